@@ -0,0 +1,286 @@
+"""
+Throughput benchmarks for the prep and loading hot paths.
+
+Generates synthetic screens of increasing size, times each stage and writes
+the results as JSON so runs can be compared across commits:
+
+    python -m benchmarks.run --output bench.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+from nncell import chop
+from nncell import illumination
+from nncell import image_prep
+from nncell import preprocessing
+from benchmarks import synthetic
+
+
+# (name, screen layout) for each dataset size
+SIZES = [
+    ("small", dict(n_plates=1, n_wells=2, n_sites=2)),
+    ("medium", dict(n_plates=2, n_wells=4, n_sites=4)),
+]
+
+
+def timed(fn, repeat=1):
+    """best wall clock time of `repeat` calls to fn, and its last result"""
+    best = float("inf")
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def record(name, seconds, items, unit, **extra):
+    """one benchmark result"""
+    out = dict(name=name, seconds=seconds, items=items, unit=unit,
+               per_second=items / seconds if seconds > 0 else None)
+    out.update(extra)
+    return out
+
+
+def count_files(directory):
+    return sum(len(files) for _, _, files in os.walk(directory))
+
+
+def make_img_dict(urls):
+    """train/test dictionary with one class per well"""
+    img_dict = image_prep.ImageDict()
+    for well, well_urls in sorted(urls.items()):
+        img_dict.add_class(well, list(well_urls))
+    img_dict.group_image_channels()
+    img_dict.train_test_split(test_size=0.5)
+    return img_dict.make_dict()
+
+
+def bench_group_channels(urls, work_dir):
+    flat = [url for well_urls in urls.values() for url in well_urls]
+    seconds, grouped = timed(
+        lambda: image_prep.ImageDict._group_channels(flat, order=True), repeat=3)
+    return [record("ImageDict._group_channels", seconds, len(flat), "urls",
+                   fields=len(grouped))]
+
+
+def _chop(img, size):
+    """chop_nuclei, treating fields with no nuclei as empty like the writers"""
+    try:
+        return chop.chop_nuclei(img, size=size)
+    except ValueError:
+        return []
+
+
+def bench_convert_and_chop(urls, work_dir, size=64):
+    flat = [url for well_urls in urls.values() for url in well_urls]
+    fields = image_prep.ImageDict._group_channels(flat, order=True)
+    seconds, rgb = timed(
+        lambda: [image_prep.Prepper.convert_to_rgb(f) for f in fields])
+    results = [record("Prepper.convert_to_rgb", seconds, len(fields), "fields",
+                      bytes=int(sum(i.nbytes for i in rgb)))]
+    seconds, crops = timed(lambda: [_chop(img, size) for img in rgb])
+    results.append(record("chop.chop_nuclei", seconds, len(rgb), "fields",
+                          crops=int(sum(len(c) for c in crops))))
+    return results
+
+
+def bench_bit_depth(urls, work_dir):
+    """field conversion time and peak memory, per output bit depth"""
+    flat = [url for well_urls in urls.values() for url in well_urls]
+    fields = image_prep.ImageDict._group_channels(flat, order=True)
+    rescale = illumination.PercentileRescale(
+        os.path.join(work_dir, "lut"), n_sample=5, seed=0).fit(fields)
+    variants = [
+        ("convert_to_rgb(bit_depth=8)",
+         lambda f: image_prep.Prepper.convert_to_rgb(f)),
+        ("convert_to_rgb(bit_depth=16)",
+         lambda f: image_prep.Prepper.convert_to_rgb(f, bit_depth=16)),
+        ("convert_to_rgb(lut)", rescale.read_field),
+    ]
+    results = []
+    for name, fn in variants:
+        seconds, rgb = timed(lambda: [fn(f) for f in fields])
+        tracemalloc.start()
+        fn(fields[0])
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        results.append(record(name, seconds, len(fields), "fields",
+                              bytes=int(sum(i.nbytes for i in rgb)),
+                              peak_bytes_per_field=peak))
+    return results
+
+
+def bench_create_directories(urls, work_dir, size=64):
+    img_dict = make_img_dict(urls)
+    n_fields = sum(len(v) for group in img_dict.values() for v in group.values())
+    variants = [
+        ("ImagePrep.create_directories",
+         lambda d: image_prep.ImagePrep(img_dict).create_directories(d)),
+        ("ArrayPrep.create_directories",
+         lambda d: image_prep.ArrayPrep(img_dict).create_directories(d)),
+        ("ImagePrep.create_directories_chop",
+         lambda d: image_prep.ImagePrep(img_dict).create_directories_chop(
+             d, size=size)),
+        ("ImagePrep.create_directories_chop(as_array)",
+         lambda d: image_prep.ImagePrep(img_dict).create_directories_chop(
+             d, as_array=True, size=size)),
+        ("ArrayPrep.create_directories_chop",
+         lambda d: image_prep.ArrayPrep(img_dict).create_directories_chop(
+             d, size=size)),
+        ("ArrayPrep.create_directories_chop(prefetch=4)",
+         lambda d: image_prep.ArrayPrep(img_dict).create_directories_chop(
+             d, size=size, prefetch=4)),
+        ("ImagePrep.create_directories_chop_par",
+         lambda d: image_prep.ImagePrep(img_dict).create_directories_chop_par(
+             d, size=size)),
+    ]
+    results = []
+    for name, fn in variants:
+        out_dir = os.path.join(work_dir, "prep")
+        seconds, _ = timed(lambda: fn(out_dir))
+        results.append(record(name, seconds, n_fields, "fields",
+                              files=count_files(out_dir)))
+        shutil.rmtree(out_dir)
+    return results
+
+
+def bench_directory_iterator(urls, work_dir, batch_size=32, n_batches=50):
+    n_fields = sum(len(v) for v in urls.values())
+    array_dir = synthetic.make_array_directory(
+        os.path.join(work_dir, "arrays"), n_per_class=max(n_fields, batch_size))
+    image_shape = (64, 64, 3)
+    generator = preprocessing.ArrayDataGenerator()
+    iterator = preprocessing.DirectoryIterator(array_dir, generator, batch_size,
+                                               image_shape)
+    seconds, _ = timed(lambda: [next(iterator) for _ in range(n_batches)])
+    results = [record("DirectoryIterator.next", seconds, n_batches, "batches",
+                      samples_per_second=n_batches * batch_size / seconds)]
+    shutil.rmtree(array_dir)
+    return results
+
+
+def bench_compressed_iterator(urls, work_dir, batch_size=32, n_batches=50):
+    """bytes read from disk against samples delivered, per storage format"""
+    n_fields = sum(len(v) for v in urls.values())
+    image_shape = (64, 64, 3)
+    results = []
+    for compress in [None, "zlib", "lzma"]:
+        array_dir = synthetic.make_array_directory(
+            os.path.join(work_dir, "arrays"), compress=compress,
+            n_per_class=max(n_fields, batch_size))
+        generator = preprocessing.ArrayDataGenerator()
+        iterator = preprocessing.DirectoryIterator(
+            array_dir, generator, batch_size, image_shape,
+            n_threads=os.cpu_count())
+        mean_file_bytes = np.mean([
+            os.path.getsize(os.path.join(array_dir, f))
+            for f in iterator.filenames])
+        seconds, _ = timed(lambda: [next(iterator) for _ in range(n_batches)])
+        n_samples = n_batches * batch_size
+        results.append(record(
+            "DirectoryIterator.next(compress={})".format(compress), seconds,
+            n_samples, "samples",
+            disk_bytes_per_second=float(n_samples * mean_file_bytes / seconds),
+            mean_file_bytes=float(mean_file_bytes)))
+        shutil.rmtree(array_dir)
+    return results
+
+
+def bench_image_iterator(urls, work_dir, batch_size=32, n_batches=50):
+    """image decode throughput, per core, with one thread and all cores"""
+    n_fields = sum(len(v) for v in urls.values())
+    image_shape = (64, 64, 3)
+    results = []
+    for ext in [".png", ".jpg"]:
+        image_dir = synthetic.make_array_directory(
+            os.path.join(work_dir, "images"), ext=ext,
+            n_per_class=max(n_fields, batch_size))
+        for n_threads in sorted(set([1, os.cpu_count()])):
+            generator = preprocessing.ArrayDataGenerator()
+            iterator = preprocessing.DirectoryIterator(
+                image_dir, generator, batch_size, image_shape,
+                n_threads=n_threads)
+            seconds, _ = timed(lambda: [next(iterator) for _ in range(n_batches)])
+            n_samples = n_batches * batch_size
+            results.append(record(
+                "DirectoryIterator.next({}, n_threads={})".format(ext, n_threads),
+                seconds, n_samples, "samples",
+                samples_per_second_per_core=n_samples / seconds / n_threads))
+        shutil.rmtree(image_dir)
+    return results
+
+
+BENCHMARKS = [
+    bench_group_channels,
+    bench_convert_and_chop,
+    bench_bit_depth,
+    bench_create_directories,
+    bench_directory_iterator,
+    bench_compressed_iterator,
+    bench_image_iterator,
+]
+
+
+def git_commit():
+    """current commit hash, or None if not in a git checkout"""
+    try:
+        out = subprocess.check_output(["git", "rev-parse", "HEAD"],
+                                      stderr=subprocess.DEVNULL,
+                                      cwd=os.path.dirname(os.path.abspath(__file__)))
+        return out.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(sizes=SIZES, benchmarks=BENCHMARKS, shape=(512, 512), n_nuclei=50):
+    """run every benchmark on every dataset size, returning a results dict"""
+    results = []
+    for size_name, layout in sizes:
+        work_dir = tempfile.mkdtemp(prefix="nncell_bench_")
+        try:
+            urls = synthetic.make_screen(os.path.join(work_dir, "screen"),
+                                         shape=shape, n_nuclei=n_nuclei,
+                                         **layout)
+            for bench in benchmarks:
+                for result in bench(urls, work_dir):
+                    result["dataset"] = size_name
+                    result["layout"] = layout
+                    results.append(result)
+                    print("{dataset:>8} {name:<45} {per_second:>10.1f} {unit}/s".format(
+                        **result))
+        finally:
+            shutil.rmtree(work_dir)
+    return dict(commit=git_commit(),
+                time=time.strftime("%Y-%m-%dT%H:%M:%S"),
+                python=platform.python_version(),
+                numpy=np.__version__,
+                cpu_count=os.cpu_count(),
+                field_shape=list(shape),
+                n_nuclei=n_nuclei,
+                results=results)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--output", default="bench_output.json",
+                        help="path to write JSON results to")
+    parser.add_argument("--sizes", nargs="*", default=[s for s, _ in SIZES],
+                        help="dataset sizes to run")
+    args = parser.parse_args()
+    sizes = [s for s in SIZES if s[0] in args.sizes]
+    output = run(sizes=sizes)
+    with open(args.output, "w") as f:
+        json.dump(output, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
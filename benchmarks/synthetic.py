@@ -0,0 +1,139 @@
+"""
+Synthetic ImageXpress-style datasets for benchmarking.
+
+Fields are uint16 TIFFs with Gaussian nuclei, named and laid out on disk
+the way ImageXpress writes them, e.g.
+
+    <base>/<date> <screen>/<screen>/<plate_name>/<date>/<plate_num>/
+        <screen>_B02_s1_w1<GUID>.tif
+"""
+
+import os
+import uuid
+import numpy as np
+from skimage import io
+from nncell import utils
+
+
+SCREEN = "synthetic screen"
+DATE = "2017-01-01"
+
+
+def well_names(n_wells):
+    """first `n_wells` well names of a 384 well plate, in row order"""
+    rows = "ABCDEFGHIJKLMNOP"
+    return ["{}{:02d}".format(rows[i // 24], i % 24 + 1) for i in range(n_wells)]
+
+
+def make_field(shape=(512, 512), n_nuclei=50, sigma=6.0, random_state=None):
+    """
+    single channel field of Gaussian nuclei on a noisy background
+
+    Parameters:
+    -----------
+    shape : tuple (default = (512, 512))
+        field shape in pixels
+    n_nuclei : integer (default = 50)
+        number of nuclei
+    sigma : number (default = 6.0)
+        nucleus radius as a Gaussian standard deviation
+    random_state : np.random.RandomState (default = None)
+
+    Returns:
+    --------
+    uint16 array, and the (n_nuclei, 2) array of nucleus centres
+    """
+    rng = np.random.RandomState() if random_state is None else random_state
+    field = rng.normal(1000, 50, size=shape).astype("float32")
+    centres = rng.uniform(0, 1, size=(n_nuclei, 2)) * np.asarray(shape)
+    # stamp a Gaussian per nucleus, only over its local window
+    radius = int(np.ceil(4 * sigma))
+    offsets = np.arange(-radius, radius + 1)
+    for x, y in centres:
+        xs = np.clip(int(x) + offsets, 0, shape[0] - 1)
+        ys = np.clip(int(y) + offsets, 0, shape[1] - 1)
+        gx = np.exp(-((xs - x) ** 2) / (2 * sigma ** 2))
+        gy = np.exp(-((ys - y) ** 2) / (2 * sigma ** 2))
+        brightness = rng.uniform(20000, 40000)
+        field[np.ix_(xs, ys)] += brightness * np.outer(gx, gy)
+    return np.clip(field, 0, 65535).astype("uint16"), centres
+
+
+def make_screen(base_dir, n_plates=1, n_wells=4, n_sites=2, n_channels=3,
+                shape=(512, 512), n_nuclei=50, seed=0):
+    """
+    write a synthetic ImageXpress screen to disk
+
+    Channel 1 holds the nuclei, the other channels are dimmer copies of
+    the same field so that crops are multi-channel but consistent.
+
+    Parameters:
+    -----------
+    base_dir : string
+        directory to write the screen into
+    n_plates, n_wells, n_sites, n_channels : integers
+        screen layout
+    shape : tuple (default = (512, 512))
+        field shape in pixels
+    n_nuclei : integer (default = 50)
+        nuclei per field
+    seed : integer (default = 0)
+        random seed
+
+    Returns:
+    --------
+    dictionary of {well : [image URLs]}
+    """
+    rng = np.random.RandomState(seed)
+    urls = dict()
+    for plate in range(n_plates):
+        plate_name = "PLATE{:05d}".format(plate)
+        plate_num = str(1000 + plate)
+        plate_dir = os.path.join(base_dir, "{} {}".format(DATE, SCREEN), SCREEN,
+                                 plate_name, DATE, plate_num)
+        os.makedirs(plate_dir, exist_ok=True)
+        for well in well_names(n_wells):
+            for site in range(1, n_sites + 1):
+                nuclei, _ = make_field(shape, n_nuclei, random_state=rng)
+                for channel in range(1, n_channels + 1):
+                    img = nuclei if channel == 1 else (nuclei // (channel + 1))
+                    guid = str(uuid.UUID(bytes=rng.bytes(16))).upper()
+                    fname = "{}_{}_s{}_w{}{}.tif".format(SCREEN, well, site,
+                                                        channel, guid)
+                    path = os.path.join(plate_dir, fname)
+                    io.imsave(path, img, check_contrast=False)
+                    urls.setdefault(well, []).append(path)
+    return urls
+
+
+def make_array_directory(base_dir, n_classes=2, n_per_class=100,
+                         shape=(64, 64, 3), compress=None, ext=None, seed=0):
+    """
+    write a directory of nucleus crops in the layout DirectoryIterator reads,
+    one sub-directory per class. Each crop is a single Gaussian nucleus on
+    background, so compresses like real crops.
+
+    Parameters:
+    -----------
+    compress : None, True, "zlib" or "lzma" (default = None)
+        passed to utils.save_array
+    ext : None, ".png" or ".jpg" (default = None)
+        if given, crops are saved as images rather than arrays
+
+    Returns:
+    --------
+    path to the directory
+    """
+    rng = np.random.RandomState(seed)
+    for label in range(n_classes):
+        class_dir = os.path.join(base_dir, "class_{}".format(label))
+        os.makedirs(class_dir, exist_ok=True)
+        for i in range(n_per_class):
+            field, _ = make_field(shape[:2], n_nuclei=1, random_state=rng)
+            crop = np.dstack([(field >> 8).astype("uint8")] * shape[2])
+            path = os.path.join(class_dir, "img_{}".format(i))
+            if ext is None:
+                utils.save_array(path, crop, compress)
+            else:
+                io.imsave(path + ext, crop, check_contrast=False)
+    return base_dir
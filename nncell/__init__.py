@@ -1,3 +1,13 @@
 from nncell import image_prep
 from nncell import chop
-from nncell import utils
\ No newline at end of file
+from nncell import utils
+from nncell import loader
+from nncell import stats
+from nncell import scheduler
+from nncell import profiling
+from nncell import validate
+from nncell import inference
+from nncell import records
+from nncell import illumination
+from nncell import prefetch
+from nncell import tables
@@ -1,8 +1,12 @@
 import os
+from collections import Counter
 import numpy as np
+from scipy import spatial
 from skimage import feature
 from skimage import io
+from skimage import transform
 from nncell import utils
+from nncell import profiling
 
 """
 chop parent image into separate images for each nuclei
@@ -120,7 +124,174 @@ def crop_to_box(x, y, img, size, edge="keep"):
         raise ValueError("wrong number of dimensions in img")
 
 
-def chop_nuclei(img, size=100, edge="keep", threshold=0.1, **kwargs):
+def find_nuclei(img, threshold=0.1, dedupe_radius=None, dedupe_keep="largest",
+                **kwargs):
+    """
+    Detect nuclei with skimage.feature.blob_dog. Multi-channel images use the
+    first channel as nuclei.
+
+    Parameters:
+    ------------
+    img : numpy.array
+        image
+    threshold : number (default = 0.1)
+        threshold argument to skimage.feature.blob_dog
+    dedupe_radius : number (default = None)
+        if given, blobs closer than this (in pixels) to a stronger or larger
+        blob are dropped, see dedupe_nuclei()
+    dedupe_keep : string (default = "largest")
+        which blob of a cluster to keep, see dedupe_nuclei()
+    **kwargs : additional arguments to skimage.feature.blob_dog
+
+    Returns:
+    ---------
+    numpy.array of blobs, one (x, y, sigma) row per nucleus
+    """
+    if img.ndim == 2:
+        # single channel image
+        nuclei_img = img
+    elif img.ndim == 3:
+        # multi channel image, take first channel as nuclei
+        nuclei_img = img[:, :, 0]
+    else:
+        raise ValueError("wrong number of dimensions in img")
+    blobs = feature.blob_dog(nuclei_img, threshold=threshold, **kwargs)
+    if dedupe_radius is not None:
+        blobs = dedupe_nuclei(blobs, dedupe_radius, keep=dedupe_keep,
+                              img=nuclei_img)
+    return blobs
+
+
+def dedupe_nuclei(blobs, radius, keep="largest", img=None):
+    """
+    Remove duplicate detections of the same nucleus. blob_dog often finds
+    a nucleus at several scales; of any blobs closer than `radius` the
+    largest or brightest is kept and the others suppressed.
+
+    Neighbours are found with a KD-tree, so this is O(n log n) in the number
+    of blobs.
+
+    Parameters:
+    ------------
+    blobs : numpy.array
+        (n, 3) array of (x, y, sigma) rows from find_nuclei()
+    radius : number
+        minimum distance between kept blobs (in pixels)
+    keep : string (default = "largest")
+        options:
+            largest   : keep the blob with the largest sigma
+            strongest : keep the blob with the brightest centre pixel in img
+    img : numpy.array (default = None)
+        single channel nuclei image, needed for keep="strongest"
+
+    Returns:
+    ---------
+    numpy.array of the kept blobs, in their original order
+    """
+    keep_args = ["largest", "strongest"]
+    if keep not in keep_args:
+        raise ValueError("unknown keep argument. options: {}".format(keep_args))
+    blobs = np.asarray(blobs)
+    if len(blobs) < 2:
+        return blobs
+    pairs = spatial.cKDTree(blobs[:, :2]).query_pairs(radius, output_type="ndarray")
+    if len(pairs) == 0:
+        return blobs
+    if keep == "largest":
+        priority = blobs[:, 2]
+    else:
+        if img is None:
+            raise ValueError("keep='strongest' needs img")
+        xs = np.clip(blobs[:, 0].astype(int), 0, img.shape[0] - 1)
+        ys = np.clip(blobs[:, 1].astype(int), 0, img.shape[1] - 1)
+        # as float, negating unsigned intensities below would wrap around
+        priority = img[xs, ys].astype("float64")
+    # neighbour lists in compressed sparse row form
+    source = np.concatenate([pairs[:, 0], pairs[:, 1]])
+    target = np.concatenate([pairs[:, 1], pairs[:, 0]])
+    target = target[np.argsort(source, kind="stable")]
+    indptr = np.concatenate([[0], np.cumsum(np.bincount(source,
+                                                        minlength=len(blobs)))])
+    suppressed = np.zeros(len(blobs), dtype=bool)
+    # greedy suppression from the highest priority down, only blobs with
+    # neighbours need visiting
+    order = np.argsort(-priority, kind="stable")
+    for i in order[np.diff(indptr)[order] > 0]:
+        if not suppressed[i]:
+            suppressed[target[indptr[i]: indptr[i + 1]]] = True
+    return blobs[~suppressed]
+
+
+def box_origins(coords, img_shape, size, edge="keep"):
+    """
+    Vectorized crop_to_box(): top-left corners of the `size` * `size` boxes
+    around each co-ordinate.
+
+    Parameters:
+    ------------
+    coords : numpy.array
+        (n, 2) array of x, y co-ordinates, e.g. the first two columns of
+        find_nuclei()
+    img_shape : tuple
+        shape of the image the boxes are cut from
+    size : number
+        width and height of the boxes (in pixels)
+    edge : string
+        "keep" moves boxes beyond the image boundary back inside it,
+        "remove" drops them. See crop_to_box()
+
+    Returns:
+    ---------
+    (origins, kept) : (m, 2) integer array of box corners, and the boolean
+        mask of the input co-ordinates they belong to
+    """
+    _check_size(size)
+    _check_edge_args(edge)
+    for dim in img_shape[:2]:
+        if dim < size:
+            raise ValueError("image is too small for specified box size")
+    coords = np.asarray(coords, dtype="float64").reshape(-1, 2)
+    dist = int(size / 2)
+    limits = np.asarray(img_shape[:2], dtype="float64")
+    outside = ((coords + dist > limits) | (coords - dist < 0)).any(axis=1)
+    if edge == "remove":
+        kept = ~outside
+    else:
+        kept = np.ones(len(coords), dtype=bool)
+    nudged = np.clip(coords[kept], dist, limits - dist)
+    origins = np.floor(nudged - dist).astype("int64")
+    return origins, kept
+
+
+def crop_boxes(img, origins, size, out=None):
+    """
+    Cut `size` * `size` boxes from img at each origin from box_origins().
+
+    Parameters:
+    ------------
+    img : numpy.array
+        image
+    origins : numpy.array
+        (n, 2) integer array of box corners
+    size : integer
+        width and height of the boxes (in pixels)
+    out : numpy.array (default = None)
+        array of shape (n, size, size[, channels]) to write the boxes into
+
+    Returns:
+    ---------
+    numpy.array of boxes
+    """
+    if out is None:
+        out = np.empty((len(origins), size, size) + img.shape[2:], dtype=img.dtype)
+    for i, (x, y) in enumerate(origins):
+        out[i] = img[x: x + size, y: y + size]
+    return out
+
+
+@profiling.profiled("chop_nuclei")
+def chop_nuclei(img, size=100, edge="keep", threshold=0.1, return_blobs=False,
+                **kwargs):
     """
     Chop an image into separate images for each nuclei. Each image will be the
     same dimensions of `size`*`size` pixels. Nuclei on the edge of the image
@@ -131,41 +302,319 @@ def chop_nuclei(img, size=100, edge="keep", threshold=0.1, **kwargs):
     ------------
     img : numpy.array
         image
-    size : integer
-        size of image, must be a positive even integer (in pixels)
+    size : integer or list of integers
+        size of image, must be a positive even integer (in pixels).
+        If a list of sizes, the nuclei are detected once and cropped at
+        every size.
     edge : string
         what to do with nuclei on the edge of the parent image
         options:
             keep   : nuclei will be kept though they may not be centered within
                      the individual image
-            remove : nuclei near the edge of the image will be ignored
+            remove : nuclei near the edge of the image will be ignored. With
+                     several sizes a nucleus is only kept if it fits at all
+                     of them.
     threshold : number (default = 0.1)
         threshold argument to skimage.feature.blob_dog
-    **kwargs : additional arguments to skimage.feature.blob_dog to detect the
-        nuclei.
+    return_blobs : Boolean (default = False)
+        also return the (x, y, sigma) row of each cropped nucleus
+    **kwargs : additional arguments to find_nuclei() and
+        skimage.feature.blob_dog to detect the nuclei, e.g. dedupe_radius to
+        drop duplicate detections of a nucleus.
+
+    Returns:
+    --------
+    array of crops, shape (n, size, size, channels). For a list of sizes a
+    dictionary {size: crops}, where crop i is the same nucleus at every size.
+    With return_blobs, a tuple (crops, blobs) where blobs is the (n, 3)
+    array of the nuclei from find_nuclei(), in the order of the crops.
+
+    Raises:
+    -------
+    ValueError if no nuclei are found
     """
+    blobs = _kept_nuclei(img, size, edge, threshold, **kwargs)
+    crops = _crop_sizes(img, blobs[:, :2], size, edge)
+    if return_blobs:
+        return crops, blobs
+    return crops
+
+
+def iter_crops(img, size=100, chunk_size=None, edge="keep", threshold=0.1,
+               return_blobs=False, **kwargs):
+    """
+    chop_nuclei() in chunks of at most `chunk_size` nuclei, so the crops of
+    a dense field never all need to be in memory at once. The nuclei are
+    detected when this is called, and cropped a chunk at a time.
+
+    Parameters:
+    ------------
+    img : numpy.array
+        image
+    size : integer or list of integers
+        size of the crops, see chop_nuclei()
+    chunk_size : integer (default = None)
+        largest number of nuclei per chunk, None for a single chunk
+    edge, threshold, return_blobs, **kwargs : see chop_nuclei()
+
+    Returns:
+    --------
+    iterator of crop arrays, or {size: crops} dictionaries for a list of
+    sizes, in the order chop_nuclei() returns the nuclei. With return_blobs,
+    (crops, blobs) tuples.
+
+    Raises:
+    -------
+    ValueError if no nuclei are found
+    """
+    if chunk_size is not None and chunk_size < 1:
+        raise ValueError("chunk_size must be at least 1")
+    blobs = _kept_nuclei(img, size, edge, threshold, **kwargs)
+    chunk_size = chunk_size or len(blobs)
+    return (_crop_chunk(img, blobs[start: start + chunk_size], size, edge,
+                        return_blobs)
+            for start in range(0, len(blobs), chunk_size))
+
+
+def _crop_chunk(img, blobs, size, edge, return_blobs):
+    """crops of one chunk of blobs, see iter_crops()"""
+    crops = _crop_sizes(img, blobs[:, :2], size, edge)
+    if return_blobs:
+        return crops, blobs
+    return crops
+
+
+def _kept_nuclei(img, size, edge, threshold, **kwargs):
+    """(n, 3) blobs of the nuclei kept at every size, see find_nuclei()"""
     _check_edge_args(edge)
-    if img.ndim == 2:
-        # single channel image
-        # find nuclei positions within the image
-        nuclei = feature.blob_dog(img, threshold=threshold, **kwargs)
-    elif img.ndim == 3:
-        # multi channel image, take first channel as nuclei
-        nuclei = feature.blob_dog(img[:, :, 0], threshold=threshold, **kwargs)
+    sizes = size if isinstance(size, (list, tuple)) else [size]
+    # find nuclei positions within the image
+    nuclei = find_nuclei(img, threshold=threshold, **kwargs)
+    coords = nuclei[:, :2]
+    # a nucleus removed at any size is removed at every size, so crop i is
+    # the same nucleus whatever the size
+    kept = np.ones(len(coords), dtype=bool)
+    for crop_size in sizes:
+        kept &= box_origins(coords, img.shape, crop_size, edge)[1]
+    if not kept.any():
+        raise ValueError("no nuclei found in img")
+    return nuclei[kept]
+
+
+def _crop_sizes(img, coords, size, edge):
+    """crops around kept co-ordinates, {size: crops} for a list of sizes"""
+    sizes = size if isinstance(size, (list, tuple)) else [size]
+    crops = dict()
+    for crop_size in sizes:
+        origins, _ = box_origins(coords, img.shape, crop_size, edge)
+        crops[crop_size] = crop_boxes(img, origins, crop_size)
+    if isinstance(size, (list, tuple)):
+        return crops
+    return crops[size]
+
+
+def detection_bytes(img_shape, min_sigma=1, max_sigma=50, sigma_ratio=1.6,
+                    **kwargs):
+    """
+    approximate peak memory of find_nuclei() on an image of `img_shape`,
+    with the skimage.feature.blob_dog scale arguments in kwargs
+    """
+    # blob_dog holds k + 1 float64 gaussian images, k differences, and a
+    # maximum filter of the k differences
+    k = int(np.log(float(max_sigma) / min_sigma) / np.log(sigma_ratio) + 1)
+    return int(img_shape[0] * img_shape[1] * 8 * (2 * k + 5))
+
+
+def crop_bytes(size, n_channels, itemsize=1, resize_to=None):
+    """
+    memory of the crops of one nucleus, at every size and resized
+
+    Parameters:
+    ------------
+    size : integer or list of integers
+        crop sizes, see chop_nuclei()
+    n_channels : integer
+        number of channels in the image
+    itemsize : integer (default = 1)
+        bytes per pixel per channel
+    resize_to : integer or tuple (default = None)
+        size the crops are resized to, see resize_crops()
+    """
+    sizes = size if isinstance(size, (list, tuple)) else [size]
+    n_bytes = sum(s * s for s in sizes) * n_channels * itemsize
+    if resize_to is not None:
+        if isinstance(resize_to, int):
+            resize_to = (resize_to, resize_to)
+        # resize_crops works in floats for sizes that aren't a factor
+        n_bytes += len(sizes) * resize_to[0] * resize_to[1] * n_channels * 8
+    return int(n_bytes)
+
+
+def resize_crops(crops, size, out=None):
+    """
+    Resize a stack of crops in one vectorized operation.
+
+    When the crop size is an integer multiple of `size`, each output pixel
+    is the mean of its block of input pixels (a reshape and mean over the
+    whole stack). Otherwise each crop is resized with
+    skimage.transform.resize.
+
+    Parameters:
+    ------------
+    crops : numpy.array
+        (n, height, width[, channels]) stack, e.g. from chop_nuclei()
+    size : integer or tuple (height, width)
+        output crop size (in pixels)
+    out : numpy.array (default = None)
+        array of shape (n, height, width[, channels]) to write into
+
+    Returns:
+    ---------
+    numpy.array of resized crops, of the same dtype as crops unless out is
+    given
+    """
+    crops = np.asarray(crops)
+    if isinstance(size, int):
+        size = (size, size)
+    n, height, width = crops.shape[:3]
+    channels = crops.shape[3:]
+    out_shape = (n, ) + tuple(size) + channels
+    if out is not None and out.shape != out_shape:
+        raise ValueError("out has shape {}, expected {}".format(out.shape,
+                                                                out_shape))
+    if (height, width) == tuple(size):
+        if out is None:
+            return crops.copy()
+        out[...] = crops
+        return out
+    if height % size[0] == 0 and width % size[1] == 0:
+        # area averaging: split each axis into (output pixel, block) and
+        # average over the blocks
+        blocks = crops.reshape((n, size[0], height // size[0],
+                                size[1], width // size[1]) + channels)
+        if out is not None:
+            return blocks.mean(axis=(2, 4), out=out)
+        resized = blocks.mean(axis=(2, 4), dtype="float32")
     else:
-        raise ValueError("wrong number of dimensions in img")
-    # loop through x-y co-ordinates for each nucleus
-    # create list of sub-arrays
-    cropped_imgs = []
-    for x, y, _ in nuclei:
-        cropped = crop_to_box(x, y, img, size, edge)
-        cropped_imgs.append(cropped)
-    # remove any empty arrays
-    cropped_remove_na = [i for i in cropped_imgs if i is not None]
-    return np.stack(cropped_remove_na)
+        resized = np.empty(out_shape, dtype="float64") if out is None else out
+        for i, crop in enumerate(crops):
+            resized[i] = transform.resize(crop, tuple(size) + channels,
+                                          preserve_range=True,
+                                          anti_aliasing=True)
+        if out is not None:
+            return out
+    if crops.dtype.kind in "ui":
+        return np.rint(resized).astype(crops.dtype)
+    return resized.astype(crops.dtype)
+
+
+def crop_quality(crops, channel=0, saturation=None):
+    """
+    Cheap quality metrics of every crop in a stack, computed in one pass
+    over the whole stack.
+
+    Parameters:
+    -----------
+    crops : numpy.array
+        crops from chop_nuclei(), shape (n, size, size) or
+        (n, size, size, channels)
+    channel : integer (default = 0)
+        channel to measure, by default the nuclear channel used to find the
+        nuclei
+    saturation : number (default = None)
+        pixel value counted as saturated. Defaults to the largest value of
+        an integer dtype, or 1.0 for floats.
+
+    Returns:
+    --------
+    dictionary of arrays of length n:
+        focus : variance of the Laplacian, low for blurred crops
+        mean : mean intensity
+        saturated : fraction of pixels at or above `saturation`
+    """
+    crops = np.asarray(crops)
+    if saturation is None:
+        if crops.dtype.kind in "ui":
+            saturation = np.iinfo(crops.dtype).max
+        else:
+            saturation = 1.0
+    if crops.ndim == 4:
+        crops = crops[..., channel]
+    x = crops.astype("float32")
+    # 4-neighbour Laplacian of the interior pixels of every crop
+    laplacian = (x[:, :-2, 1:-1] + x[:, 2:, 1:-1] + x[:, 1:-1, :-2] +
+                 x[:, 1:-1, 2:] - 4 * x[:, 1:-1, 1:-1])
+    return {"focus": laplacian.reshape(len(x), -1).var(axis=1),
+            "mean": x.reshape(len(x), -1).mean(axis=1),
+            "saturated": (crops >= saturation).reshape(len(x), -1).mean(axis=1)}
+
+
+class QualityFilter(object):
+    """
+    Drop unusable crops before they are written, by thresholds on
+    crop_quality(). A threshold of None is not applied.
+
+    Counts of kept and dropped crops are recorded per label, e.g. per
+    class, in `kept` and `dropped`.
+
+    Parameters:
+    -----------
+    min_focus : number (default = None)
+        drop crops with a variance of the Laplacian below this, out of focus
+    min_mean : number (default = None)
+        drop crops with a mean intensity below this, e.g. debris
+    max_mean : number (default = None)
+        drop crops with a mean intensity above this
+    max_saturated : number (default = None)
+        drop crops with a larger fraction of saturated pixels than this
+    channel : integer (default = 0)
+        channel to measure, see crop_quality()
+    saturation : number (default = None)
+        pixel value counted as saturated, see crop_quality()
+    """
+
+    def __init__(self, min_focus=None, min_mean=None, max_mean=None,
+                 max_saturated=None, channel=0, saturation=None):
+        self.min_focus = min_focus
+        self.min_mean = min_mean
+        self.max_mean = max_mean
+        self.max_saturated = max_saturated
+        self.channel = channel
+        self.saturation = saturation
+        self.kept = Counter()
+        self.dropped = Counter()
+
+
+    def mask(self, crops):
+        """boolean array, True for the crops that pass every threshold"""
+        metrics = crop_quality(crops, self.channel, self.saturation)
+        keep = np.ones(len(crops), dtype=bool)
+        if self.min_focus is not None:
+            keep &= metrics["focus"] >= self.min_focus
+        if self.min_mean is not None:
+            keep &= metrics["mean"] >= self.min_mean
+        if self.max_mean is not None:
+            keep &= metrics["mean"] <= self.max_mean
+        if self.max_saturated is not None:
+            keep &= metrics["saturated"] <= self.max_saturated
+        return keep
+
+
+    def record(self, label, n_kept, n_dropped):
+        """add to the kept and dropped counts of label"""
+        self.kept[label] += int(n_kept)
+        self.dropped[label] += int(n_dropped)
+
+
+    def filter(self, crops, label=None):
+        """the crops that pass, recording the counts under label"""
+        keep = self.mask(crops)
+        self.record(label, keep.sum(), len(keep) - keep.sum())
+        return crops[keep]
 
 
-def save_chopped(arr, directory, prefix="img", ext=".png", save_as="img"):
+def save_chopped(arr, directory, prefix="img", ext=".png", save_as="img",
+                 compress=None, resize_to=None, quality_filter=None):
     """
     Save chopped array from chop_nuclei() to a directory. Each image will be
     saved individually and consecutively numbered.
@@ -181,8 +630,21 @@ def save_chopped(arr, directory, prefix="img", ext=".png", save_as="img"):
     ext : string (default : ".png")
         file extension. options are .png and .jpg if saving as an image.
         Otherwise recommended extension for numpy arrays is .npy
+    save_as : string (default : "img")
+        "img" saves images with `ext`, anything else saves numpy arrays
+    compress : None, True, "zlib" or "lzma" (default : None)
+        when saving arrays, compress each into a .npz rather than a .npy.
+        See utils.save_array
+    resize_to : integer or tuple (default : None)
+        resize the crops to this size before saving, see resize_crops()
+    quality_filter : QualityFilter (default : None)
+        drop unusable crops before saving, counted under `directory`
     """
     assert isinstance(arr, np.ndarray)
+    if quality_filter is not None:
+        arr = quality_filter.filter(arr, label=directory)
+    if resize_to is not None:
+        arr = resize_crops(arr, resize_to)
     _check_ext_args(ext)
     utils.make_dir(directory)
     # loop through images in array and save with consecutive numbers
@@ -193,9 +655,9 @@ def save_chopped(arr, directory, prefix="img", ext=".png", save_as="img"):
             io.imsave(fname=full_path, arr=img)
     else:
         for i, img in enumerate(arr, 1):
-            arr_name = "arr_{}.npy".format(i)
+            arr_name = "arr_{}".format(i)
             full_path = os.path.join(os.path.abspath(directory), arr_name)
-            np.save(full_path, img)
+            utils.save_array(full_path, img, compress)
 
 
 def _check_size(size):
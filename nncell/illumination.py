@@ -0,0 +1,296 @@
+"""
+Intensity corrections computed once per plate: illumination (flat-field)
+correction, and percentile rescaling of high bit depth images to 8 bits.
+
+Both are estimated from a sample of each plate's fields and applied to
+every field of the plate, so their cost is paid per plate rather than per
+field. Results are cached as .npy files, one per plate, so they are
+computed once and shared by every process that reads the plate.
+
+The flat-field of a plate is the average image of each channel over the
+sample, smoothed and scaled to a mean of 1, and fields are divided by it.
+
+The rescaling lookup table of a plate maps each 16-bit value of a channel
+to 8 bits, stretching the sample's low to high percentiles over 0-255, so
+fields are converted with a table lookup and no float copy of the field.
+"""
+
+import os
+import random
+import numpy as np
+from scipy import ndimage
+from skimage import io
+from parserix import parse
+from nncell import image_prep
+
+
+class PlateCache(object):
+    """
+    Base class for statistics estimated once per plate from a sample of
+    its fields, and cached to disk. Subclasses set `name` and implement
+    estimate().
+
+    Parameters:
+    -----------
+    cache_dir : string
+        directory to store the results in, created if it does not exist
+    n_sample : integer (default = 50)
+        number of fields sampled per plate
+    seed : integer (default = None)
+        random seed for sampling fields
+    """
+
+    name = None
+
+    def __init__(self, cache_dir, n_sample=50, seed=None):
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        self.cache_dir = cache_dir
+        self.n_sample = n_sample
+        self.seed = seed
+        self._cache = dict()
+
+
+    @staticmethod
+    def plate_of(field):
+        """plate key of a field, from the path of its first image"""
+        return "{}_{}".format(parse.plate_name(field[0]), parse.plate_num(field[0]))
+
+
+    def _suffix(self):
+        """
+        distinguishes results computed with different settings, subclasses
+        add every setting of their own that changes the result
+        """
+        return "_{}_{}".format(self.n_sample, self.seed)
+
+
+    def _path(self, plate):
+        return os.path.join(self.cache_dir, "{}_{}{}.npy".format(
+            self.name, plate, self._suffix()))
+
+
+    def fit(self, fields):
+        """
+        estimate and cache the result for every plate that isn't cached
+
+        Parameters:
+        -----------
+        fields : iterable, ImageDict or dictionary
+            fields to sample from, channel paths per field or an image
+            dictionary, see image_prep.list_fields()
+
+        Returns:
+        --------
+        self
+        """
+        if isinstance(fields, (dict, image_prep.ImageDict)):
+            fields, _ = image_prep.list_fields(fields)
+        else:
+            fields = list(fields)
+        by_plate = dict()
+        for field in fields:
+            by_plate.setdefault(self.plate_of(field), []).append(field)
+        random_state = random.Random(self.seed)
+        for plate in sorted(by_plate):
+            if os.path.isfile(self._path(plate)):
+                continue
+            plate_fields = by_plate[plate]
+            sample = random_state.sample(plate_fields,
+                                         min(self.n_sample, len(plate_fields)))
+            result = self.estimate(sample)
+            # write then rename, so other processes never see part of a file
+            tmp_path = self._path(plate) + ".{}.tmp.npy".format(os.getpid())
+            np.save(tmp_path, result)
+            os.replace(tmp_path, self._path(plate))
+        return self
+
+
+    def estimate(self, fields):
+        """the result for one plate, from a sample of its fields"""
+        raise NotImplementedError
+
+
+    def get(self, plate):
+        """the cached result of a plate, loaded once per process"""
+        if plate not in self._cache:
+            path = self._path(plate)
+            if not os.path.isfile(path):
+                raise ValueError("no {} for plate {}, call fit() first".format(
+                    self.name, plate))
+            self._cache[plate] = np.load(path)
+        return self._cache[plate]
+
+
+    def get_for(self, field):
+        """the result of the plate a field belongs to"""
+        return self.get(self.plate_of(field))
+
+
+    def __getstate__(self):
+        # workers load the results they need from the cache
+        state = self.__dict__.copy()
+        state["_cache"] = dict()
+        return state
+
+
+
+class IlluminationCorrection(PlateCache):
+    """
+    Per-plate, per-channel flat-fields.
+
+    Parameters:
+    -----------
+    cache_dir : string
+        directory to store the flat-fields in, created if it does not exist
+    method : string (default = "mean")
+        "mean" streams a running sum over the sample, one field at a time.
+        "median" is more robust to debris and bright artefacts, but holds
+        the sampled images of a channel in memory at once.
+    n_sample : integer (default = 50)
+        number of fields sampled per plate
+    sigma : number (default = None)
+        standard deviation of the gaussian smoothing, in pixels. Defaults to
+        1/20th of the smaller image dimension.
+    seed : integer (default = None)
+        random seed for sampling fields
+    """
+
+    name = "flatfield"
+
+    def __init__(self, cache_dir, method="mean", n_sample=50, sigma=None,
+                 seed=None):
+        if method not in ("mean", "median"):
+            raise ValueError("method must be 'mean' or 'median'")
+        super().__init__(cache_dir, n_sample, seed)
+        self.method = method
+        self.sigma = sigma
+
+
+    def _suffix(self):
+        return "_{}_{}{}".format(self.method, self.sigma, super()._suffix())
+
+
+    def estimate(self, fields):
+        """
+        (height, width, channels) float32 flat-field from a sample of fields,
+        each smoothed and scaled to a mean of 1
+        """
+        n_channels = len(fields[0])
+        channels = []
+        for c in range(n_channels):
+            if self.method == "mean":
+                total = None
+                for field in fields:
+                    img = io.imread(field[c])
+                    if total is None:
+                        total = np.zeros(img.shape, dtype="float64")
+                    total += img
+                average = total / len(fields)
+            else:
+                stack = np.stack([io.imread(field[c]) for field in fields])
+                average = np.median(stack, axis=0)
+            sigma = self.sigma
+            if sigma is None:
+                sigma = min(average.shape) / 20.0
+            smooth = ndimage.gaussian_filter(average.astype("float32"), sigma)
+            smooth /= smooth.mean()
+            # never divide by (nearly) zero in dark corners
+            channels.append(np.maximum(smooth, 1e-3))
+        return np.dstack(channels).astype("float32")
+
+
+    def flatfield(self, plate):
+        """the cached flat-field of a plate"""
+        return self.get(plate)
+
+
+    def flatfield_for(self, field):
+        """the flat-field of the plate a field belongs to"""
+        return self.get_for(field)
+
+
+    def read_field(self, field):
+        """
+        read and correct a field, image_prep.Prepper.convert_to_rgb with
+        its plate's flat-field. Can be passed as read_field to
+        FieldCropIterator and the inference functions.
+        """
+        return image_prep.Prepper.convert_to_rgb(field, self.flatfield_for(field))
+
+
+
+class PercentileRescale(PlateCache):
+    """
+    Per-plate, per-channel lookup tables rescaling 8 or 16-bit images to
+    8 bits, mapping the `low` to `high` percentile of each channel's values
+    over the sample to 0-255.
+
+    Parameters:
+    -----------
+    cache_dir : string
+        directory to store the lookup tables in, created if it does not exist
+    low : number (default = 0.1)
+        percentile mapped to 0
+    high : number (default = 99.9)
+        percentile mapped to 255
+    n_sample : integer (default = 50)
+        number of fields sampled per plate
+    seed : integer (default = None)
+        random seed for sampling fields
+    """
+
+    name = "lut"
+
+    def __init__(self, cache_dir, low=0.1, high=99.9, n_sample=50, seed=None):
+        if not 0 <= low < high <= 100:
+            raise ValueError("need 0 <= low < high <= 100")
+        super().__init__(cache_dir, n_sample, seed)
+        self.low = low
+        self.high = high
+
+
+    def _suffix(self):
+        return "_{}_{}{}".format(self.low, self.high, super()._suffix())
+
+
+    def estimate(self, fields):
+        """(channels, 65536) uint8 lookup table from a sample of fields"""
+        n_channels = len(fields[0])
+        hist = np.zeros((n_channels, 2 ** 16), dtype="int64")
+        for field in fields:
+            for c, path in enumerate(field):
+                img = io.imread(path)
+                if img.dtype.kind != "u" or img.dtype.itemsize > 2:
+                    raise ValueError("rescaling needs 8 or 16-bit unsigned images")
+                hist[c] += np.bincount(img.ravel(), minlength=2 ** 16)
+        cumulative = np.cumsum(hist, axis=1)
+        values = np.arange(2 ** 16, dtype="float64")
+        lut = np.empty((n_channels, 2 ** 16), dtype="uint8")
+        for c in range(n_channels):
+            total = cumulative[c, -1]
+            low, high = np.searchsorted(
+                cumulative[c], [max(self.low / 100.0 * total, 1),
+                                self.high / 100.0 * total])
+            high = max(high, low + 1)
+            scaled = (values - low) * (255.0 / (high - low))
+            lut[c] = np.rint(np.clip(scaled, 0, 255))
+        return lut
+
+
+    def lut(self, plate):
+        """the cached lookup table of a plate"""
+        return self.get(plate)
+
+
+    def lut_for(self, field):
+        """the lookup table of the plate a field belongs to"""
+        return self.get_for(field)
+
+
+    def read_field(self, field):
+        """
+        read and rescale a field, image_prep.Prepper.convert_to_rgb with its
+        plate's lookup table
+        """
+        return image_prep.Prepper.convert_to_rgb(field, lut=self.lut_for(field))
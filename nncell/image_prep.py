@@ -7,6 +7,7 @@ Also need to split into a test and a training directory
 import os
 import random
 import uuid
+from functools import partial
 import numpy as np
 import pandas as pd
 from parserix import parse
@@ -16,6 +17,16 @@ import multiprocessing
 from skimage import io
 from nncell import utils
 from nncell import chop
+from nncell import scheduler
+from nncell import profiling
+from nncell import records
+from nncell import tables
+from nncell import prefetch as prefetch_fields
+
+# metadata columns identifying a group, for ImageDict.train_test_split
+SPLIT_LEVELS = {"site": ["plate_name", "plate_num", "well", "site"],
+                "well": ["plate_name", "plate_num", "well"],
+                "plate": ["plate_name", "plate_num"]}
 
 
 
@@ -35,21 +46,183 @@ class Prepper(object):
         test:
             class1 : [image_list]
             class2 : [image_list]
+
+    illumination : illumination.IlluminationCorrection (default = None)
+        fitted flat-fields to correct each field with before chopping
+    bit_depth : 8 or 16 (default = 8)
+        bit depth of the output, see convert_to_rgb
+    rescale : illumination.PercentileRescale (default = None)
+        fitted lookup tables to convert each field to 8 bits with
     """
 
-    def __init__(self, img_dict):
+    def __init__(self, img_dict, illumination=None, bit_depth=8, rescale=None):
         if isinstance(img_dict, dict):
             self.img_dict = img_dict
         else:
             raise ValueError("input needs to be a dictionary")
+        if bit_depth not in (8, 16):
+            raise ValueError("bit_depth must be 8 or 16")
+        if rescale is not None and bit_depth != 8:
+            raise ValueError("rescale converts to 8 bits, bit_depth must be 8")
+        self.illumination = illumination
+        self.bit_depth = bit_depth
+        self.rescale = rescale
 
 
     @staticmethod
-    def convert_to_rgb(img_channels):
-        """read in three channels and merge to an 8-bit RGB array"""
+    def convert_to_rgb(img_channels, flatfields=None, bit_depth=8, lut=None):
+        """
+        read in three channels and merge to an 8-bit RGB array
+
+        flatfields : numpy.array (default = None)
+            (height, width, channels) flat-field to divide the channels by
+            before conversion, see illumination.IlluminationCorrection
+        bit_depth : 8 or 16 (default = 8)
+            16 keeps 16-bit images as uint16 rather than dropping the low
+            8 bits. Other images are scaled to the 16-bit range by their
+            dtype, see skimage.img_as_uint
+        lut : numpy.array (default = None)
+            (channels, 65536) uint8 lookup table to convert 8 or 16-bit
+            channels to 8 bits with, see illumination.PercentileRescale
+
+        With any of these options the channels are read and converted one
+        at a time into the output array, so no float copy of the whole
+        field is made. A flat-field correction uses a single float32
+        buffer the size of one channel.
+        """
+        if bit_depth not in (8, 16):
+            raise ValueError("bit_depth must be 8 or 16")
         image_collection = io.imread_collection(img_channels)
-        img_ubyte = skimage.img_as_ubyte(image_collection)
-        return np.dstack(img_ubyte)
+        if flatfields is None and lut is None and bit_depth == 8:
+            img_ubyte = skimage.img_as_ubyte(image_collection)
+            return np.dstack(img_ubyte)
+        out, buffer = None, None
+        for c in range(len(image_collection)):
+            channel = image_collection[c]
+            if flatfields is not None:
+                channel, buffer = _flatfield_channel(channel, flatfields[..., c],
+                                                     buffer)
+            if lut is not None:
+                channel = _lut_channel(channel, lut[c])
+            elif bit_depth == 16:
+                channel = skimage.img_as_uint(channel)
+            else:
+                channel = skimage.img_as_ubyte(channel)
+            if out is None:
+                out = np.empty(channel.shape + (len(image_collection), ),
+                               dtype=channel.dtype)
+            out[..., c] = channel
+        return out
+
+
+    def _read_field(self, img_channels):
+        """convert_to_rgb, with the corrections and bit depth of this Prepper"""
+        options = _field_options(img_channels, self.illumination,
+                                 self.bit_depth, self.rescale)
+        if not options:
+            return self.convert_to_rgb(img_channels)
+        return self.convert_to_rgb(img_channels, **options)
+
+
+    def _read_fields(self, base_dir, size=None, prefetch=0, prefetch_bytes=None):
+        """
+        create the crop directories of every group/class, and read their
+        fields in order, `prefetch` fields ahead
+
+        Yields:
+        -------
+        (group, key, dir_paths, i, img, rgb_img) for the i'th field, img, of
+        each class, see _crop_dirs for dir_paths
+        """
+        tasks = []
+        for group in self.img_dict.keys():
+            for key, img_list in self.img_dict[group].items():
+                # create directory item/key from key, one per crop size
+                dir_paths = _crop_dirs(base_dir, group, key, size)
+                for dir_path in dir_paths.values():
+                    utils.make_dir(dir_path)
+                tasks.extend((group, key, dir_paths, i, img)
+                             for i, img in enumerate(img_list, 1))
+        # read ahead across class boundaries, so they don't stall the reads
+        fields = prefetch_fields.FieldPrefetcher(
+            self._read_field, [task[-1] for task in tasks], depth=prefetch,
+            max_bytes=prefetch_bytes)
+        for task, rgb_img in zip(tasks, fields):
+            yield task + (rgb_img, )
+
+
+    @profiling.profiled("Prepper.export_records")
+    def export_records(self, base_dir, shard_bytes=2 ** 30, resize_to=None,
+                       quality_filter=None, seed=None, **kwargs):
+        """
+        chop each image into an image per cell, and write the crops to
+        sequential record files rather than a file per crop, see
+        records.RecordWriter. Each group gets its own set of shards in
+        base_dir/group, and each record holds the class as its label with
+        the field, nucleus and first image path as metadata.
+
+        Fields are written in a random order across classes, so a reader
+        with a bounded shuffle buffer sees a mix of classes.
+
+        Parameters:
+        -----------
+        base_dir : string
+            directory to write the shards to
+        shard_bytes : integer
+            size at which to start a new shard file
+        resize_to : integer or tuple
+            resize the crops to this size before saving, see chop.resize_crops.
+            Can't be combined with a list of sizes.
+        quality_filter : chop.QualityFilter
+            drop unusable crops before saving, counted per group/class
+        seed : integer
+            random seed for the order fields are written in
+        **kwargs: additional arguments to chop functions. A list of sizes
+            writes each size to base_dir/size_<size>/group
+
+        Returns:
+        --------
+        dictionary {group: [shard paths]}, or {group: {size: [shard paths]}}
+        for a list of sizes
+        """
+        _check_resize_to(kwargs.get("size"), resize_to)
+        random_state = random.Random(seed)
+        shards = dict()
+        for group in self.img_dict.keys():
+            tasks = [(key, i, img)
+                     for key, img_list in sorted(self.img_dict[group].items())
+                     for i, img in enumerate(img_list, 1)]
+            random_state.shuffle(tasks)
+            writers = dict()
+            for key, i, img in tasks:
+                rgb_img = self._read_field(img)
+                try:
+                    crops = _by_size(chop.chop_nuclei(rgb_img, **kwargs))
+                except ValueError:
+                    continue
+                crops = _filter_crops(crops, quality_filter,
+                                      "{}/{}".format(group, key))
+                for crop_size, sub_img_array in crops.items():
+                    if crop_size not in writers:
+                        dir_path = os.path.join(base_dir, group)
+                        if crop_size is not None:
+                            dir_path = os.path.join(
+                                base_dir, "size_{}".format(crop_size), group)
+                        writers[crop_size] = records.RecordWriter(
+                            dir_path, shard_bytes=shard_bytes)
+                    if resize_to is not None:
+                        sub_img_array = chop.resize_crops(sub_img_array,
+                                                          resize_to)
+                    for j, sub_img in enumerate(sub_img_array, 1):
+                        metadata = {"field": i, "nucleus": j, "path": str(img[0])}
+                        writers[crop_size].write(sub_img, key, metadata)
+            for writer in writers.values():
+                writer.close()
+            if isinstance(kwargs.get("size"), (list, tuple)):
+                shards[group] = {s: w.paths for s, w in writers.items()}
+            else:
+                shards[group] = writers[None].paths if writers else []
+        return shards
 
 
     def _check_dict(self):
@@ -91,10 +264,18 @@ class ImagePrep(Prepper):
         test:
             class1 : [image_list]
             class2 : [image_list]
+
+    illumination : illumination.IlluminationCorrection (default = None)
+        fitted flat-fields to correct each field with before chopping
+    bit_depth : 8 or 16 (default = 8)
+        bit depth of the output, see Prepper.convert_to_rgb.
+        16-bit images are saved as .tif files
+    rescale : illumination.PercentileRescale (default = None)
+        fitted lookup tables to convert each field to 8 bits with
     """
 
-    def __init__(self, img_dict):
-        super().__init__(img_dict)
+    def __init__(self, img_dict, illumination=None, bit_depth=8, rescale=None):
+        super().__init__(img_dict, illumination, bit_depth, rescale)
 
 
     @staticmethod
@@ -118,6 +299,7 @@ class ImagePrep(Prepper):
         io.imsave(fname=full_path, arr=img)
 
 
+    @profiling.profiled("ImagePrep.create_directories")
     def create_directories(self, base_dir):
         """
         create directory structure for prepared images
@@ -138,13 +320,18 @@ class ImagePrep(Prepper):
                 # create and save images in dir_path
                 for i, img in enumerate(img_list, 1):
                     # need to load images and merge
-                    rgb_img = self.convert_to_rgb(img)
+                    rgb_img = self._read_field(img)
                     self.write_img_to_disk(img=rgb_img, name="img_{}".format(i),
-                                           path=dir_path)
+                                           path=dir_path,
+                                           extension=_image_ext(self.bit_depth))
 
 
+    @profiling.profiled("ImagePrep.create_directories_chop")
     def create_directories_chop(self, base_dir, prefix="", as_array=False,
-                                **kwargs):
+                                compress=None, resize_to=None,
+                                quality_filter=None, prefetch=0,
+                                prefetch_bytes=None, memory_budget=None,
+                                nucleus_table=None, **kwargs):
         """
         create directory structure for prepared images, and chop each image
         into an image per cell.
@@ -159,44 +346,93 @@ class ImagePrep(Prepper):
         as_array: Boolean
             if True will save as a numpy array. If False, then images are saved
             as RGB .png files.
-        **kwargs: additional arguments to chop functions
+        compress: None, True, "zlib" or "lzma"
+            if saving as arrays, compress each one into a .npz file.
+            See utils.save_array
+        resize_to: integer or tuple
+            resize the crops to this size before saving, see chop.resize_crops.
+            Can't be combined with a list of sizes.
+        quality_filter: chop.QualityFilter
+            drop unusable crops before saving, counted per group/class in
+            quality_filter.kept and quality_filter.dropped
+        prefetch: integer (default = 0)
+            number of fields to read ahead in background threads, so
+            chopping doesn't wait on slow (e.g. network) storage. See
+            prefetch.FieldPrefetcher
+        prefetch_bytes: integer (default = None)
+            limit on the memory used by fields read ahead
+        memory_budget: integer (default = None)
+            bytes of memory for chopping a field. A field with too many
+            nuclei to crop at once within the budget is cropped in chunks,
+            see scheduler.nuclei_per_chunk
+        nucleus_table: string (default = None)
+            directory to write a table of every written nucleus to, with
+            its field, plate, well, site, class, crop name and position,
+            see tables.NucleusTableWriter. Merged into nuclei.parquet,
+            or nuclei.npz without pyarrow, at the end.
+        **kwargs: additional arguments to chop functions. A list of sizes,
+            e.g. size=[64, 128, 256], detects the nuclei once and writes each
+            size to its own base_dir/size_<size> directory tree, with the same
+            file name for a nucleus at every size
         """
+        _check_resize_to(kwargs.get("size"), resize_to)
         utils.make_dir(base_dir)
-        for group in self.img_dict.keys():
-            for key, img_list in self.img_dict[group].items():
-                # create directory item/key from key
-                dir_path = os.path.join(os.path.abspath(base_dir), group, key)
-                utils.make_dir(dir_path)
-                # create and save images in dir_path
-                for i, img in enumerate(img_list, 1):
-                    rgb_img = self.convert_to_rgb(img)
-                    # convert_to_rgb is a bit of a misnomer, actually just stacks
-                    # an image collection to a numpy array, can work with more
-                    # than three channels
-                    #
-                    # chop image into sub-img per cell
-                    # sometimes there is an error where we don't have all the
-                    # channel to stack into an array, not sure what is causing
-                    # this though we can skip any errors and carry on processing
-                    # the images rather than crash the entire session
-                    #
-                    # probably a much better way to handle this, but screw it
-                    try:
-                        sub_img_array = chop.chop_nuclei(rgb_img, **kwargs)
-                        for j, sub_img in enumerate(sub_img_array, 1):
-                            if as_array: # save as numpy array
-                                img_name = "{}_img_{}_{}.npy".format(prefix, i, j)
-                                full_path = os.path.join(os.path.abspath(dir_path), img_name)
-                                np.save(file=full_path, arr=sub_img,
-                                        allow_pickle=False)
-                            else: # save as .png (has to be RGB)
-                                img_name = "{}_img_{}_{}.png".format(prefix, i, j)
-                                full_path = os.path.join(os.path.abspath(dir_path), img_name)
-                                io.imsave(fname=full_path, arr=sub_img)
-                    except ValueError:
-                        pass
-
-    def create_directories_chop_par(self, base_dir, n_jobs=-1, size=200):
+        table = None
+        if nucleus_table is not None:
+            table = tables.NucleusTableWriter(nucleus_table)
+        fields = self._read_fields(base_dir, kwargs.get("size"), prefetch,
+                                   prefetch_bytes)
+        for group, key, dir_paths, i, img, rgb_img in fields:
+            # convert_to_rgb is a bit of a misnomer, actually just stacks
+            # an image collection to a numpy array, can work with more
+            # than three channels
+            #
+            # chop image into sub-img per cell
+            # sometimes there is an error where we don't have all the
+            # channel to stack into an array, not sure what is causing
+            # this though we can skip any errors and carry on processing
+            # the images rather than crash the entire session
+            #
+            # probably a much better way to handle this, but screw it
+            try:
+                chunks = _crop_chunks(rgb_img, memory_budget, resize_to,
+                                      **kwargs)
+            except ValueError:
+                continue
+            label = "{}/{}".format(group, key)
+            n_written = 0
+            for chunk in chunks:
+                crops, blobs = _filter_chunk(chunk, quality_filter, label)
+                for crop_size, sub_img_array in crops.items():
+                    dir_path = dir_paths[crop_size]
+                    if resize_to is not None:
+                        sub_img_array = chop.resize_crops(sub_img_array,
+                                                          resize_to)
+                    for j, sub_img in enumerate(sub_img_array, n_written + 1):
+                        if as_array: # save as numpy array
+                            img_name = "{}_img_{}_{}".format(prefix, i, j)
+                            full_path = os.path.join(os.path.abspath(dir_path), img_name)
+                            utils.save_array(full_path, sub_img, compress)
+                        else: # save as .png (has to be RGB)
+                            img_name = "{}_img_{}_{}{}".format(
+                                prefix, i, j, _image_ext(self.bit_depth))
+                            full_path = os.path.join(os.path.abspath(dir_path), img_name)
+                            io.imsave(fname=full_path, arr=sub_img)
+                nuclei = np.arange(n_written + 1, n_written + len(blobs) + 1)
+                if table is not None:
+                    table.add(_field_info(img, label), nuclei,
+                              ["{}_img_{}_{}".format(prefix, i, j) for j in nuclei],
+                              blobs)
+                n_written += len(blobs)
+        if table is not None:
+            table.close()
+            tables.merge_parts(nucleus_table)
+
+    @profiling.profiled("ImagePrep.create_directories_chop_par")
+    def create_directories_chop_par(self, base_dir, n_jobs=-1, size=200,
+                                    resize_to=None, schedule=None,
+                                    quality_filter=None, memory_budget=None,
+                                    nucleus_table=None, **kwargs):
         """
         create directory structure for prepared images, and chop each image
         into an image per cell.
@@ -206,19 +442,150 @@ class ImagePrep(Prepper):
         base_dir : string
             Path to directory in which to hold training and test datasets.
             A directory will be created if it does not already exist
-        **kwargs: additional arguments to chop functions
-        """
+        n_jobs : integer
+            number of worker processes, -1 for one per CPU
+        size : integer or list of integers
+            size of the crops, see chop.chop_nuclei. A list of sizes writes
+            each size to its own base_dir/size_<size> directory tree
+        resize_to : integer or tuple
+            resize the crops to this size before saving, see chop.resize_crops.
+            Can't be combined with a list of sizes.
+        schedule : None or "plate"
+            None processes one class at a time, spreading its images across
+            the workers. "plate" orders the images of every class by plate,
+            well and site, and workers pull chunks of a single plate, so each
+            worker reads from as few plate directories as possible.
+            See scheduler.plan_chunks
+        quality_filter : chop.QualityFilter
+            drop unusable crops before saving, counted per group/class in
+            quality_filter.kept and quality_filter.dropped
+        memory_budget : integer (default = None)
+            bytes of memory for all the workers together. The memory of a
+            task is estimated from a sample of the fields, see
+            scheduler.estimate_task_bytes, and n_jobs is reduced so the
+            workers fit. A field with too many nuclei for its worker's share
+            is cropped in chunks.
+        nucleus_table : string (default = None)
+            directory to write a table of every written nucleus to, see
+            create_directories_chop. Each batch of fields a worker runs
+            writes its own parts, merged at the end.
+        **kwargs : additional arguments to chop functions, e.g. edge or
+            threshold
 
+        Returns:
+        --------
+        with schedule="plate", the per-worker load from
+        scheduler.run_chunks, otherwise None
+        """
+        if schedule not in (None, "plate"):
+            raise ValueError("schedule must be None or 'plate'")
+        _check_resize_to(size, resize_to)
         if n_jobs < 1:
             n_jobs = multiprocessing.cpu_count()
+        if memory_budget is not None:
+            n_jobs = self._workers_for_budget(memory_budget, n_jobs, size,
+                                              resize_to, **kwargs)
+            # each worker's share
+            memory_budget = memory_budget // n_jobs
 
         utils.make_dir(base_dir)
+        tasks = []
         for group in self.img_dict.keys():
             for key, img_list in self.img_dict[group].items():
-                # create directory item/key from key
-                dir_path = os.path.join(os.path.abspath(base_dir), group, key)
-                utils.make_dir(dir_path)
-                Parallel(n_jobs=n_jobs)(delayed(chopper)(img, dir_path, size) for img in img_list)
+                # create directory item/key from key, one per crop size
+                dir_paths = _crop_dirs(base_dir, group, key, size)
+                for dir_path in dir_paths.values():
+                    utils.make_dir(dir_path)
+                if not isinstance(size, (list, tuple)):
+                    dir_paths = dir_paths[None]
+                label = "{}/{}".format(group, key)
+                if schedule == "plate":
+                    tasks.extend((img, dir_paths, label) for img in img_list)
+                elif nucleus_table is None:
+                    counts = Parallel(n_jobs=n_jobs)(
+                        delayed(chopper)(img, dir_paths, size, resize_to,
+                                         quality_filter, self.illumination,
+                                         self.bit_depth, self.rescale,
+                                         memory_budget, **kwargs)
+                        for img in img_list)
+                    if quality_filter is not None and counts:
+                        quality_filter.record(label, *np.sum(counts, axis=0))
+                else:
+                    # batches of fields, so each table part holds many fields
+                    batches = np.array_split(np.arange(len(img_list)),
+                                             max(1, min(len(img_list),
+                                                        4 * n_jobs)))
+                    results = Parallel(n_jobs=n_jobs)(
+                        delayed(_chop_chunk)(
+                            [(img_list[i], dir_paths, label) for i in batch],
+                            size, resize_to, quality_filter, self.illumination,
+                            self.bit_depth, self.rescale, memory_budget,
+                            nucleus_table, **kwargs)
+                        for batch in batches if len(batch))
+                    counts = [c[1:] for result in results for c in result]
+                    if quality_filter is not None and counts:
+                        quality_filter.record(label, *np.sum(counts, axis=0))
+        if schedule == "plate" and tasks:
+            # the metadata of a field is that of its first channel
+            metadata = ImageDict.parse_metadata([task[0][0] for task in tasks])
+            chunks = [[tasks[i] for i in chunk]
+                      for chunk in scheduler.plan_chunks(metadata, n_jobs)]
+            report = scheduler.run_chunks(
+                partial(_chop_chunk, size=size, resize_to=resize_to,
+                        quality_filter=quality_filter,
+                        illumination=self.illumination,
+                        bit_depth=self.bit_depth, rescale=self.rescale,
+                        memory_budget=memory_budget,
+                        nucleus_table=nucleus_table, **kwargs),
+                chunks, n_jobs)
+            if quality_filter is not None:
+                for chunk_counts in report["results"]:
+                    for label, n_kept, n_dropped in chunk_counts:
+                        quality_filter.record(label, n_kept, n_dropped)
+        if nucleus_table is not None:
+            tables.merge_parts(nucleus_table)
+        if schedule == "plate" and tasks:
+            return report
+
+
+    def _workers_for_budget(self, memory_budget, n_jobs, size, resize_to=None,
+                            n_sample=4, **kwargs):
+        """
+        number of workers that fit in memory_budget, at most n_jobs.
+
+        This is an estimate from a sample of `n_sample` fields spread over
+        the image dictionary: the largest task of the sample, with its
+        nuclei detected using the chop arguments in kwargs.
+        """
+        fields = [img for group in self.img_dict.values()
+                  for img_list in group.values() for img in img_list]
+        if not fields:
+            return n_jobs
+        sample = np.unique(np.linspace(0, len(fields) - 1, n_sample).astype(int))
+        detect_kwargs = {k: v for k, v in kwargs.items() if k != "edge"}
+        task_bytes, min_bytes = 0, 0
+        for i in sample:
+            try:
+                field = self._read_field(fields[i])
+            except ValueError:
+                # unreadable fields are skipped when chopping too
+                continue
+            try:
+                n_nuclei = len(chop.find_nuclei(field, **detect_kwargs))
+            except ValueError:
+                n_nuclei = 0
+            args = dict(itemsize=field.dtype.itemsize, resize_to=resize_to,
+                        **kwargs)
+            task_bytes = max(task_bytes, scheduler.estimate_task_bytes(
+                field.shape, size, n_nuclei, **args))
+            # fields that need more than the budget are cropped in chunks, so
+            # a worker needs room for the field and one nucleus at least
+            min_bytes = max(min_bytes, scheduler.estimate_task_bytes(
+                field.shape, size, 1, **args))
+        if min_bytes == 0:
+            return n_jobs
+        return scheduler.workers_for_budget(
+            memory_budget, max(min_bytes, min(task_bytes, memory_budget)), n_jobs)
 
 
 
@@ -241,10 +608,17 @@ class ArrayPrep(Prepper):
         test:
             class1 : [image_list]
             class2 : [image_list]
+
+    illumination : illumination.IlluminationCorrection (default = None)
+        fitted flat-fields to correct each field with before chopping
+    bit_depth : 8 or 16 (default = 8)
+        bit depth of the output, see Prepper.convert_to_rgb
+    rescale : illumination.PercentileRescale (default = None)
+        fitted lookup tables to convert each field to 8 bits with
     """
 
-    def __init__(self, img_dict):
-        super().__init__(img_dict)
+    def __init__(self, img_dict, illumination=None, bit_depth=8, rescale=None):
+        super().__init__(img_dict, illumination, bit_depth, rescale)
 
 
     @staticmethod
@@ -268,6 +642,7 @@ class ArrayPrep(Prepper):
         np.save(file=full_path, arr=img)
 
 
+    @profiling.profiled("ArrayPrep.create_directories")
     def create_directories(self, base_dir):
         """
         create directory structure for prepared images
@@ -288,12 +663,16 @@ class ArrayPrep(Prepper):
                 # create and save images in dir_path
                 for i, img in enumerate(img_list, 1):
                     # need to load images and merge
-                    rgb_img = self.convert_to_rgb(img)
+                    rgb_img = self._read_field(img)
                     self.write_array_to_disk(img=rgb_img, name="img_{}".format(i),
                                              path=dir_path)
 
 
-    def create_directories_chop(self, base_dir, **kwargs):
+    @profiling.profiled("ArrayPrep.create_directories_chop")
+    def create_directories_chop(self, base_dir, compress=None, resize_to=None,
+                                quality_filter=None, prefetch=0,
+                                prefetch_bytes=None, memory_budget=None,
+                                nucleus_table=None, **kwargs):
         """
         create directory structure for prepared images, and chop each image
         into an image per cell.
@@ -303,32 +682,78 @@ class ArrayPrep(Prepper):
         base_dir : string
             Path to directory in which to hold training and test datasets.
             A directory will be created if it does not already exist
-        **kwargs: additional arguments to chop functions
+        compress : None, True, "zlib" or "lzma"
+            compress each array into a .npz file rather than a .npy file.
+            Background dominated crops compress several fold, which helps
+            when reading is limited by disk or network bandwidth.
+            See utils.save_array
+        resize_to : integer or tuple
+            resize the crops to this size before saving, see chop.resize_crops.
+            Can't be combined with a list of sizes.
+        quality_filter : chop.QualityFilter
+            drop unusable crops before saving, counted per group/class in
+            quality_filter.kept and quality_filter.dropped
+        prefetch : integer (default = 0)
+            number of fields to read ahead in background threads, so
+            chopping doesn't wait on slow (e.g. network) storage. See
+            prefetch.FieldPrefetcher
+        prefetch_bytes : integer (default = None)
+            limit on the memory used by fields read ahead
+        memory_budget : integer (default = None)
+            bytes of memory for chopping a field. A field with too many
+            nuclei to crop at once within the budget is cropped in chunks,
+            see scheduler.nuclei_per_chunk
+        nucleus_table : string (default = None)
+            directory to write a table of every written nucleus to, with
+            its field, plate, well, site, class, crop name and position,
+            see tables.NucleusTableWriter. Merged into nuclei.parquet,
+            or nuclei.npz without pyarrow, at the end.
+        **kwargs: additional arguments to chop functions. A list of sizes,
+            e.g. size=[64, 128, 256], detects the nuclei once and writes each
+            size to its own base_dir/size_<size> directory tree, with the same
+            file name for a nucleus at every size
         """
+        _check_resize_to(kwargs.get("size"), resize_to)
         utils.make_dir(base_dir)
-        for group in self.img_dict.keys():
-            for key, img_list in self.img_dict[group].items():
-                # create directory item/key from key
-                dir_path = os.path.join(os.path.abspath(base_dir), group, key)
-                utils.make_dir(dir_path)
-                # create and save images in dir_path
-                for i, img in enumerate(img_list, 1):
-                    rgb_img = self.convert_to_rgb(img)
-                    # chop image into sub-img per cell
-                    # sometimes there is an error where we don't have all the
-                    # channel to stack into an array, not sure what is causing
-                    # this though we can skip any errors and carry on processing
-                    # the images rather than crash the entire session
-                    #
-                    # probably a much better way to handle this, but screw it
-                    try:
-                        sub_img_array = chop.chop_nuclei(rgb_img, **kwargs)
-                        for j, sub_img in enumerate(sub_img_array, 1):
-                            img_name = "img_{}_{}.npy".format(i, j)
-                            full_path = os.path.join(os.path.abspath(dir_path), img_name)
-                            np.save(file=full_path, arr=sub_img)
-                    except ValueError:
-                        pass
+        table = None
+        if nucleus_table is not None:
+            table = tables.NucleusTableWriter(nucleus_table)
+        fields = self._read_fields(base_dir, kwargs.get("size"), prefetch,
+                                   prefetch_bytes)
+        for group, key, dir_paths, i, img, rgb_img in fields:
+            # chop image into sub-img per cell
+            # sometimes there is an error where we don't have all the
+            # channel to stack into an array, not sure what is causing
+            # this though we can skip any errors and carry on processing
+            # the images rather than crash the entire session
+            #
+            # probably a much better way to handle this, but screw it
+            try:
+                chunks = _crop_chunks(rgb_img, memory_budget, resize_to,
+                                      **kwargs)
+            except ValueError:
+                continue
+            label = "{}/{}".format(group, key)
+            n_written = 0
+            for chunk in chunks:
+                crops, blobs = _filter_chunk(chunk, quality_filter, label)
+                for crop_size, sub_img_array in crops.items():
+                    dir_path = dir_paths[crop_size]
+                    if resize_to is not None:
+                        sub_img_array = chop.resize_crops(sub_img_array,
+                                                          resize_to)
+                    for j, sub_img in enumerate(sub_img_array, n_written + 1):
+                        img_name = "img_{}_{}".format(i, j)
+                        full_path = os.path.join(os.path.abspath(dir_path), img_name)
+                        utils.save_array(full_path, sub_img, compress)
+                nuclei = np.arange(n_written + 1, n_written + len(blobs) + 1)
+                if table is not None:
+                    table.add(_field_info(img, label), nuclei,
+                              ["img_{}_{}".format(i, j) for j in nuclei], blobs)
+                n_written += len(blobs)
+        if table is not None:
+            table.close()
+            tables.merge_parts(nucleus_table)
 
 
 
@@ -355,6 +780,26 @@ class ImageDict(object):
         self.train_test_dict = dict()
 
 
+    @staticmethod
+    def parse_metadata(url_list):
+        """
+        parse plate, well and site metadata from a list of image paths
+
+        Returns:
+        --------
+        pandas.DataFrame with columns img_url, plate_name, plate_num, well and
+        site, one row per path
+        """
+        urls = [parse.img_filename(i) for i in url_list]
+        tmp_df = pd.DataFrame(list(url_list), columns=["img_url"])
+        tmp_df["plate_name"] = [parse.plate_name(i) for i in url_list]
+        tmp_df["plate_num"] = [parse.plate_num(i) for i in url_list]
+        # get_well and get_site use the image URL rather than the full path
+        tmp_df["well"] = [parse.img_well(i) for i in urls]
+        tmp_df["site"] = [parse.img_site(i) for i in urls]
+        return tmp_df
+
+
     @staticmethod
     def _group_channels(url_list, order):
         """
@@ -366,13 +811,7 @@ class ImageDict(object):
             sort channel numbers into numerical order
         """
         grouped_list = []
-        urls = [parse.img_filename(i) for i in url_list]
-        tmp_df = pd.DataFrame(list(url_list), columns=["img_url"])
-        tmp_df["plate_name"] = [parse.plate_name(i) for i in url_list]
-        tmp_df["plate_num"] = [parse.plate_num(i) for i in url_list]
-        # get_well and get_site use the image URL rather than the full path
-        tmp_df["well"] = [parse.img_well(i) for i in urls]
-        tmp_df["site"] = [parse.img_site(i) for i in urls]
+        tmp_df = ImageDict.parse_metadata(url_list)
         grouped_df = tmp_df.groupby(["plate_name", "plate_num", "well", "site"])
         if order is True:
             # order by channel
@@ -537,22 +976,51 @@ class ImageDict(object):
         self.grouped = True
 
 
-    def train_test_split(self, test_size=0.3):
+    def train_test_split(self, test_size=0.3, group_by=None, seed=None):
         """
         split into train and test sets
         these are stored in separate dictionary keys
+
+        Parameters:
+        -----------
+        test_size : float (default = 0.3)
+            proportion of the fields of each class to become the test set
+        group_by : string (default = None)
+            "site", "well" or "plate", keep every field of a group on the
+            same side of the split, so e.g. sites of one well can't end up
+            in both the training and test set. None splits single fields.
+        seed : integer (default = None)
+            seed for the split, the same seed gives the same split on any
+            machine. None draws a seed from the random module.
+
+        See split_indices
         """
         if self.grouped is False:
             raise AttributeError("image channels not grouped")
+        if group_by is not None and group_by not in SPLIT_LEVELS:
+            raise ValueError("unknown group_by. options: {}".format(
+                sorted(SPLIT_LEVELS)))
+        if seed is None:
+            seed = random.getrandbits(32)
+        keys = list(self.parent_dict.keys())
+        fields = [field for key in keys for field in self.parent_dict[key]]
+        labels = np.repeat(np.arange(len(keys)),
+                           [len(self.parent_dict[key]) for key in keys])
+        if group_by is None:
+            groups = [field[0] for field in fields]
+        else:
+            metadata = self.parse_metadata([field[0] for field in fields])
+            columns = SPLIT_LEVELS[group_by]
+            groups = metadata[columns].astype(str).agg("/".join, axis=1).values
+        train_idx, test_idx = split_indices(labels, groups, test_size, seed)
         # create train and test sub-dictionaries
         self.train_test_dict["test"] = dict()
         self.train_test_dict["train"] = dict()
-        # loop through class lists
-        # split into training and test, place in approp dicts under the same key
-        for key, img_list in self.parent_dict.items():
-            train, test = self._split_train_test(img_list, test_size)
-            self.train_test_dict["train"][key] = train
-            self.train_test_dict["test"][key] = test
+        # place fields in approp dicts under the class key, in input order
+        for side, index in [("train", train_idx), ("test", test_idx)]:
+            for i, key in enumerate(keys):
+                self.train_test_dict[side][key] = [
+                    fields[j] for j in index[labels[index] == i]]
         # once finished, indicate we have created training and test sets
         self.train_test_sets = True
 
@@ -599,22 +1067,305 @@ class ImageDict(object):
 
 
 
-def _convert_to_rgb(img_channels):
+def _convert_to_rgb(img_channels, **kwargs):
     """read in three channels and merge to an 8-bit RGB array"""
-    image_collection = io.imread_collection(img_channels)
-    img_ubyte = skimage.img_as_ubyte(image_collection)
-    return np.dstack(img_ubyte)
+    return Prepper.convert_to_rgb(img_channels, **kwargs)
 
 
-def chopper(img, dir_path, size):
-    """wrapper round chop.chop_nuclei for joblib parallelism"""
+def _flatfield_channel(channel, flatfield, buffer=None):
+    """
+    a channel divided by its flat-field, computed in a float32 buffer which
+    is returned for reuse with the next channel. Integer channels are
+    converted back to their dtype, so the conversion that follows matches
+    the uncorrected path.
+    """
+    if buffer is None or buffer.shape != channel.shape:
+        buffer = np.empty(channel.shape, dtype="float32")
+    np.divide(channel, flatfield, out=buffer)
+    if channel.dtype.kind in "ui":
+        np.clip(buffer, 0, np.iinfo(channel.dtype).max, out=buffer)
+        if not channel.flags.writeable:
+            channel = channel.copy()
+        np.copyto(channel, buffer, casting="unsafe")
+        return channel, buffer
+    return np.clip(buffer, 0, 1, out=buffer), buffer
+
+
+def _lut_channel(channel, lut):
+    """an 8 or 16-bit unsigned channel converted to uint8 through its lut"""
+    if channel.dtype.kind != "u" or channel.dtype.itemsize > 2:
+        raise ValueError("lut needs 8 or 16-bit unsigned images")
+    return lut[channel]
+
+
+def _image_ext(bit_depth):
+    """file extension for crops, .png cannot hold 16-bit RGB images"""
+    return ".png" if bit_depth == 8 else ".tif"
+
+
+def _field_options(img_channels, illumination=None, bit_depth=8, rescale=None):
+    """convert_to_rgb keyword arguments for a field, given the corrections"""
+    options = dict()
+    if illumination is not None:
+        options["flatfields"] = illumination.flatfield_for(img_channels)
+    if bit_depth != 8:
+        options["bit_depth"] = bit_depth
+    if rescale is not None:
+        options["lut"] = rescale.lut_for(img_channels)
+    return options
+
+
+def list_fields(img_dict):
+    """
+    fields and their class labels from an ImageDict, or a dictionary of
+    {class: [field]} or {group: {class: [field]}}
+
+    Returns:
+    --------
+    (fields, labels) : lists of the same length
+    """
+    if isinstance(img_dict, ImageDict):
+        if img_dict.train_test_sets:
+            img_dict = img_dict.make_dict()
+        else:
+            img_dict = img_dict.parent_dict
+    fields, labels = [], []
+    for name in sorted(img_dict):
+        value = img_dict[name]
+        if isinstance(value, dict):
+            sub_fields, sub_labels = list_fields(value)
+            fields.extend(sub_fields)
+            labels.extend(sub_labels)
+        else:
+            fields.extend(value)
+            labels.extend([name] * len(value))
+    return fields, labels
+
+
+def split_indices(labels, groups=None, test_size=0.3, seed=0):
+    """
+    Split items into training and test sets, keeping every item of a group
+    on the same side, and the test fraction of every class near test_size.
+
+    Each group is ranked by a hash of the seed and its key, and within each
+    class, groups are taken in rank order until the class has test_size of
+    its items in the test set. As the rank of a group only depends on its
+    key, the split does not depend on the order of the items, and adding
+    or removing groups doesn't move the other groups between sets.
+
+    Parameters:
+    -----------
+    labels : array-like
+        class of each item
+    groups : array-like (default = None)
+        group key of each item, e.g. its plate and well. Keys are compared
+        as strings. None puts each item in its own group, keyed by position.
+    test_size : float (default = 0.3)
+        proportion of each class to become the test set
+    seed : integer (default = 0)
+
+    Returns:
+    --------
+    (train_index, test_index) : sorted int64 index arrays into labels.
+    A group with items in several classes is split by class.
+    """
+    if not 0 <= test_size <= 1:
+        raise ValueError("test_size must be between 0 and 1")
+    labels = np.asarray(labels)
+    if groups is None:
+        groups = np.arange(len(labels))
+    else:
+        groups = np.asarray(groups).astype(str)
+    if len(groups) != len(labels):
+        raise ValueError("need one group per label")
+    if len(labels) == 0:
+        empty = np.empty(0, dtype="int64")
+        return empty, empty
+    # hash based factorize, sorting millions of strings is slow
+    label_codes, _ = pd.factorize(labels, sort=True)
+    group_codes, group_keys = pd.factorize(groups)
+    group_keys = np.asarray(group_keys)
+    if group_keys.dtype.kind == "U":
+        group_keys = group_keys.astype(object)
+    # hash the keys, mix in the seed and hash again, the same on every
+    # machine and run
+    salt = pd.util.hash_array(np.array([seed], dtype="int64"))
+    rank = pd.util.hash_array(
+        pd.util.hash_array(group_keys, categorize=False) ^ salt)
+    # one unit per (class, group), ordered by class then rank
+    units, unit_codes, unit_sizes = np.unique(
+        label_codes.astype("int64") * len(group_keys) + group_codes,
+        return_inverse=True, return_counts=True)
+    unit_labels, unit_groups = np.divmod(units, len(group_keys))
+    # ties in rank are broken by key, not by order of appearance
+    key_order = np.argsort(np.argsort(group_keys, kind="stable"))
+    order = np.lexsort((key_order[unit_groups], rank[unit_groups], unit_labels))
+    unit_labels = unit_labels[order]
+    sizes = unit_sizes[order]
+    class_sizes = np.bincount(unit_labels, weights=sizes)
+    class_start = np.r_[0, np.cumsum(class_sizes)[:-1]]
+    # items of the class in the units before each unit
+    cum_before = np.cumsum(sizes) - sizes - class_start[unit_labels]
+    target = test_size * class_sizes[unit_labels]
+    # a unit is test if its midpoint falls within the test fraction
+    is_test = np.empty(len(units), dtype=bool)
+    is_test[order] = cum_before + sizes / 2.0 < target
+    test_mask = is_test[unit_codes]
+    return np.flatnonzero(~test_mask), np.flatnonzero(test_mask)
+
+
+def chopper(img, dir_path, size, resize_to=None, quality_filter=None,
+            illumination=None, bit_depth=8, rescale=None, memory_budget=None,
+            nucleus_table=None, label=None, **kwargs):
+    """
+    wrapper round chop.chop_nuclei for joblib parallelism, kwargs are
+    passed to it
+
+    with a list of sizes, dir_path is a dictionary {size: directory}.
+    nucleus_table is a tables.NucleusTableWriter to record the written
+    nuclei in, as class `label` ("group/class").
+    Returns the number of nuclei kept and dropped by quality_filter.
+    """
+    _check_resize_to(size, resize_to)
+    options = _field_options(img, illumination, bit_depth, rescale)
+    field = img
     try:
-        img = _convert_to_rgb(img)
-        sub_img_array = chop.chop_nuclei(img, size)
-        for sub_img in sub_img_array:
-            img_name = "img_{}.png".format(uuid.uuid4().hex)
-            full_path = os.path.join(os.path.abspath(dir_path), img_name)
-            io.imsave(fname=full_path, arr=sub_img)
+        img = _convert_to_rgb(img, **options)
+        chunks = _crop_chunks(img, memory_budget, resize_to, size=size,
+                              **kwargs)
     except ValueError:
         # numpy stack error for empty channels, skip image
-        pass
+        return 0, 0
+    if not isinstance(size, (list, tuple)):
+        dir_path = {None: dir_path}
+    # one id per field, so a nucleus has the same name at every size
+    field_id = uuid.uuid4().hex
+    n_found, n_kept = 0, 0
+    for chunk in chunks:
+        n_found += len(chunk[1])
+        crops, blobs = _filter_chunk(chunk, quality_filter)
+        for crop_size, sub_img_array in crops.items():
+            if resize_to is not None:
+                sub_img_array = chop.resize_crops(sub_img_array, resize_to)
+            for j, sub_img in enumerate(sub_img_array, n_kept + 1):
+                img_name = "img_{}_{}{}".format(field_id, j, _image_ext(bit_depth))
+                full_path = os.path.join(os.path.abspath(dir_path[crop_size]), img_name)
+                io.imsave(fname=full_path, arr=sub_img)
+        nuclei = np.arange(n_kept + 1, n_kept + len(blobs) + 1)
+        if nucleus_table is not None:
+            nucleus_table.add(_field_info(field, label), nuclei,
+                              ["img_{}_{}".format(field_id, j) for j in nuclei],
+                              blobs)
+        n_kept += len(blobs)
+    return n_kept, n_found - n_kept
+
+
+def _chop_chunk(chunk, size, resize_to=None, quality_filter=None,
+                illumination=None, bit_depth=8, rescale=None,
+                memory_budget=None, nucleus_table=None, **kwargs):
+    """
+    chopper() for each (img, dir_path, label) task of a scheduler chunk,
+    returns the (label, kept, dropped) counts of each task. The nuclei are
+    recorded by one tables.NucleusTableWriter per chunk in the directory
+    nucleus_table, if given.
+    """
+    writer = None
+    if nucleus_table is not None:
+        writer = tables.NucleusTableWriter(nucleus_table)
+    counts = [(label, ) + chopper(img, dir_path, size, resize_to,
+                                  quality_filter, illumination, bit_depth,
+                                  rescale, memory_budget, writer, label,
+                                  **kwargs)
+              for img, dir_path, label in chunk]
+    if writer is not None:
+        writer.close()
+    return counts
+
+
+def _crop_dirs(base_dir, group, key, size=None):
+    """
+    output directories for the crops of group/key, {None: directory} for a
+    single crop size, or {size: directory} with a base_dir/size_<size> tree
+    per size when `size` is a list
+    """
+    base_dir = os.path.abspath(base_dir)
+    if isinstance(size, (list, tuple)):
+        return {s: os.path.join(base_dir, "size_{}".format(s), group, key)
+                for s in size}
+    return {None: os.path.join(base_dir, group, key)}
+
+
+def _check_resize_to(size, resize_to):
+    """
+    raise ValueError for resize_to with a list of sizes, which would resize
+    every size to the same resolution
+    """
+    if resize_to is not None and isinstance(size, (list, tuple)):
+        raise ValueError("resize_to can't be used with a list of sizes")
+
+
+def _filter_crops(crops, quality_filter, label=None):
+    """
+    apply a chop.QualityFilter to {size: crops}, measured on the smallest
+    size so the same nuclei are dropped at every size
+    """
+    if quality_filter is None:
+        return crops
+    keep = _quality_mask(crops, quality_filter, label)
+    return {crop_size: arr[keep] for crop_size, arr in crops.items()}
+
+
+def _filter_chunk(chunk, quality_filter, label=None):
+    """_filter_crops on a (crops, blobs) chunk from _crop_chunks"""
+    crops, blobs = chunk
+    if quality_filter is None:
+        return crops, blobs
+    keep = _quality_mask(crops, quality_filter, label)
+    return {crop_size: arr[keep] for crop_size, arr in crops.items()}, blobs[keep]
+
+
+def _quality_mask(crops, quality_filter, label=None):
+    keep = quality_filter.mask(crops[min(crops, key=lambda s: s or 0)])
+    if label is not None:
+        quality_filter.record(label, keep.sum(), len(keep) - keep.sum())
+    return keep
+
+
+def _crop_chunks(rgb_img, memory_budget=None, resize_to=None, size=100,
+                 **kwargs):
+    """
+    crops of a field as ({size: crops}, blobs) chunks, see _by_size and
+    chop.chop_nuclei. In one chunk, or in chunks that fit in memory_budget
+    bytes if given.
+
+    Raises:
+    -------
+    ValueError if no nuclei are found
+    """
+    if memory_budget is None:
+        crops, blobs = chop.chop_nuclei(rgb_img, size=size, return_blobs=True,
+                                        **kwargs)
+        return [(_by_size(crops), blobs)]
+    chunk_size = scheduler.nuclei_per_chunk(
+        memory_budget, rgb_img.shape, size, itemsize=rgb_img.dtype.itemsize,
+        resize_to=resize_to, **kwargs)
+    chunks = chop.iter_crops(rgb_img, size=size, chunk_size=chunk_size,
+                             return_blobs=True, **kwargs)
+    return ((_by_size(crops), blobs) for crops, blobs in chunks)
+
+
+def _field_info(img, label):
+    """per-field columns of a nucleus table, see tables.FIELD_COLUMNS"""
+    url = img[0]
+    name = parse.img_filename(url)
+    group, key = label.split("/", 1)
+    return {"img_url": url, "plate_name": parse.plate_name(url),
+            "plate_num": parse.plate_num(url), "well": parse.img_well(name),
+            "site": parse.img_site(name), "group": group, "class": key}
+
+
+def _by_size(crops):
+    """chop.chop_nuclei output as a dictionary {size: crops}, see _crop_dirs"""
+    if isinstance(crops, dict):
+        return crops
+    return {None: crops}
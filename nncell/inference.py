@@ -0,0 +1,214 @@
+"""
+Batched inference over whole fields, aggregated per field, site, well and
+plate.
+
+Fields are read and chopped one at a time, and their crops are packed
+into batches of a fixed size that span fields, so the model always sees
+full batches whatever the number of nuclei per field. The prediction of
+every crop is kept with the index of its field, and aggregated to each
+level with segment reductions over the crops sorted by group.
+"""
+
+import numpy as np
+import pandas as pd
+from nncell import chop
+from nncell import image_prep
+
+# metadata columns that identify a group at each level
+LEVELS = {"field": ["field"],
+          "site": ["plate_name", "plate_num", "well", "site"],
+          "well": ["plate_name", "plate_num", "well"],
+          "plate": ["plate_name", "plate_num"]}
+
+
+def iter_batches(fields, batch_size, read_field=None, **kwargs):
+    """
+    Chop each field and pack the crops into batches of `batch_size` crops,
+    which span fields. The last batch may be smaller.
+
+    The batch is a view into a buffer which is overwritten by the next
+    batch, copy it to keep it.
+
+    Parameters:
+    -----------
+    fields : list
+        fields to read with read_field
+    batch_size : integer
+        number of crops per batch
+    read_field : callable (default = image_prep.Prepper.convert_to_rgb)
+        reads a field into an array
+    **kwargs : arguments to chop.chop_nuclei, e.g. size
+
+    Yields:
+    -------
+    (batch, field_index) : crops and the index of the field of each crop.
+        Fields without nuclei contribute no crops.
+    """
+    if read_field is None:
+        read_field = image_prep.Prepper.convert_to_rgb
+    buffer, index, filled = None, None, 0
+    for f, field in enumerate(fields):
+        try:
+            crops = chop.chop_nuclei(read_field(field), **kwargs)
+        except ValueError:
+            continue
+        if buffer is None:
+            buffer = np.empty((batch_size, ) + crops.shape[1:], dtype=crops.dtype)
+            index = np.empty(batch_size, dtype="int64")
+        start = 0
+        while start < len(crops):
+            n = min(batch_size - filled, len(crops) - start)
+            buffer[filled: filled + n] = crops[start: start + n]
+            index[filled: filled + n] = f
+            filled += n
+            start += n
+            if filled == batch_size:
+                yield buffer, index.copy()
+                filled = 0
+    if filled:
+        yield buffer[:filled], index[:filled].copy()
+
+
+def predict_crops(fields, predict, batch_size=256, read_field=None,
+                  preprocess=None, **kwargs):
+    """
+    Predictions for every crop of every field.
+
+    Parameters:
+    -----------
+    fields : list
+        fields to read with read_field
+    predict : callable
+        takes a batch of crops and returns an array of (n, ) or
+        (n, outputs) predictions, e.g. a keras model's predict
+    batch_size : integer (default = 256)
+        number of crops passed to predict at a time
+    read_field : callable (default = image_prep.Prepper.convert_to_rgb)
+        reads a field into an array
+    preprocess : callable (default = None)
+        applied to each batch before predict, e.g. the standardize method
+        of preprocessing.ArrayDataGenerator on a float copy
+    **kwargs : arguments to chop.chop_nuclei, e.g. size
+
+    Returns:
+    --------
+    (predictions, field_index) : (n_crops, outputs) array, and the index of
+        the field of each crop
+    """
+    predictions, field_index = [], []
+    for batch, index in iter_batches(fields, batch_size, read_field, **kwargs):
+        if preprocess is not None:
+            batch = preprocess(batch)
+        output = np.asarray(predict(batch))
+        predictions.append(output.reshape(len(batch), -1))
+        field_index.append(index)
+    if not predictions:
+        return np.empty((0, 0)), np.empty(0, dtype="int64")
+    return np.concatenate(predictions), np.concatenate(field_index)
+
+
+def aggregate(predictions, field_index, metadata, level="well", how="mean"):
+    """
+    Aggregate crop predictions to a level of the plate layout.
+
+    Parameters:
+    -----------
+    predictions : numpy.array
+        (n_crops, outputs) predictions, from predict_crops()
+    field_index : numpy.array
+        the field of each crop, a row of metadata
+    metadata : pandas.DataFrame
+        one row per field, with the columns in LEVELS[level], see
+        image_prep.ImageDict.parse_metadata
+    level : string (default = "well")
+        "field", "site", "well" or "plate"
+    how : string (default = "mean")
+        "mean", "sum" or "max" of the predictions, or "vote" for the
+        fraction of crops whose largest output is each output
+
+    Returns:
+    --------
+    pandas.DataFrame with the level's columns, n_crops, and one column per
+    output, pred_0, pred_1, ... One row per group with at least one crop.
+    """
+    if level not in LEVELS:
+        raise ValueError("unknown level. options: {}".format(sorted(LEVELS)))
+    if how not in ("mean", "sum", "max", "vote"):
+        raise ValueError("unknown how argument. options: mean, sum, max, vote")
+    keys = LEVELS[level]
+    metadata = metadata.reset_index(drop=True).assign(field=np.arange(len(metadata)))
+    grouped = metadata.groupby(keys, sort=True)
+    group_keys = grouped.size().index
+    # group of each crop, and the crops sorted into contiguous segments
+    crop_codes = grouped.ngroup().values[field_index]
+    if len(crop_codes) == 0:
+        return pd.DataFrame(columns=keys + ["n_crops"])
+    order = np.argsort(crop_codes, kind="stable")
+    sorted_codes = crop_codes[order]
+    starts = np.flatnonzero(np.r_[True, sorted_codes[1:] != sorted_codes[:-1]])
+    counts = np.diff(np.r_[starts, len(order)])
+    values = np.asarray(predictions, dtype="float64")[order]
+    if how == "vote":
+        values = np.eye(values.shape[1])[values.argmax(axis=1)]
+    if how == "max":
+        reduced = np.maximum.reduceat(values, starts, axis=0)
+    else:
+        reduced = np.add.reduceat(values, starts, axis=0)
+    if how in ("mean", "vote"):
+        reduced = reduced / counts[:, np.newaxis]
+    out = group_keys[sorted_codes[starts]].to_frame(index=False)
+    out.columns = keys
+    out["n_crops"] = counts
+    for i in range(reduced.shape[1]):
+        out["pred_{}".format(i)] = reduced[:, i]
+    return out
+
+
+def run_inference(img_dict, predict, levels=("field", "site", "well", "plate"),
+                  how="mean", batch_size=256, metadata=None, read_field=None,
+                  preprocess=None, **kwargs):
+    """
+    Chop every field of an image dictionary, predict every crop in batches
+    of `batch_size`, and aggregate the predictions to each level.
+
+    Parameters:
+    -----------
+    img_dict : ImageDict or dictionary
+        fields to predict, see image_prep.list_fields()
+    predict : callable
+        takes a batch of crops and returns their predictions, see
+        predict_crops()
+    levels : list of strings (default = all levels)
+        levels to aggregate to, see aggregate()
+    how : string (default = "mean")
+        how to aggregate, see aggregate()
+    batch_size : integer (default = 256)
+        number of crops passed to predict at a time
+    metadata : pandas.DataFrame (default = None)
+        one row per field, in the order of image_prep.list_fields(). Parsed from the
+        path of each field's first image by default.
+    read_field : callable (default = image_prep.Prepper.convert_to_rgb)
+        reads a field into an array
+    preprocess : callable (default = None)
+        applied to each batch before predict
+    **kwargs : arguments to chop.chop_nuclei, e.g. size
+
+    Returns:
+    --------
+    dictionary {level: pandas.DataFrame}, see aggregate(). The field
+    level also has the class label of each field.
+    """
+    fields, labels = image_prep.list_fields(img_dict)
+    if metadata is None:
+        metadata = image_prep.ImageDict.parse_metadata([f[0] for f in fields])
+    if len(metadata) != len(fields):
+        raise ValueError("metadata needs one row per field")
+    predictions, field_index = predict_crops(
+        fields, predict, batch_size, read_field, preprocess, **kwargs)
+    results = dict()
+    for level in levels:
+        results[level] = aggregate(predictions, field_index, metadata, level, how)
+    if "field" in results:
+        field_labels = np.asarray(labels)[results["field"]["field"].values.astype("int64")]
+        results["field"].insert(1, "class", field_labels)
+    return results
@@ -0,0 +1,199 @@
+"""
+Process based batch loading for DirectoryIterator.
+
+Worker processes write batches straight into a ring of pre-allocated slots
+in shared memory, so no array data is pickled between processes. Only the
+index arrays and slot numbers travel through the queues.
+"""
+
+import queue
+import traceback
+from collections import deque
+from multiprocessing import shared_memory
+import multiprocessing
+import numpy as np
+
+
+class SharedMemoryLoader(object):
+    """
+    Load batches from a DirectoryIterator using worker processes.
+
+    Batches are returned in exactly the order the iterator's index generator
+    produces them, whatever order the workers finish in.
+
+    The returned `batch_x` is a view into shared memory and is only valid
+    until the next call to `next()`, after which the slot is handed back to
+    the workers. Copy it if it needs to outlive that.
+
+    Parameters:
+    -----------
+    iterator : DirectoryIterator
+        iterator to draw index arrays and labels from
+    n_workers : integer (default = 2)
+        number of worker processes
+    n_slots : integer (default = n_workers + 2)
+        number of batch slots in the shared memory ring, must be at least 2.
+        One slot is held by the consumer, the rest are filled ahead.
+    timeout : number (default = 1.0)
+        seconds between checks that the workers are still alive while
+        waiting for a batch
+    """
+
+    def __init__(self, iterator, n_workers=2, n_slots=None, timeout=1.0):
+        if n_workers < 1:
+            raise ValueError("n_workers must be at least 1")
+        if n_slots is None:
+            n_slots = n_workers + 2
+        if n_slots < 2:
+            raise ValueError("n_slots must be at least 2")
+        self.iterator = iterator
+        self.n_workers = n_workers
+        self.n_slots = n_slots
+        self.timeout = timeout
+        self._closed = True
+        slot_shape = (iterator.batch_size, ) + tuple(iterator.image_shape)
+        shape = (n_slots, ) + slot_shape
+        nbytes = int(np.prod(shape)) * np.dtype("float32").itemsize
+        self._shm = shared_memory.SharedMemory(create=True, size=nbytes)
+        self._buffer = np.ndarray(shape, dtype="float32", buffer=self._shm.buf)
+        ctx = multiprocessing.get_context()
+        self._tasks = ctx.Queue()
+        self._results = ctx.Queue()
+        self._workers = []
+        for _ in range(n_workers):
+            worker = ctx.Process(target=_worker,
+                                 args=(iterator, self._shm.name, shape,
+                                       self._tasks, self._results),
+                                 daemon=True)
+            worker.start()
+            self._workers.append(worker)
+        self._closed = False
+        self._free_slots = deque(range(n_slots))
+        self._in_flight = dict()  # seq -> (slot, index_array)
+        self._done = dict()       # seq -> slot
+        self._submitted = 0
+        self._next_seq = 0
+        self._held_slot = None
+        self._submit()
+
+
+    def _submit(self):
+        """hand every free slot to the workers"""
+        while self._free_slots:
+            slot = self._free_slots.popleft()
+            with self.iterator.lock:
+                index_array, _, _ = next(self.iterator.index_generator)
+            seq = self._submitted
+            self._in_flight[seq] = (slot, index_array)
+            self._tasks.put((seq, slot, index_array))
+            self._submitted += 1
+
+
+    def _wait_for(self, seq):
+        """block until batch `seq` has been filled"""
+        while seq not in self._done:
+            try:
+                done_seq, slot, err = self._results.get(timeout=self.timeout)
+            except queue.Empty:
+                dead = [w for w in self._workers if not w.is_alive()]
+                if dead:
+                    self.close()
+                    raise RuntimeError(
+                        "loader worker exited unexpectedly (exit code {})".format(
+                            dead[0].exitcode))
+                continue
+            if err is not None:
+                self.close()
+                raise RuntimeError("loader worker failed:\n{}".format(err))
+            self._done[done_seq] = slot
+
+
+    def next(self):
+        """
+        returns the next batch
+        """
+        if self._closed:
+            raise RuntimeError("loader has been closed")
+        if self._held_slot is not None:
+            self._free_slots.append(self._held_slot)
+            self._held_slot = None
+            self._submit()
+        seq = self._next_seq
+        self._wait_for(seq)
+        slot = self._done.pop(seq)
+        _, index_array = self._in_flight.pop(seq)
+        self._held_slot = slot
+        self._next_seq += 1
+        batch_x = self._buffer[slot, :len(index_array)]
+        if self.iterator.class_mode is None:
+            return batch_x
+        return batch_x, self.iterator._batch_labels(index_array)
+
+
+    def close(self):
+        """stop the workers and release the shared memory"""
+        if self._closed:
+            return
+        self._closed = True
+        for _ in self._workers:
+            self._tasks.put(None)
+        for worker in self._workers:
+            worker.join(timeout=5)
+            if worker.is_alive():
+                worker.terminate()
+                worker.join()
+        self._tasks.close()
+        self._results.close()
+        # drop our view before closing the mapping
+        self._buffer = None
+        try:
+            self._shm.close()
+        except BufferError:
+            # the consumer still holds a batch view, the mapping is released
+            # when that is garbage collected
+            pass
+        self._shm.unlink()
+
+
+    def __iter__(self):
+        return self
+
+
+    def __next__(self):
+        return self.next()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+
+def _worker(reader, shm_name, shape, tasks, results):
+    """fill batch slots in shared memory until sent None"""
+    shm = shared_memory.SharedMemory(name=shm_name)
+    buffer = np.ndarray(shape, dtype="float32", buffer=shm.buf)
+    try:
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+            seq, slot, index_array = task
+            try:
+                reader._load_batch(buffer[slot, :len(index_array)], index_array)
+                results.put((seq, slot, None))
+            except Exception:
+                results.put((seq, slot, traceback.format_exc()))
+    finally:
+        del buffer
+        shm.close()
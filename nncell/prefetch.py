@@ -0,0 +1,83 @@
+"""
+Read-ahead of source fields, so chopping never waits on the file system.
+
+Reading a field is mostly waiting on disk or network storage, with the
+decompression of the images done outside the GIL, so a small pool of
+threads reading the next few fields keeps the main loop busy with
+detection and writing. Fields are returned in order.
+
+The number of fields read ahead is limited by `depth`, and by `max_bytes`,
+an upper bound on the memory held by fields that have been read ahead.
+"""
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+class FieldPrefetcher(object):
+    """
+    Iterate over read_field(field) for each field, reading up to `depth`
+    fields ahead in a pool of threads.
+
+    Parameters:
+    -----------
+    read_field : callable
+        reads a field into an array, e.g. Prepper._read_field
+    fields : list
+        fields to read, e.g. lists of channel paths
+    depth : integer (default = 4)
+        maximum number of fields read ahead of the one being used.
+        0 reads each field when it is needed, with no threads.
+    max_bytes : integer (default = None)
+        maximum number of bytes of fields read ahead, estimated from the
+        largest field read so far. At least one field is always read ahead.
+    n_threads : integer (default = depth)
+        number of fields read at once
+
+    An error reading a field is raised when that field is reached.
+    """
+
+    def __init__(self, read_field, fields, depth=4, max_bytes=None,
+                 n_threads=None):
+        if depth < 0:
+            raise ValueError("depth must be 0 or more")
+        self.read_field = read_field
+        self.fields = fields
+        self.depth = depth
+        self.max_bytes = max_bytes
+        self.n_threads = n_threads or depth
+        self.field_bytes = 0
+
+
+    def _n_ahead(self):
+        """number of fields that can be read ahead at once"""
+        if self.max_bytes is None or self.field_bytes == 0:
+            return self.depth
+        return max(1, min(self.depth, self.max_bytes // self.field_bytes))
+
+
+    def __iter__(self):
+        if self.depth == 0:
+            for field in self.fields:
+                yield self.read_field(field)
+            return
+        fields = iter(self.fields)
+        pending = deque()
+        with ThreadPoolExecutor(self.n_threads) as executor:
+            try:
+                while True:
+                    while len(pending) < self._n_ahead():
+                        field = next(fields, None)
+                        if field is None:
+                            break
+                        pending.append(executor.submit(self.read_field, field))
+                    if not pending:
+                        return
+                    result = pending.popleft().result()
+                    self.field_bytes = max(self.field_bytes,
+                                           getattr(result, "nbytes", 0))
+                    yield result
+            finally:
+                # stopped early, don't wait on reads nobody will use
+                for future in pending:
+                    future.cancel()
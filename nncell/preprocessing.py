@@ -1,30 +1,86 @@
 import os
 import random
+from collections import OrderedDict
 from functools import partial
 import multiprocessing.pool
 import threading
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
+from skimage import io
+from nncell import utils
+from nncell import chop
+from nncell import image_prep
+from nncell import profiling
+
+
+# file extensions DirectoryIterator can load
+ARRAY_FORMATS = ["npy", "npz"]
+IMAGE_FORMATS = ["png", "jpg", "jpeg", "tif", "tiff"]
 
 
 class Iterator(object):
     """
     Abstract base class for data iterators
 
+    Subclasses set `image_shape`, `class_mode`, `classes`, `num_classes`,
+    `n_buffers` and `cache`, and implement `_fill_batch` to load samples.
+    Batch buffers and labels are handled here.
+
+    For data parallel training each of `world_size` processes creates the
+    same iterator with its own `rank`. Every epoch the full index array is
+    drawn identically on all ranks (so shuffling needs a seed), then split
+    into `world_size` contiguous blocks and each rank only loads its own.
+    Block sizes are made equal, so every rank sees the same number of
+    batches, by either repeating indices from the start of the epoch or
+    dropping the remainder.
+
     Parameters:
     -----------
     n : Integer
         total number of samples in the dataset to loop over
     batch_size: Integer
         size of batch
+    shuffle: Boolean (default = False)
+        shuffle the samples every epoch
+    seed: Integer or None (default = None)
+        random seed for shuffling
+    rank: Integer (default = 0)
+        index of this process, from 0 to world_size - 1
+    world_size: Integer (default = 1)
+        number of processes the samples are split between
+    drop_last: Boolean (default = False)
+        If True, drop the samples left over after splitting between ranks.
+        If False, pad with samples from the start of the epoch instead.
     """
 
-    def __init__(self, n, batch_size):
-        self.n = n
+    def __init__(self, n, batch_size, shuffle=False, seed=None, rank=0,
+                 world_size=1, drop_last=False):
+        if world_size < 1 or not 0 <= rank < world_size:
+            raise ValueError("rank must be in the range 0 to world_size - 1")
+        if world_size > 1 and shuffle and seed is None:
+            raise ValueError("shuffling with world_size > 1 needs a seed so "
+                             "that every rank draws the same order")
         self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.random_state = np.random.RandomState(seed)
+        self.rank = rank
+        self.world_size = world_size
+        self.drop_last = drop_last
+        self.n = self._shard_size(n)
+        if self.n == 0:
+            raise ValueError("fewer samples than ranks to split them between")
+        self.epoch = 0
         self.batch_index = 0
         self.total_batches_seen = 0
         self.index_generator = self._flow_index(n, batch_size)
         self.lock = threading.Lock()
+        self._buffers = None
+        self._buffer_index = 0
+        if self.class_mode == "binary" and self.num_classes != 2:
+            raise ValueError("class_mode 'binary' needs exactly 2 classes, "
+                             "found {}".format(self.num_classes))
+        # one-hot labels are rows of the identity matrix
+        self._eye = np.eye(self.num_classes, dtype="float32")
 
 
     def reset(self):
@@ -35,19 +91,151 @@ class Iterator(object):
         self.reset()
         while 1:
             if self.batch_index == 0:
-                index_array = np.arange(n)
-            current_index = (self.batch_index * batch_size) % n
-            if n > current_index + batch_size:
+                index_array = self._shard(self._epoch_index_array(n))
+                self.epoch += 1
+                n_rank = len(index_array)
+            current_index = (self.batch_index * batch_size) % n_rank
+            if n_rank > current_index + batch_size:
                 current_batch_size = batch_size
                 self.batch_index += 1
             else:
-                current_batch_size = n - current_index
+                current_batch_size = n_rank - current_index
                 self.batch_index = 0
             self.total_batches_seen += 1
             yield (index_array[current_index: current_index + current_batch_size],
                    current_index, current_batch_size)
 
 
+    def _epoch_index_array(self, n):
+        """sample indices for a new epoch, the same on every rank"""
+        if self.shuffle:
+            return self.random_state.permutation(n)
+        return np.arange(n)
+
+
+    def _shard_size(self, n):
+        """number of samples per rank for an epoch of n samples"""
+        if self.drop_last:
+            return n // self.world_size
+        return -(-n // self.world_size)
+
+
+    def _shard(self, index_array):
+        """this rank's block of an epoch's index array"""
+        if self.world_size == 1:
+            return index_array
+        size = self._shard_size(len(index_array))
+        total = size * self.world_size
+        if total > len(index_array):
+            # pad by repeating from the start, wrapping if needed
+            index_array = np.resize(index_array, total)
+        return index_array[self.rank * size: (self.rank + 1) * size]
+
+
+    @profiling.profiled("Iterator.next")
+    def next(self):
+        """
+        returns the next batch
+        """
+        with self.lock:
+            index_array, _, current_batch_size = next(self.index_generator)
+            batch_x, batch_y = self._get_buffers(current_batch_size)
+        self._load_batch(batch_x, index_array)
+        batch_y = self._batch_labels(index_array, out=batch_y)
+        if self.class_mode is None:
+            return batch_x
+        return batch_x, batch_y
+
+
+    def _label_shape(self, n):
+        if self.class_mode == "categorical":
+            return (n, self.num_classes)
+        return (n, )
+
+
+    def _get_buffers(self, current_batch_size):
+        """batch arrays to fill, either new or the next ones in the ring"""
+        if self.n_buffers is None:
+            batch_x = np.zeros((current_batch_size, ) + self.image_shape,
+                               dtype="float32")
+            return batch_x, None
+        if self._buffers is None:
+            self._buffers = [
+                (np.zeros((self.batch_size, ) + self.image_shape, dtype="float32"),
+                 np.zeros(self._label_shape(self.batch_size), dtype="float32"))
+                for _ in range(self.n_buffers)]
+        batch_x, batch_y = self._buffers[self._buffer_index]
+        self._buffer_index = (self._buffer_index + 1) % self.n_buffers
+        return batch_x[:current_batch_size], batch_y[:current_batch_size]
+
+
+    @profiling.profiled("Iterator._load_batch")
+    def _load_batch(self, batch_x, index_array):
+        """
+        fill batch_x with the samples in index_array, and standardize it
+        with image_data_generator if one was given
+        """
+        self._fill_batch(batch_x, index_array)
+        if self.image_data_generator is not None:
+            self.image_data_generator.standardize(batch_x)
+
+
+    def _fill_batch(self, batch_x, index_array):
+        """load the samples in index_array into batch_x"""
+        raise NotImplementedError
+
+
+    def _map(self, function, items):
+        """call function on each item, using a thread pool if n_threads > 1"""
+        if self.n_threads > 1:
+            if self._thread_pool is None:
+                self._thread_pool = ThreadPoolExecutor(self.n_threads)
+            # consume the iterator so errors in the threads are raised here
+            list(self._thread_pool.map(function, items))
+        else:
+            for item in items:
+                function(item)
+
+
+    def _batch_labels(self, index_array, out=None):
+        """
+        labels for the samples in index_array, written into `out` if given
+        """
+        if self.class_mode is None:
+            return None
+        if out is None:
+            out = np.empty(self._label_shape(len(index_array)), dtype="float32")
+        labels = self.classes[index_array]
+        if self.class_mode == "categorical":
+            np.take(self._eye, labels, axis=0, out=out)
+        else:
+            out[:] = labels
+        return out
+
+
+    def __getstate__(self):
+        # the index generator and lock cannot be pickled, so worker processes
+        # get a copy which can only load samples, not draw batches
+        state = self.__dict__.copy()
+        state["index_generator"] = None
+        state["lock"] = None
+        state["_buffers"] = None
+        state["_thread_pool"] = None
+        return state
+
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+
+    def cache_info(self):
+        """hit and miss statistics of the sample cache, or None"""
+        if self.cache is None:
+            return None
+        return self.cache.info()
+
+
     def __iter__(self):
         return self
 
@@ -67,22 +255,72 @@ class DirectoryIterator(Iterator):
     directory: string
         Path to directory to read from. Each subdirectory in this directory
         will be considered to contain samples from one class.
-    image_data_generator: Instance of ArrayDataGenerator
-        To use for transformations and normalizations
+    image_data_generator: Instance of ArrayDataGenerator or None
+        its standardize method is applied to every batch, e.g. to rescale
+        and normalise. None leaves the samples as they are stored.
     batch_size: Integer
                 Size of batch
+    image_shape: tuple
+        shape of a single sample
+    class_mode: string or None (default = "categorical")
+        options:
+            categorical : one-hot encoded labels
+            sparse      : integer class labels
+            binary      : class labels for two classes, as 0 or 1
+            None        : no labels, only batch_x is returned
+    n_buffers: Integer or None (default = None)
+        If None a new batch array is allocated for every batch. Otherwise
+        batches are written into a ring of `n_buffers` reusable arrays, so a
+        returned batch is overwritten `n_buffers` calls later. Use 2 to keep
+        the previous batch intact while the next one is loaded.
+    class_weight: None, "balanced", dict or list (default = None)
+        If None every sample is visited once per epoch. Otherwise each epoch
+        is drawn with replacement by a ClassWeightedSampler with these class
+        weights.
+    shuffle: Boolean (default = False)
+        shuffle the samples every epoch, ignored with class_weight
+    seed: Integer or None (default = None)
+        random seed for shuffling or class weighted sampling
+    cache_bytes: Integer (default = 0)
+        If greater than 0, loaded samples are kept in a least recently used
+        SampleCache of this many bytes, so later epochs are served from
+        memory rather than disk.
+    n_threads: Integer (default = 1)
+        number of threads loading the samples of each batch. Decompressing
+        .npz files, decoding images and reading from disk release the GIL,
+        so threads help with compressed data, images or slow storage.
+    resize: Boolean (default = False)
+        If True, samples whose height and width differ from image_shape are
+        resized to fit. Samples are loaded into a staging batch at their
+        stored size and the whole batch is resized at once with
+        chop.resize_crops, which is a block mean for integer factors. If
+        False samples must already match image_shape.
+    rank, world_size, drop_last:
+        split the samples between data parallel processes, see Iterator
     """
 
     def __init__(self, directory, image_data_generator, batch_size, image_shape,
-                 class_mode="categorical", follow_links=False):
+                 class_mode="categorical", follow_links=False, n_buffers=None,
+                 class_weight=None, shuffle=False, seed=None, cache_bytes=0,
+                 n_threads=1, resize=False, rank=0, world_size=1,
+                 drop_last=False):
+        _check_class_mode(class_mode)
+        if n_buffers is not None and n_buffers < 1:
+            raise ValueError("n_buffers must be a positive integer or None")
         self.directory = directory
         self.image_data_generator = image_data_generator
         self.batch_size = batch_size
-        self.image_shape = image_shape
+        self.image_shape = tuple(image_shape)
         self.class_mode = class_mode
+        self.n_buffers = n_buffers
+        self.cache = SampleCache(cache_bytes) if cache_bytes > 0 else None
+        self.n_threads = n_threads
+        self._thread_pool = None
+        self.resize = resize
+        self.source_shape = None
 
         # count the number of samples and classes
-        white_list_formats = ["npy"]
+        white_list_formats = ARRAY_FORMATS + IMAGE_FORMATS
 
         self.samples = 0
 
@@ -101,7 +339,7 @@ class DirectoryIterator(Iterator):
 
         pool = multiprocessing.pool.ThreadPool()
         function_partial = partial(_count_valid_files_in_directory,
-                                white_list_formats=["npy"],
+                                white_list_formats=white_list_formats,
                                 follow_links=follow_links)
         self.samples = sum(pool.map(function_partial,
                                     (os.path.join(directory, subdir)
@@ -124,27 +362,383 @@ class DirectoryIterator(Iterator):
             i += len(classes)
         pool.close()
         pool.join()
-        super(DirectoryIterator, self).__init__(self.samples, batch_size)
+        if class_weight is None:
+            self.sampler = None
+        else:
+            if world_size > 1 and seed is None:
+                raise ValueError("class_weight with world_size > 1 needs a "
+                                 "seed so that every rank draws the same order")
+            self.sampler = ClassWeightedSampler(self.classes, class_weight,
+                                                num_classes=self.num_classes,
+                                                seed=seed)
+        super(DirectoryIterator, self).__init__(
+            self.samples, batch_size, shuffle=shuffle, seed=seed, rank=rank,
+            world_size=world_size, drop_last=drop_last)
+
+
+    def _epoch_index_array(self, n):
+        if self.sampler is None:
+            return super(DirectoryIterator, self)._epoch_index_array(n)
+        return self.sampler.sample()
+
+
+    def _fill_batch(self, batch_x, index_array):
+        """load the samples in index_array into batch_x"""
+        target = batch_x
+        if self.resize:
+            if self.source_shape is None:
+                # stored sample shape, assumed common to the dataset
+                self.source_shape = self._load_sample(index_array[0]).shape
+            if self.source_shape != self.image_shape:
+                target = np.empty((len(index_array), ) + self.source_shape,
+                                  dtype="float32")
+        # samples of an unexpected shape, resized one by one
+        mismatched = []
+
+        def _load_into(i):
+            # transform here
+            arr = self._load_sample(index_array[i])
+            if self.resize and arr.shape != target.shape[1:]:
+                mismatched.append((i, arr))
+            else:
+                target[i] = arr
 
+        self._map(_load_into, range(len(index_array)))
+        if target is not batch_x:
+            chop.resize_crops(target, self.image_shape[:2], out=batch_x)
+        for i, arr in mismatched:
+            batch_x[i] = chop.resize_crops(arr[np.newaxis], self.image_shape[:2])[0]
 
-    def next(self):
-        """
-        returns the next batch
-        """
+
+    def _load_sample(self, j):
+        """load sample j, from the cache if there is one"""
+        if self.cache is not None:
+            arr = self.cache.get(j)
+            if arr is not None:
+                return arr
+        arr = _read_sample(os.path.join(self.directory, self.filenames[j]))
+        if arr.ndim == len(self.image_shape) - 1:
+            # single channel image into a channels-last batch
+            arr = arr[..., np.newaxis]
+        if self.cache is not None:
+            self.cache.put(j, arr)
+        return arr
+
+
+
+
+
+class FieldCropIterator(Iterator):
+    """
+    Crop nuclei out of their parent fields at batch time, so crops are never
+    written to disk.
+
+    Nuclei are detected once per field when the iterator is created and only
+    the crop corners are stored. Samples are ordered by parent field, so
+    reading a field serves every crop of it in the batch. With shuffle the
+    order of fields, and of crops within each field, is shuffled, but crops
+    of a field stay together.
+
+    Parameters:
+    ------------
+    img_dict: dictionary
+        {class_name : [field, ...]} where each field is a list of channel
+        image paths, e.g. ImageDict.make_dict()["train"]
+    image_data_generator: Instance of ArrayDataGenerator or None
+        its standardize method is applied to every batch, e.g. to rescale
+        and normalise. None leaves the samples as they are stored.
+    batch_size: Integer
+        Size of batch
+    size: Integer (default = 100)
+        width and height of the crops, see chop.chop_nuclei
+    edge: string (default = "keep")
+        what to do with nuclei on the edge of a field, see chop.chop_nuclei
+    threshold: number (default = 0.1)
+        threshold argument to skimage.feature.blob_dog
+    class_mode: string or None (default = "categorical")
+        see DirectoryIterator
+    n_buffers: Integer or None (default = None)
+        see DirectoryIterator
+    shuffle: Boolean (default = False)
+        shuffle fields, and crops within fields, every epoch
+    seed: Integer or None (default = None)
+        random seed for shuffling
+    cache_bytes: Integer (default = 0)
+        byte budget for decoded fields kept in memory between batches
+    memmap_dir: string (default = None)
+        If given, decoded fields are written here as .npy files while
+        indexing, and memory mapped at batch time instead of being decoded
+        again.
+    n_threads: Integer (default = 1)
+        number of threads cropping the fields of each batch
+    read_field: callable (default = image_prep.Prepper.convert_to_rgb)
+        function from a list of channel paths to a field array
+    rank, world_size, drop_last:
+        split the samples between data parallel processes, see Iterator
+    **kwargs: additional arguments to chop.find_nuclei, such as
+        dedupe_radius, and skimage.feature.blob_dog
+    """
+
+    def __init__(self, img_dict, image_data_generator, batch_size, size=100,
+                 edge="keep", threshold=0.1, class_mode="categorical",
+                 n_buffers=None, shuffle=False, seed=None, cache_bytes=0,
+                 memmap_dir=None, n_threads=1, read_field=None, rank=0,
+                 world_size=1, drop_last=False, **kwargs):
+        _check_class_mode(class_mode)
+        self.image_data_generator = image_data_generator
+        self.size = size
+        self.class_mode = class_mode
+        self.n_buffers = n_buffers
+        self.cache = SampleCache(cache_bytes) if cache_bytes > 0 else None
+        self.memmap_dir = memmap_dir
+        self.n_threads = n_threads
+        self._thread_pool = None
+        if read_field is None:
+            read_field = image_prep.Prepper.convert_to_rgb
+        self.read_field = read_field
+        if memmap_dir is not None:
+            utils.make_dir(memmap_dir)
+        class_names = sorted(img_dict.keys())
+        self.num_classes = len(class_names)
+        self.class_indices = dict(zip(class_names, range(len(class_names))))
+        self.fields = []
+        field_index, origins, classes = [], [], []
+        self.image_shape = None
+        for class_name in class_names:
+            for field in img_dict[class_name]:
+                # skip fields which can't be read or have no nuclei, like the
+                # create_directories_chop writers do
+                try:
+                    img = read_field(field)
+                    nuclei = chop.find_nuclei(img, threshold=threshold, **kwargs)
+                    field_origins, _ = chop.box_origins(nuclei[:, :2], img.shape,
+                                                        size, edge)
+                except ValueError:
+                    continue
+                if len(field_origins) == 0:
+                    continue
+                if self.image_shape is None:
+                    self.image_shape = (size, size) + img.shape[2:]
+                f = len(self.fields)
+                self.fields.append(field)
+                if memmap_dir is not None:
+                    np.save(self._memmap_path(f), img)
+                field_index.append(np.full(len(field_origins), f, dtype="int64"))
+                origins.append(field_origins)
+                classes.append(np.full(len(field_origins),
+                                       self.class_indices[class_name],
+                                       dtype="int32"))
+        if not self.fields:
+            raise ValueError("no nuclei found in any field")
+        self.field_index = np.concatenate(field_index)
+        self.origins = np.concatenate(origins)
+        self.classes = np.concatenate(classes)
+        self.samples = len(self.classes)
+        print("Found {} nuclei in {} fields belonging to {} classes".format(
+              self.samples, len(self.fields), self.num_classes))
+        super(FieldCropIterator, self).__init__(
+            self.samples, batch_size, shuffle=shuffle, seed=seed, rank=rank,
+            world_size=world_size, drop_last=drop_last)
+
+
+    def _memmap_path(self, f):
+        return os.path.join(self.memmap_dir, "field_{}.npy".format(f))
+
+
+    def _epoch_index_array(self, n):
+        if not self.shuffle:
+            return np.arange(n)
+        rng = self.random_state
+        field_rank = rng.permutation(len(self.fields))
+        # sort by shuffled field, then randomly within each field
+        return np.lexsort((rng.random_sample(n), field_rank[self.field_index]))
+
+
+    def _load_field(self, f):
+        """decoded field f, from the cache or memory map if possible"""
+        if self.cache is not None:
+            img = self.cache.get(f)
+            if img is not None:
+                return img
+        if self.memmap_dir is not None:
+            img = np.load(self._memmap_path(f), mmap_mode="r")
+        else:
+            img = self.read_field(self.fields[f])
+        if self.cache is not None:
+            # cache an in-memory copy, not the memory map
+            img = np.array(img)
+            self.cache.put(f, img)
+        return img
+
+
+    def _fill_batch(self, batch_x, index_array):
+        fields = self.field_index[index_array]
+        size = self.size
+
+        def _crop_field(f):
+            img = self._load_field(f)
+            for i in np.flatnonzero(fields == f):
+                x, y = self.origins[index_array[i]]
+                batch_x[i] = img[x: x + size, y: y + size]
+
+        self._map(_crop_field, np.unique(fields))
+
+
+
+
+class SampleCache(object):
+    """
+    Thread-safe least recently used cache of arrays, bounded by total bytes
+    rather than number of entries.
+
+    Cached arrays are made read-only, as they are shared between batches.
+
+    Parameters:
+    -----------
+    max_bytes : Integer
+        byte budget, once exceeded the least recently used arrays are evicted
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self.lock = threading.Lock()
+
+
+    def get(self, key):
+        """cached array for key, or None"""
         with self.lock:
-            index_array, _, current_batch_size = next(self.index_generator)
-        batch_x = np.zeros((current_batch_size, ) + self.image_shape, dtype="float32")
-        for i, j in enumerate(index_array):
-            fname = self.filenames[j]
-            arr = np.load(os.path.join(self.directory, fname))
-            # transform here
-            batch_x[i] = arr
-        if self.class_mode == "categorical":
-            batch_y = np.zeros((len(batch_x), self.num_classes), dtype="float32")
-            for i, label in enumerate(self.classes[index_array]):
-                batch_y[i, label] = 1
-        return batch_x, batch_y
+            arr = self._data.get(key)
+            if arr is None:
+                self.misses += 1
+            else:
+                self._data.move_to_end(key)
+                self.hits += 1
+            return arr
+
+
+    def put(self, key, arr):
+        """add an array, evicting others to stay within the byte budget"""
+        if arr.nbytes > self.max_bytes:
+            return
+        arr.flags.writeable = False
+        with self.lock:
+            if key in self._data:
+                return
+            while self.current_bytes + arr.nbytes > self.max_bytes:
+                _, evicted = self._data.popitem(last=False)
+                self.current_bytes -= evicted.nbytes
+                self.evictions += 1
+            self._data[key] = arr
+            self.current_bytes += arr.nbytes
+
+
+    def info(self):
+        """dictionary of cache statistics"""
+        with self.lock:
+            return dict(hits=self.hits, misses=self.misses,
+                        evictions=self.evictions, entries=len(self._data),
+                        current_bytes=self.current_bytes,
+                        max_bytes=self.max_bytes)
+
 
+    def __len__(self):
+        return len(self._data)
+
+
+    def __getstate__(self):
+        # copies sent to other processes start empty
+        return dict(max_bytes=self.max_bytes)
+
+
+    def __setstate__(self, state):
+        self.__init__(state["max_bytes"])
+
+
+
+
+class ClassWeightedSampler(object):
+    """
+    Draw an epoch of sample indices with replacement, weighting each sample
+    by the weight of its class. Used to over-sample rare classes without
+    copying files.
+
+    Samples are drawn in two vectorized steps: the number of samples per
+    class from a multinomial, then uniform positions within each class.
+    Both are O(n) per epoch.
+
+    Parameters:
+    -----------
+    classes : array-like of integers
+        class index of every sample
+    weights : "balanced", dict or list
+        "balanced" : every class is drawn equally often on average
+        dict       : {class_index: weight}, missing classes get weight 0
+        list       : weight for each class index
+        Weights are per sample, so a class is drawn in proportion to its
+        weight times its number of samples.
+    num_classes : Integer (default = None)
+        number of classes, inferred from `classes` if None
+    num_samples : Integer (default = None)
+        number of indices drawn per epoch, defaults to len(classes)
+    seed : Integer or None (default = None)
+        random seed
+    """
+
+    def __init__(self, classes, weights="balanced", num_classes=None,
+                 num_samples=None, seed=None):
+        self.classes = np.asarray(classes)
+        if num_classes is None:
+            num_classes = int(self.classes.max()) + 1
+        self.num_classes = num_classes
+        self.num_samples = len(self.classes) if num_samples is None else num_samples
+        self.class_counts = np.bincount(self.classes, minlength=num_classes)
+        self.class_probs = self._class_probs(weights)
+        # sample indices grouped by class, and where each class starts
+        self._order = np.argsort(self.classes, kind="stable")
+        self._starts = np.concatenate([[0], np.cumsum(self.class_counts)[:-1]])
+        self.random_state = np.random.RandomState(seed)
+
+
+    def _class_probs(self, weights):
+        """probability of drawing each class"""
+        if isinstance(weights, str):
+            if weights != "balanced":
+                raise ValueError("unknown weights argument, expected 'balanced', "
+                                 "a dict or a list")
+            class_mass = (self.class_counts > 0).astype("float64")
+        else:
+            if isinstance(weights, dict):
+                per_sample = np.zeros(self.num_classes, dtype="float64")
+                for label, weight in weights.items():
+                    per_sample[label] = weight
+            else:
+                per_sample = np.asarray(weights, dtype="float64")
+                if per_sample.shape != (self.num_classes, ):
+                    raise ValueError("expected a weight for each of {} classes".format(
+                        self.num_classes))
+            if (per_sample < 0).any():
+                raise ValueError("class weights must not be negative")
+            class_mass = per_sample * self.class_counts
+        if class_mass.sum() == 0:
+            raise ValueError("class weights select no samples")
+        return class_mass / class_mass.sum()
+
+
+    def sample(self):
+        """return an array of sample indices for one epoch"""
+        rng = self.random_state
+        per_class = rng.multinomial(self.num_samples, self.class_probs)
+        class_ids = np.repeat(np.arange(self.num_classes), per_class)
+        offsets = (rng.random_sample(self.num_samples) *
+                   self.class_counts[class_ids]).astype("int64")
+        index_array = self._order[self._starts[class_ids] + offsets]
+        rng.shuffle(index_array)
+        return index_array
 
 
 
@@ -152,11 +746,50 @@ class DirectoryIterator(Iterator):
 class ArrayDataGenerator(Iterator):
     """
     Similar to keras.preprocessing.ImageDataGenerator but works on numpy arrays.
+
+    Parameters:
+    -----------
+    rescale : number or None (default = None)
+        multiply the data by this value
+    horizontal_flip : Boolean (default = False)
+    mean : array-like or None (default = None)
+        per-channel mean of the stored data, e.g. stats.channel_stats().mean
+    std : array-like or None (default = None)
+        per-channel standard deviation of the stored data, e.g.
+        stats.channel_stats().std
+
+    If mean and std are given each channel is normalised to zero mean and
+    unit variance, which makes rescale redundant. Rescaling and
+    normalisation are fused into one multiply and add per channel, applied
+    in place to each batch.
     """
 
-    def __init__(self, rescale=None, horizontal_flip=False):
+    def __init__(self, rescale=None, horizontal_flip=False, mean=None, std=None):
         self.rescale = rescale
         self.horizontal_flip = horizontal_flip
+        self.mean = mean
+        self.std = std
+        if (mean is None) != (std is None):
+            raise ValueError("mean and std must be given together")
+        # x * scale + offset
+        # == ((x * rescale) - (mean * rescale)) / (std * rescale)
+        self._scale = rescale
+        self._offset = None
+        if mean is not None:
+            std = np.asarray(std, dtype="float64")
+            # leave constant channels unscaled rather than dividing by zero
+            std = np.where(std > 0, std, 1.0)
+            self._scale = (1.0 / std).astype("float32")
+            self._offset = (-np.asarray(mean, dtype="float64") / std).astype("float32")
+
+
+    def standardize(self, x):
+        """apply rescale and normalisation to a batch in place"""
+        if self._scale is not None:
+            np.multiply(x, self._scale, out=x)
+        if self._offset is not None:
+            np.add(x, self._offset, out=x)
+        return x
 
 
     def flow(self):
@@ -167,12 +800,27 @@ class ArrayDataGenerator(Iterator):
 
 
     def flow_from_directory(self, directory, batch_size=32,
-                            follow_links=False, image_shape=(250, 250)):
+                            follow_links=False, image_shape=(250, 250),
+                            resize=False, **kwargs):
         """
         generator to return numpy arrays from a directory
+
+        Parameters:
+        -----------
+        directory : string
+            directory with a sub-directory of samples per class
+        batch_size : Integer
+        follow_links : Boolean
+        image_shape : tuple
+            shape of each sample in a batch
+        resize : Boolean
+            resize stored samples to image_shape, see DirectoryIterator
+        **kwargs : additional arguments to DirectoryIterator
         """
         return DirectoryIterator(directory, self, batch_size=batch_size,
-                                 follow_links=follow_links)
+                                 image_shape=image_shape,
+                                 follow_links=follow_links, resize=resize,
+                                 **kwargs)
 
         if self.horizontal_flip is True:
             # Check if array is square. If it is we can rotate by a
@@ -194,6 +842,35 @@ class ArrayDataGenerator(Iterator):
 
 
 
+def iter_files(directory, follow_links=False):
+    """
+    paths of every file in `directory` that DirectoryIterator can read, in
+    sorted order, without listing the whole tree up front
+    """
+    formats = tuple("." + ext for ext in ARRAY_FORMATS + IMAGE_FORMATS)
+    for root, dirs, files in os.walk(directory, followlinks=follow_links):
+        dirs.sort()
+        for fname in sorted(files):
+            if fname.lower().endswith(formats):
+                yield os.path.join(root, fname)
+
+
+def _read_sample(path):
+    """read an array or image file into a numpy array"""
+    ext = os.path.splitext(path)[1].lower().lstrip(".")
+    if ext in IMAGE_FORMATS:
+        return io.imread(path)
+    return utils.load_array(path)
+
+
+def _check_class_mode(class_mode):
+    """check class_mode arguments"""
+    class_mode_args = ["categorical", "sparse", "binary", None]
+    if class_mode not in class_mode_args:
+        raise ValueError("unknown class_mode argument. options: {}".format(
+            class_mode_args))
+
+
 def _count_valid_files_in_directory(directory, white_list_formats, follow_links):
     """
     Count files with extension in white_list_formats contained in a directory
@@ -215,7 +892,7 @@ def _count_valid_files_in_directory(directory, white_list_formats, follow_links)
 
     samples = 0
     for root, _, files in _recursive_list(directory):
-        for fname in files:
+        for fname in sorted(files):
             is_valid = False
             for extension in white_list_formats:
                 if fname.lower().endswith("." + extension):
@@ -250,7 +927,7 @@ def _list_valid_filenames_in_directory(directory, white_list_formats,
     subdir = os.path.basename(directory)
     basedir = os.path.dirname(directory)
     for root, _, files in _recursive_list(directory):
-        for fname in files:
+        for fname in sorted(files):
             is_valid = False
             for extension in white_list_formats:
                 if fname.lower().endswith("." + extension):
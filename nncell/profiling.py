@@ -0,0 +1,250 @@
+"""
+Opt-in profiling of the prep and loading stages.
+
+Profiling is switched on by setting the NNCELL_PROFILE environment variable
+to an output directory before the run, or by calling enable(out_dir).
+Because the setting is an environment variable, worker processes started
+by joblib or multiprocessing inherit it.
+
+While enabled, every stage (a function decorated with profiled(), or a
+`with stage(name):` block) collects cProfile statistics and the peak
+memory traced by tracemalloc. Time inside a nested stage, both in the
+profile and in the stage's total seconds, is counted towards the inner
+stage only, so the totals of all stages add up to the time profiled. Each process writes its results to the
+output directory, and merge_report() combines the results of every
+process into one report at the end of the run.
+
+When disabled, a decorated function costs one extra flag check per call.
+"""
+
+import os
+import time
+import json
+import glob
+import atexit
+import cProfile
+import pstats
+import tracemalloc
+import threading
+import functools
+from contextlib import contextmanager
+from multiprocessing import util
+
+ENV_VAR = "NNCELL_PROFILE"
+
+# output directory, None when profiling is disabled
+_out_dir = os.environ.get(ENV_VAR) or None
+# seconds between writing results while stages are running
+_DUMP_INTERVAL = 1.0
+
+_lock = threading.Lock()
+_local = threading.local()
+_state = {"pid": None, "last_dump": 0.0}
+_profiles = dict()  # (stage, thread id) -> cProfile.Profile
+_active = set()     # (stage, thread id) of running profiles
+_totals = dict()    # stage -> {"calls", "seconds", "peak_bytes"}
+
+
+def enable(out_dir):
+    """
+    switch profiling on for this process and any process it starts
+
+    Parameters:
+    -----------
+    out_dir : string
+        directory to write the per-process results to
+    """
+    global _out_dir
+    out_dir = os.path.abspath(out_dir)
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    os.environ[ENV_VAR] = out_dir
+    _out_dir = out_dir
+
+
+def disable():
+    """switch profiling off, writing out what has been collected so far"""
+    global _out_dir
+    if _out_dir is not None:
+        dump()
+    os.environ.pop(ENV_VAR, None)
+    _out_dir = None
+
+
+def is_enabled():
+    """True if profiling is switched on"""
+    return _out_dir is not None
+
+
+def profiled(name):
+    """
+    decorator to profile every call to a function as the stage `name`
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if _out_dir is None:
+                return function(*args, **kwargs)
+            with stage(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def stage(name):
+    """
+    profile the body of a `with` block as the stage `name`, does nothing
+    when profiling is disabled
+    """
+    if _out_dir is None:
+        yield
+        return
+    _start_process()
+    stack = _stack()
+    key = (name, threading.get_ident())
+    with _lock:
+        profile = _profiles.get(key)
+        if profile is None:
+            profile = _profiles[key] = cProfile.Profile()
+        _active.add(key)
+    # only one profiler can run per thread, pause the enclosing stage's
+    parent = stack[-1] if stack else None
+    if parent is not None:
+        _profiles[parent["key"]].disable()
+        parent["peak"] = max(parent["peak"], tracemalloc.get_traced_memory()[1])
+    current = tracemalloc.get_traced_memory()[0]
+    tracemalloc.reset_peak()
+    stack.append({"key": key, "peak": 0, "nested": 0.0})
+    start = time.time()
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        elapsed = time.time() - start
+        frame = stack.pop()
+        seconds = elapsed - frame["nested"]
+        peak = max(frame["peak"], tracemalloc.get_traced_memory()[1])
+        with _lock:
+            if key not in [f["key"] for f in stack]:
+                _active.discard(key)
+            totals = _totals.setdefault(
+                name, {"calls": 0, "seconds": 0.0, "peak_bytes": 0})
+            totals["calls"] += 1
+            totals["seconds"] += seconds
+            totals["peak_bytes"] = max(totals["peak_bytes"], peak - current)
+        if parent is not None:
+            # the enclosing stage's peak includes this one, its time doesn't
+            parent["peak"] = max(parent["peak"], peak)
+            parent["nested"] += elapsed
+            _profiles[parent["key"]].enable()
+        elif time.time() - _state["last_dump"] > _DUMP_INTERVAL:
+            dump()
+
+
+def _stack():
+    """the stages running in this thread, innermost last"""
+    if not hasattr(_local, "stack"):
+        _local.stack = []
+    return _local.stack
+
+
+def _start_process():
+    """start tracemalloc and register exit hooks, once per process"""
+    pid = os.getpid()
+    if _state["pid"] == pid:
+        return
+    with _lock:
+        if _state["pid"] == pid:
+            return
+        if _state["pid"] is not None:
+            # forked from a profiled process, drop the parent's results
+            _profiles.clear()
+            _active.clear()
+            _totals.clear()
+            _local.stack = []
+        _state["pid"] = pid
+        _state["last_dump"] = time.time()
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+    atexit.register(dump)
+    # multiprocessing workers leave with os._exit, which skips atexit
+    util.Finalize(None, dump, exitpriority=0)
+
+
+def dump():
+    """write this process's results to the output directory"""
+    if _out_dir is None or _state["pid"] != os.getpid():
+        return
+    pid = os.getpid()
+    with _lock:
+        by_stage = dict()
+        for (name, ident), profile in _profiles.items():
+            # profiles running in other threads are written next time
+            if (name, ident) not in _active:
+                by_stage.setdefault(name, []).append(profile)
+        totals = json.dumps(_totals)
+        _state["last_dump"] = time.time()
+    for name, profiles in by_stage.items():
+        stats = pstats.Stats(profiles[0])
+        for profile in profiles[1:]:
+            stats.add(profile)
+        stats.dump_stats(os.path.join(_out_dir, "{}.{}.prof".format(name, pid)))
+    with open(os.path.join(_out_dir, "{}.json".format(pid)), "w") as f:
+        f.write(totals)
+
+
+def merge_report(out_dir=None, n_functions=20):
+    """
+    Combine the results of every process into one report, also written to
+    report.txt in the output directory.
+
+    Parameters:
+    -----------
+    out_dir : string (default = the enabled output directory)
+        directory the processes wrote their results to
+    n_functions : integer (default = 20)
+        number of functions to list per stage, by cumulative time
+
+    Returns:
+    --------
+    dictionary {stage: {"calls", "seconds", "peak_bytes", "processes",
+    "stats"}}, where seconds excludes the time of nested stages,
+    peak_bytes is the largest increase in traced memory during one call,
+    and stats is the merged pstats.Stats
+    """
+    out_dir = out_dir or _out_dir
+    if out_dir is None:
+        raise ValueError("profiling is not enabled and no out_dir was given")
+    if _state["pid"] == os.getpid():
+        dump()
+    report = dict()
+    for path in sorted(glob.glob(os.path.join(out_dir, "*.json"))):
+        with open(path) as f:
+            for name, totals in json.load(f).items():
+                merged = report.setdefault(
+                    name, {"calls": 0, "seconds": 0.0, "peak_bytes": 0,
+                           "processes": 0, "stats": None})
+                merged["calls"] += totals["calls"]
+                merged["seconds"] += totals["seconds"]
+                merged["peak_bytes"] = max(merged["peak_bytes"], totals["peak_bytes"])
+                merged["processes"] += 1
+    for path in sorted(glob.glob(os.path.join(out_dir, "*.prof"))):
+        name = os.path.basename(path).rsplit(".", 2)[0]
+        if name not in report:
+            continue
+        if report[name]["stats"] is None:
+            report[name]["stats"] = pstats.Stats(path)
+        else:
+            report[name]["stats"].add(path)
+    with open(os.path.join(out_dir, "report.txt"), "w") as f:
+        for name in sorted(report, key=lambda n: -report[n]["seconds"]):
+            merged = report[name]
+            f.write("{}: {} calls in {} processes, {:.3f} s, peak {:.1f} MB\n".format(
+                name, merged["calls"], merged["processes"], merged["seconds"],
+                merged["peak_bytes"] / 1e6))
+            if merged["stats"] is not None:
+                merged["stats"].stream = f
+                merged["stats"].sort_stats("cumulative").print_stats(n_functions)
+    return report
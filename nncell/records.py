@@ -0,0 +1,260 @@
+"""
+Sequential record files of crops, for training jobs that read data
+strictly in order rather than opening millions of small files.
+
+A shard file starts with MAGIC, followed by records of
+
+    length  : uint64, number of bytes in the payload
+    crc     : uint32, zlib.crc32 of the payload
+    payload : uint32 metadata length, JSON metadata (including the
+              label), then the array in .npy format
+
+Next to every shard, `<shard>.idx.npy` holds the (offset, length) of each
+record, so single records can be read without scanning the shard.
+"""
+
+import io
+import os
+import json
+import glob
+import random
+import struct
+import zlib
+import numpy as np
+from nncell import utils
+
+MAGIC = b"NNCREC1\n"
+RECORD_HEADER = struct.Struct("<QI")
+META_LENGTH = struct.Struct("<I")
+
+
+def encode_record(arr, label, metadata=None):
+    """payload bytes of one record"""
+    meta = dict(metadata or {})
+    meta["label"] = label
+    meta_bytes = json.dumps(meta).encode("utf-8")
+    buf = io.BytesIO()
+    buf.write(META_LENGTH.pack(len(meta_bytes)))
+    buf.write(meta_bytes)
+    np.lib.format.write_array(buf, np.asanyarray(arr), allow_pickle=False)
+    return buf.getvalue()
+
+
+def decode_record(payload):
+    """(array, label, metadata) from the payload bytes of one record"""
+    meta_length, = META_LENGTH.unpack_from(payload)
+    start = META_LENGTH.size
+    meta = json.loads(payload[start: start + meta_length].decode("utf-8"))
+    f = io.BytesIO(payload)
+    f.seek(start + meta_length)
+    shape, fortran_order, dtype, offset = utils.read_npy_header(f)
+    arr = np.frombuffer(payload, dtype=dtype, offset=offset,
+                        count=int(np.prod(shape)))
+    arr = arr.reshape(shape, order="F" if fortran_order else "C")
+    label = meta.pop("label")
+    return arr, label, meta
+
+
+class RecordWriter(object):
+    """
+    Write records to a series of shard files in `directory`, starting a new
+    shard once the current one reaches `shard_bytes`.
+
+    Parameters:
+    -----------
+    directory : string
+        directory to write shards to, created if it does not exist
+    prefix : string (default = "shard")
+        shard file names are <prefix>_<number>.rec
+    shard_bytes : integer (default = 1 GB)
+        size at which to start a new shard
+    """
+
+    def __init__(self, directory, prefix="shard", shard_bytes=2 ** 30):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.prefix = prefix
+        self.shard_bytes = shard_bytes
+        self.paths = []
+        self.n_records = 0
+        self._file = None
+        self._index = []
+
+
+    def write(self, arr, label, metadata=None):
+        """append one record"""
+        if self._file is None or self._file.tell() >= self.shard_bytes:
+            self._next_shard()
+        payload = encode_record(arr, label, metadata)
+        offset = self._file.tell()
+        self._file.write(RECORD_HEADER.pack(len(payload), zlib.crc32(payload)))
+        self._file.write(payload)
+        self._index.append((offset, RECORD_HEADER.size + len(payload)))
+        self.n_records += 1
+
+
+    def _next_shard(self):
+        self._close_shard()
+        path = os.path.join(self.directory, "{}_{:05d}.rec".format(
+            self.prefix, len(self.paths)))
+        self._file = open(path, "wb")
+        self._file.write(MAGIC)
+        self.paths.append(path)
+
+
+    def _close_shard(self):
+        """close the current shard and write its index"""
+        if self._file is None:
+            return
+        self._file.close()
+        self._file = None
+        index = np.asarray(self._index, dtype="int64").reshape(-1, 2)
+        np.save(self.paths[-1] + ".idx.npy", index)
+        self._index = []
+
+
+    def close(self):
+        self._close_shard()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+
+def list_shards(directory):
+    """sorted shard paths in directory"""
+    return sorted(glob.glob(os.path.join(directory, "*.rec")))
+
+
+def load_index(shard):
+    """(n, 2) array of the offset and length of each record in a shard"""
+    return np.load(shard + ".idx.npy")
+
+
+def read_record(shard, offset):
+    """(array, label, metadata) of the record at `offset` in a shard"""
+    with open(shard, "rb") as f:
+        f.seek(offset)
+        return _read_one(f, shard)
+
+
+def _read_one(f, shard):
+    """the next record in an open shard, None at the end"""
+    header = f.read(RECORD_HEADER.size)
+    if not header:
+        return None
+    if len(header) < RECORD_HEADER.size:
+        raise ValueError("truncated record header in {}".format(shard))
+    length, crc = RECORD_HEADER.unpack(header)
+    payload = f.read(length)
+    if len(payload) < length or zlib.crc32(payload) != crc:
+        raise ValueError("corrupt record in {}".format(shard))
+    return decode_record(payload)
+
+
+class RecordReader(object):
+    """
+    Stream records from shard files in order, with large buffered reads.
+
+    Shuffling uses a bounded buffer: records are read in order into a
+    buffer of `shuffle_buffer` records, and each new record replaces a
+    random one, which is yielded. Shard order is shuffled every pass.
+
+    Parameters:
+    -----------
+    shards : string or list of strings
+        directory of shards written by RecordWriter, or shard paths
+    shuffle_buffer : integer (default = 0)
+        number of records to shuffle between, 0 reads in order
+    read_size : integer (default = 16 MB)
+        bytes per read from each shard file
+    seed : integer (default = None)
+        random seed for shuffling
+    """
+
+    def __init__(self, shards, shuffle_buffer=0, read_size=16 * 2 ** 20,
+                 seed=None):
+        if isinstance(shards, str):
+            shards = list_shards(shards)
+        if not shards:
+            raise ValueError("no shards found")
+        self.shards = list(shards)
+        self.shuffle_buffer = shuffle_buffer
+        self.read_size = read_size
+        self.random_state = random.Random(seed)
+
+
+    def __len__(self):
+        return sum(len(load_index(shard)) for shard in self.shards)
+
+
+    def _records(self):
+        """every record of every shard, in shard order"""
+        shards = list(self.shards)
+        if self.shuffle_buffer:
+            self.random_state.shuffle(shards)
+        for shard in shards:
+            with open(shard, "rb", buffering=self.read_size) as f:
+                if f.read(len(MAGIC)) != MAGIC:
+                    raise ValueError("{} is not a record file".format(shard))
+                while True:
+                    record = _read_one(f, shard)
+                    if record is None:
+                        break
+                    yield record
+
+
+    def __iter__(self):
+        """one pass over the records, yielding (array, label, metadata)"""
+        if not self.shuffle_buffer:
+            for record in self._records():
+                yield record
+            return
+        buffer = []
+        for record in self._records():
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append(record)
+                continue
+            i = self.random_state.randrange(len(buffer))
+            buffer[i], record = record, buffer[i]
+            yield record
+        self.random_state.shuffle(buffer)
+        for record in buffer:
+            yield record
+
+
+    def batches(self, batch_size, class_names=None):
+        """
+        one pass over the records in batches of stacked arrays
+
+        Parameters:
+        -----------
+        batch_size : integer
+            records per batch, the last batch may be smaller
+        class_names : list (default = None)
+            if given, labels are returned as indices into class_names
+
+        Yields:
+        -------
+        (batch_x, labels, metadata) : stacked arrays, labels and a list of
+            metadata dictionaries
+        """
+        lookup = None
+        if class_names is not None:
+            lookup = {name: i for i, name in enumerate(class_names)}
+        arrays, labels, metas = [], [], []
+        for arr, label, meta in self:
+            arrays.append(arr)
+            labels.append(label if lookup is None else lookup[label])
+            metas.append(meta)
+            if len(arrays) == batch_size:
+                yield np.stack(arrays), np.asarray(labels), metas
+                arrays, labels, metas = [], [], []
+        if arrays:
+            yield np.stack(arrays), np.asarray(labels), metas
@@ -0,0 +1,203 @@
+"""
+Plate-ordered scheduling of per-field tasks for parallel prep.
+
+Images are stored in a directory per plate, often on network storage.
+Spreading the fields of a plate across every worker means every worker
+touches every plate directory, which defeats metadata caching and
+read-ahead. Instead tasks are sorted by plate, well and site and cut into
+chunks that never span plates, and idle workers pull the next chunk.
+
+Chunks start plate-sized and shrink towards the end of the schedule
+(guided self-scheduling), so the last plates are shared between workers
+rather than left to a single straggler.
+
+A memory budget for prep is shared between workers from an estimate of
+the peak memory of one task: the field as read and converted, nucleus
+detection, and the crops held at once. Fields with too many nuclei to fit
+their worker's share are cropped in chunks.
+"""
+
+import os
+import time
+import multiprocessing
+from functools import partial
+import numpy as np
+from nncell import chop
+
+
+def plan_chunks(metadata, n_workers, min_chunk=1):
+    """
+    Split tasks into plate-local chunks, in plate, well and site order.
+
+    Each chunk holds at most one plate. A chunk is the rest of its plate or
+    ceil(remaining / (2 * n_workers)) tasks, whichever is smaller, where
+    remaining is the number of tasks not yet assigned to a chunk, so the
+    chunks get smaller towards the end of the schedule.
+
+    Parameters:
+    -----------
+    metadata : pandas.DataFrame
+        one row per task with plate_name, plate_num, well and site columns,
+        see image_prep.ImageDict.parse_metadata
+    n_workers : integer
+        number of workers the chunks are shared between
+    min_chunk : integer (default = 1)
+        smallest number of tasks in a chunk, unless the plate has fewer
+
+    Returns:
+    --------
+    list of integer arrays, the row positions of the tasks in each chunk
+    """
+    if n_workers < 1:
+        raise ValueError("n_workers must be at least 1")
+    if min_chunk < 1:
+        raise ValueError("min_chunk must be at least 1")
+    keys = ["plate_name", "plate_num", "well", "site"]
+    order = metadata.reset_index(drop=True).sort_values(keys, kind="stable")
+    positions = order.index.values
+    plates = order[["plate_name", "plate_num"]].astype(str).agg("/".join, axis=1).values
+    # start of each run of the same plate
+    starts = np.flatnonzero(np.r_[True, plates[1:] != plates[:-1]])
+    ends = np.r_[starts[1:], len(positions)]
+    chunks = []
+    remaining = len(positions)
+    for start, end in zip(starts, ends):
+        while start < end:
+            size = max(min_chunk, -(-remaining // (2 * n_workers)))
+            stop = min(start + size, end)
+            chunks.append(positions[start:stop])
+            remaining -= stop - start
+            start = stop
+    return chunks
+
+
+def run_chunks(function, chunks, n_jobs=-1):
+    """
+    Call `function(chunk)` for every chunk in a pool of worker processes,
+    each worker pulling the next chunk as soon as it is free.
+
+    Parameters:
+    -----------
+    function : callable
+        picklable function of one chunk
+    chunks : list
+        chunks of tasks, e.g. from plan_chunks(). Anything with a length.
+    n_jobs : integer (default = -1)
+        number of worker processes, -1 for one per CPU
+
+    Returns:
+    --------
+    dictionary, the load on each worker, see load_report(), and the return
+    value of function for each chunk as "results", in the order the chunks
+    finished
+    """
+    if n_jobs < 1:
+        n_jobs = multiprocessing.cpu_count()
+    timed = partial(_timed_chunk, function)
+    pool = multiprocessing.Pool(n_jobs)
+    try:
+        # chunksize=1 so chunks are handed out one at a time, in order
+        results = list(pool.imap_unordered(timed, chunks, chunksize=1))
+    finally:
+        pool.close()
+        pool.join()
+    report = load_report([result[:3] for result in results])
+    report["results"] = [result[3] for result in results]
+    return report
+
+
+def _timed_chunk(function, chunk):
+    """run one chunk, returning (pid, number of tasks, seconds, result)"""
+    start = time.time()
+    result = function(chunk)
+    return os.getpid(), len(chunk), time.time() - start, result
+
+
+def load_report(results):
+    """
+    Per-worker load from the (pid, tasks, seconds) of each chunk.
+
+    Returns:
+    --------
+    dictionary with
+        workers : {pid: {"chunks", "tasks", "seconds"}} for every worker
+            that ran a chunk
+        imbalance : busiest worker's seconds over the mean, 1.0 is perfectly
+            balanced
+    """
+    workers = dict()
+    for pid, n_tasks, seconds in results:
+        load = workers.setdefault(pid, {"chunks": 0, "tasks": 0, "seconds": 0.0})
+        load["chunks"] += 1
+        load["tasks"] += n_tasks
+        load["seconds"] += seconds
+    busy = [load["seconds"] for load in workers.values()]
+    if busy and np.mean(busy) > 0:
+        imbalance = float(max(busy) / np.mean(busy))
+    else:
+        imbalance = 1.0
+    return {"workers": workers, "imbalance": imbalance}
+
+
+def estimate_task_bytes(field_shape, size, n_nuclei, source_itemsize=2,
+                        itemsize=1, resize_to=None, **kwargs):
+    """
+    Approximate peak memory of chopping one field.
+
+    Parameters:
+    -----------
+    field_shape : tuple
+        (height, width, channels) of the converted field
+    size : integer or list of integers
+        crop sizes, see chop.chop_nuclei
+    n_nuclei : integer
+        number of nuclei cropped at once
+    source_itemsize : integer (default = 2)
+        bytes per pixel of the channel images as read, 2 for 16-bit images
+    itemsize : integer (default = 1)
+        bytes per pixel per channel of the converted field
+    resize_to : integer or tuple (default = None)
+        size the crops are resized to
+    **kwargs : arguments to chop.chop_nuclei, for the detection scales
+
+    Returns:
+    --------
+    integer, bytes
+    """
+    pixels = field_shape[0] * field_shape[1]
+    n_channels = field_shape[2] if len(field_shape) > 2 else 1
+    # channel images as read and stacked, and the converted field
+    field = pixels * n_channels * (2 * source_itemsize + itemsize)
+    crops = n_nuclei * chop.crop_bytes(size, n_channels, itemsize, resize_to)
+    return int(field + chop.detection_bytes(field_shape, **kwargs) + crops)
+
+
+def nuclei_per_chunk(memory_budget, field_shape, size, source_itemsize=2,
+                     itemsize=1, resize_to=None, **kwargs):
+    """
+    number of nuclei that can be cropped at once from a field within
+    `memory_budget` bytes, at least 1. See estimate_task_bytes()
+    """
+    n_channels = field_shape[2] if len(field_shape) > 2 else 1
+    fixed = estimate_task_bytes(field_shape, size, 0, source_itemsize,
+                                itemsize, resize_to, **kwargs)
+    per_nucleus = chop.crop_bytes(size, n_channels, itemsize, resize_to)
+    return int(max(1, (memory_budget - fixed) // per_nucleus))
+
+
+def workers_for_budget(memory_budget, task_bytes, n_jobs=-1):
+    """
+    number of workers, at most n_jobs (-1 for one per CPU), whose tasks of
+    `task_bytes` each fit in `memory_budget` bytes together
+
+    Raises:
+    -------
+    ValueError if a single task doesn't fit
+    """
+    if n_jobs < 1:
+        n_jobs = multiprocessing.cpu_count()
+    n_workers = int(memory_budget // task_bytes)
+    if n_workers < 1:
+        raise ValueError("memory_budget of {} bytes is too small for one "
+                         "task of {} bytes".format(memory_budget, task_bytes))
+    return min(n_jobs, n_workers)
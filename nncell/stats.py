@@ -0,0 +1,215 @@
+"""
+Per-channel normalisation statistics of a prepared dataset, computed in a
+single streaming pass without loading the dataset into memory.
+
+Files are processed in chunks, each reduced to per-channel count, mean,
+sum of squared deviations and a histogram. Chunk results are merged with
+the parallel variance formula of Chan et al., so chunks can be spread
+across worker processes.
+"""
+
+import multiprocessing
+import numpy as np
+from nncell import preprocessing
+
+
+class ChannelStats(object):
+    """
+    Running per-channel statistics which can be updated with arrays and
+    merged with other ChannelStats.
+
+    Parameters:
+    -----------
+    n_channels : Integer
+        number of channels, the last axis of the data
+    value_range : tuple (low, high)
+        range of the histogram used for percentiles
+    bins : Integer
+        number of histogram bins across value_range
+    """
+
+    def __init__(self, n_channels, value_range, bins):
+        self.n_channels = n_channels
+        self.value_range = tuple(value_range)
+        self.bins = bins
+        self.count = 0
+        self.mean = np.zeros(n_channels, dtype="float64")
+        self.m2 = np.zeros(n_channels, dtype="float64")
+        self.min = np.full(n_channels, np.inf)
+        self.max = np.full(n_channels, -np.inf)
+        self.hist = np.zeros((n_channels, bins), dtype="int64")
+
+
+    @property
+    def std(self):
+        """population standard deviation of each channel"""
+        if self.count == 0:
+            return np.full(self.n_channels, np.nan)
+        return np.sqrt(self.m2 / self.count)
+
+
+    def update(self, arr):
+        """add an array of shape (..., n_channels)"""
+        values = np.asarray(arr).reshape(-1, self.n_channels)
+        other = ChannelStats(self.n_channels, self.value_range, self.bins)
+        other.count = len(values)
+        if other.count == 0:
+            return self
+        values = values.astype("float64")
+        other.mean = values.mean(axis=0)
+        other.m2 = ((values - other.mean) ** 2).sum(axis=0)
+        other.min = values.min(axis=0)
+        other.max = values.max(axis=0)
+        low, high = self.value_range
+        # bin index of every value, clipped into the end bins
+        index = np.floor((values - low) * (self.bins / float(high - low)))
+        index = np.clip(index, 0, self.bins - 1).astype("int64")
+        for c in range(self.n_channels):
+            other.hist[c] = np.bincount(index[:, c], minlength=self.bins)
+        return self.merge(other)
+
+
+    def merge(self, other):
+        """combine with the statistics of another ChannelStats, in place"""
+        if other.count == 0:
+            return self
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean = self.mean + delta * (other.count / float(count))
+        self.m2 = self.m2 + other.m2 + delta ** 2 * (
+            self.count * other.count / float(count))
+        self.count = count
+        self.min = np.minimum(self.min, other.min)
+        self.max = np.maximum(self.max, other.max)
+        self.hist += other.hist
+        return self
+
+
+    def percentiles(self, q):
+        """
+        per-channel percentiles from the histogram, accurate to one bin width
+
+        Parameters:
+        -----------
+        q : list of numbers
+            percentiles between 0 and 100
+
+        Returns:
+        --------
+        array of shape (len(q), n_channels)
+        """
+        low, high = self.value_range
+        width = (high - low) / float(self.bins)
+        cumulative = np.cumsum(self.hist, axis=1)
+        # smallest bin holding at least q% of the values, and at least one,
+        # so q=0 is the minimum rather than the bottom of value_range
+        target = np.maximum(np.asarray(q, dtype="float64") / 100.0 * self.count, 1)
+        out = np.empty((len(q), self.n_channels), dtype="float64")
+        for c in range(self.n_channels):
+            index = np.searchsorted(cumulative[c], target)
+            out[:, c] = low + np.minimum(index, self.bins - 1) * width
+        return out
+
+
+    def save(self, path):
+        """save to a .npz file"""
+        np.savez(path, count=self.count, mean=self.mean, m2=self.m2,
+                 min=self.min, max=self.max, hist=self.hist,
+                 value_range=np.asarray(self.value_range))
+
+
+    @classmethod
+    def load(cls, path):
+        """load from a .npz file written by save()"""
+        with np.load(path) as data:
+            hist = data["hist"]
+            stats = cls(hist.shape[0], tuple(data["value_range"]), hist.shape[1])
+            stats.count = int(data["count"])
+            stats.mean = data["mean"]
+            stats.m2 = data["m2"]
+            stats.min = data["min"]
+            stats.max = data["max"]
+            stats.hist = hist
+        return stats
+
+
+
+def default_range(dtype):
+    """histogram value range and bins for data of `dtype`"""
+    dtype = np.dtype(dtype)
+    if dtype.kind in "ui":
+        info = np.iinfo(dtype)
+        n_values = int(info.max) - int(info.min) + 1
+        # one bin per value, up to 16 bits
+        return (int(info.min), int(info.max) + 1), min(n_values, 2 ** 16)
+    raise ValueError("value_range must be given for {} data".format(dtype))
+
+
+def _chunk_stats(args):
+    """ChannelStats of one chunk of files"""
+    paths, n_channels, value_range, bins = args
+    values = [preprocessing._read_sample(path).reshape(-1, n_channels)
+              for path in paths]
+    # one vectorized update per chunk rather than per file
+    return ChannelStats(n_channels, value_range, bins).update(np.concatenate(values))
+
+
+def channel_stats(directory, n_jobs=1, chunk_size=256, value_range=None,
+                  bins=None, follow_links=False):
+    """
+    Per-channel count, mean, standard deviation, min, max and histogram of
+    every sample in a prepared dataset, in one streaming pass.
+
+    Parameters:
+    -----------
+    directory : string or list of strings
+        dataset directory, as read by DirectoryIterator, or a list of
+        sample file paths
+    n_jobs : Integer (default = 1)
+        number of worker processes, -1 for one per CPU
+    chunk_size : Integer (default = 256)
+        number of files reduced by a worker at a time
+    value_range : tuple (low, high) (default = None)
+        histogram range for percentiles. Inferred for integer data, must be
+        given for float data.
+    bins : Integer (default = None)
+        number of histogram bins, one per value for integer data by default,
+        otherwise 1000
+    follow_links : Boolean (default = False)
+        follow symbolic links when listing directory
+
+    Returns:
+    --------
+    ChannelStats, use .mean, .std and .percentiles([1, 50, 99])
+    """
+    if isinstance(directory, str):
+        paths = list(preprocessing.iter_files(directory, follow_links))
+    else:
+        paths = list(directory)
+    if not paths:
+        raise ValueError("no samples found")
+    first = preprocessing._read_sample(paths[0])
+    n_channels = first.shape[2] if first.ndim == 3 else 1
+    if value_range is None:
+        value_range, default_bins = default_range(first.dtype)
+    else:
+        default_bins = 1000
+    bins = default_bins if bins is None else bins
+    chunks = [(paths[i: i + chunk_size], n_channels, value_range, bins)
+              for i in range(0, len(paths), chunk_size)]
+    if n_jobs < 1:
+        n_jobs = multiprocessing.cpu_count()
+    stats = ChannelStats(n_channels, value_range, bins)
+    if n_jobs == 1:
+        for chunk in chunks:
+            stats.merge(_chunk_stats(chunk))
+    else:
+        pool = multiprocessing.Pool(n_jobs)
+        try:
+            # merged in order so the result doesn't depend on scheduling
+            for chunk_result in pool.imap(_chunk_stats, chunks):
+                stats.merge(chunk_result)
+        finally:
+            pool.close()
+            pool.join()
+    return stats
@@ -0,0 +1,230 @@
+"""
+Per-nucleus tables: the field, plate, well, site, class and position of
+every cropped nucleus, for quality control and for joining crops with
+other per-cell features.
+
+Rows are buffered and written out in parts of `rows_per_part` rows, so
+memory use doesn't grow with the size of the screen. Every writer, e.g.
+one per worker, writes its own parts to a shared directory, and
+merge_parts() combines them into one table, one part at a time.
+
+Tables are Parquet files if pyarrow is installed, otherwise .npz files of
+one compressed array per column.
+"""
+
+import os
+import glob
+import uuid
+import zipfile
+import numpy as np
+import pandas as pd
+from nncell import utils
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# per-field columns, then per-nucleus columns
+FIELD_COLUMNS = ["img_url", "plate_name", "plate_num", "well", "site",
+                 "group", "class"]
+COLUMNS = FIELD_COLUMNS + ["nucleus", "crop", "x", "y", "sigma"]
+
+
+def default_format():
+    """"parquet" if pyarrow is installed, otherwise "npz" """
+    return "npz" if pyarrow is None else "parquet"
+
+
+class NucleusTableWriter(object):
+    """
+    Write rows of COLUMNS to part files in `directory`, `rows_per_part` rows
+    at a time.
+
+    Parameters:
+    -----------
+    directory : string
+        directory to write parts to, created if it does not exist
+    rows_per_part : integer (default = 100000)
+        number of rows buffered before a part is written
+    fmt : string (default = None)
+        "parquet" or "npz", defaults to default_format()
+    """
+
+    def __init__(self, directory, rows_per_part=100000, fmt=None):
+        fmt = fmt or default_format()
+        if fmt not in ("parquet", "npz"):
+            raise ValueError("fmt must be 'parquet' or 'npz'")
+        if fmt == "parquet" and pyarrow is None:
+            raise ValueError("writing parquet needs pyarrow")
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.rows_per_part = rows_per_part
+        self.fmt = fmt
+        self.paths = []
+        self.n_rows = 0
+        # unique per writer, so writers in different processes never clash
+        self._prefix = "part_{}".format(uuid.uuid4().hex)
+        self._columns = {column: [] for column in COLUMNS}
+        self._n_buffered = 0
+
+
+    def add(self, field, nuclei, crops, blobs):
+        """
+        add the rows of the nuclei of one field
+
+        Parameters:
+        -----------
+        field : dictionary
+            value of each of FIELD_COLUMNS for the field
+        nuclei : array-like
+            index of each nucleus within its field
+        crops : list of strings
+            crop file name of each nucleus, without the extension
+        blobs : numpy.array
+            (n, 3) array of the (x, y, sigma) of each nucleus, see
+            chop.find_nuclei
+        """
+        n = len(nuclei)
+        if n == 0:
+            return
+        blobs = np.asarray(blobs, dtype="float64").reshape(n, 3)
+        for column in FIELD_COLUMNS:
+            self._columns[column].append(np.full(n, str(field[column])))
+        self._columns["nucleus"].append(np.asarray(nuclei, dtype="int64"))
+        self._columns["crop"].append(np.asarray(crops, dtype=str))
+        for i, column in enumerate(["x", "y", "sigma"]):
+            self._columns[column].append(blobs[:, i])
+        self._n_buffered += n
+        if self._n_buffered >= self.rows_per_part:
+            self.flush()
+
+
+    def flush(self):
+        """write the buffered rows to a new part"""
+        if self._n_buffered == 0:
+            return
+        columns = {column: np.concatenate(arrays)
+                   for column, arrays in self._columns.items()}
+        path = os.path.join(self.directory, "{}_{:05d}.{}".format(
+            self._prefix, len(self.paths), self.fmt))
+        _write(columns, path, self.fmt)
+        self.paths.append(path)
+        self.n_rows += self._n_buffered
+        self._columns = {column: [] for column in COLUMNS}
+        self._n_buffered = 0
+
+
+    def close(self):
+        self.flush()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+
+def _write(columns, path, fmt):
+    """write a dictionary of equal length column arrays to path"""
+    # write then rename, so a part is never seen half written
+    tmp_path = path + ".tmp"
+    if fmt == "parquet":
+        table = pyarrow.table({name: columns[name] for name in COLUMNS})
+        pyarrow.parquet.write_table(table, tmp_path)
+    else:
+        with open(tmp_path, "wb") as f:
+            np.savez_compressed(f, **columns)
+    os.replace(tmp_path, path)
+
+
+def list_parts(directory):
+    """sorted part paths in directory"""
+    parts = glob.glob(os.path.join(directory, "part_*.parquet"))
+    parts += glob.glob(os.path.join(directory, "part_*.npz"))
+    return sorted(parts)
+
+
+def merge_parts(directory, out_path=None, remove=True):
+    """
+    Combine the parts in directory into one table, reading one part at a
+    time.
+
+    Parameters:
+    -----------
+    directory : string
+        directory the parts were written to
+    out_path : string (default = directory/nuclei.<format>)
+        path of the merged table
+    remove : Boolean (default = True)
+        delete the parts once they are merged
+
+    Returns:
+    --------
+    path of the merged table, None if there were no parts
+    """
+    parts = list_parts(directory)
+    if not parts:
+        return None
+    fmt = os.path.splitext(parts[0])[1][1:]
+    if any(not part.endswith("." + fmt) for part in parts):
+        raise ValueError("parts in {} are of different formats".format(directory))
+    if out_path is None:
+        out_path = os.path.join(directory, "nuclei.{}".format(fmt))
+    tmp_path = out_path + ".tmp"
+    if fmt == "parquet":
+        _merge_parquet(parts, tmp_path)
+    else:
+        _merge_npz(parts, tmp_path)
+    os.replace(tmp_path, out_path)
+    if remove:
+        for part in parts:
+            os.remove(part)
+    return out_path
+
+
+def _merge_parquet(parts, out_path):
+    schema = pyarrow.parquet.read_schema(parts[0])
+    with pyarrow.parquet.ParquetWriter(out_path, schema) as writer:
+        for part in parts:
+            writer.write_table(pyarrow.parquet.read_table(part, schema=schema))
+
+
+def _merge_npz(parts, out_path):
+    # length and widest dtype of each column, from the array headers only
+    n_rows = 0
+    dtypes = dict()
+    for part in parts:
+        with zipfile.ZipFile(part) as zf:
+            for name in zf.namelist():
+                with zf.open(name) as f:
+                    shape, _, dtype, _ = utils.read_npy_header(f)
+                column = name[:-len(".npy")]
+                dtypes[column] = np.promote_types(dtypes.get(column, dtype), dtype)
+        n_rows += shape[0]
+    # stream each column into the output, one part at a time
+    with zipfile.ZipFile(out_path, "w", zipfile.ZIP_DEFLATED,
+                         allowZip64=True) as out:
+        for column in COLUMNS:
+            header = {"descr": np.lib.format.dtype_to_descr(dtypes[column]),
+                      "fortran_order": False, "shape": (n_rows, )}
+            with out.open(column + ".npy", "w", force_zip64=True) as f:
+                np.lib.format.write_array_header_2_0(f, header)
+                for part in parts:
+                    with np.load(part) as data:
+                        f.write(data[column].astype(dtypes[column]).tobytes())
+
+
+def read_table(path):
+    """a table written by NucleusTableWriter or merge_parts, as a DataFrame"""
+    if path.endswith(".parquet"):
+        if pyarrow is None:
+            raise ValueError("reading parquet needs pyarrow")
+        return pyarrow.parquet.read_table(path).to_pandas()
+    with np.load(path) as data:
+        return pd.DataFrame({column: data[column] for column in COLUMNS})
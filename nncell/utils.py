@@ -1,6 +1,11 @@
 import os
+import zipfile
 import numpy as np
 
+
+# compression options for save_array
+COMPRESSION = {"zlib": zipfile.ZIP_DEFLATED, "lzma": zipfile.ZIP_LZMA}
+
 def is_full_path(path):
     """determines if URL is a full path or just a file name"""
     num_splits = len(path.split(os.sep))
@@ -22,8 +27,73 @@ def make_dir(directory):
             raise RuntimeError(err_msg)
 
 
-def softmax(results):
-    results = np.asarray(results)
-    exp_r = np.exp(results)
-    return exp_r / exp_r.sum()
+def softmax(results, axis=-1):
+    """
+    softmax along an axis, by default the last so a batch of (n, classes)
+    logits gives a row of probabilities per sample
+
+    the maximum along the axis is subtracted before exponentiating, so
+    large logits don't overflow
+    """
+    results = np.asarray(results, dtype="float64")
+    exp_r = np.exp(results - results.max(axis=axis, keepdims=True))
+    return exp_r / exp_r.sum(axis=axis, keepdims=True)
+
+
+def save_array(path, arr, compress=None):
+    """
+    save an array as .npy, or as a single-array compressed .npz
+
+    Parameters:
+    -----------
+    path : string
+        path to save to, without a file extension
+    arr : np.ndarray
+        array to save
+    compress : None, True, "zlib" or "lzma" (default = None)
+        None or False saves an uncompressed .npy. Otherwise the array is
+        saved in a .npz compressed with zlib (True or "zlib") or lzma.
+
+    Returns:
+    --------
+    path to the saved file, including the extension
+    """
+    if not compress:
+        full_path = path + ".npy"
+        np.save(full_path, arr, allow_pickle=False)
+        return full_path
+    if compress is True:
+        compress = "zlib"
+    if compress not in COMPRESSION:
+        raise ValueError("unknown compress argument. options: {}".format(
+            sorted(COMPRESSION)))
+    full_path = path + ".npz"
+    with zipfile.ZipFile(full_path, "w", compression=COMPRESSION[compress]) as zf:
+        with zf.open("arr.npy", "w", force_zip64=True) as f:
+            np.lib.format.write_array(f, np.asanyarray(arr), allow_pickle=False)
+    return full_path
+
+
+def load_array(path):
+    """load an array saved with save_array, either .npy or .npz"""
+    if path.endswith(".npz"):
+        with np.load(path) as data:
+            return data[data.files[0]]
+    return np.load(path)
+
+
+def read_npy_header(f):
+    """
+    shape, fortran order, dtype and data offset of the .npy file object f,
+    from its header
 
+    Raises:
+    -------
+    ValueError if the header is not valid
+    """
+    version = np.lib.format.read_magic(f)
+    if version == (1, 0):
+        shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+    else:
+        shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+    return shape, fortran_order, dtype, f.tell()
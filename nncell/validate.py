@@ -0,0 +1,233 @@
+"""
+Integrity checks for prepared datasets, without loading any array data.
+
+For .npy files only the header is read: the shape, dtype and data offset
+give the expected file size, which is compared with the size on disk to
+catch truncated files. For .npz files the zip central directory and the
+header of the array inside it are read. Images are checked for a non-empty
+file, and .png files for a complete final chunk.
+
+Files are checked by a pool of threads, as the work is almost all waiting
+on the file system, and results are aggregated as they arrive, so memory
+use depends on the number of bad files rather than the size of the dataset.
+
+    python -m nncell.validate <directory> [--shape 100 100 3] [--quarantine <dir>]
+"""
+
+import os
+import shutil
+import zipfile
+import argparse
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from nncell import preprocessing
+from nncell import utils
+
+# last 12 bytes of every complete png: empty IEND chunk and its crc
+PNG_END = b"\x00\x00\x00\x00IEND\xaeB`\x82"
+
+
+def check_file(path):
+    """
+    Check one sample file without reading its array data.
+
+    Returns:
+    --------
+    (problem, shape, dtype) where problem is None for a valid file,
+    "missing", or "corrupt: <reason>". shape and dtype are None unless the
+    file is a valid array.
+    """
+    if not os.path.exists(path):
+        return "missing", None, None
+    try:
+        ext = os.path.splitext(path)[1].lower()
+        if ext == ".npy":
+            with open(path, "rb") as f:
+                shape, _, dtype, offset = utils.read_npy_header(f)
+            expected = offset + _nbytes(shape, dtype)
+            size = os.path.getsize(path)
+            if size != expected:
+                return ("corrupt: {} bytes, expected {}".format(size, expected),
+                        None, None)
+            return None, shape, dtype.str
+        if ext == ".npz":
+            with zipfile.ZipFile(path) as zf:
+                info = zf.infolist()[0]
+                with zf.open(info) as f:
+                    shape, _, dtype, offset = utils.read_npy_header(f)
+            expected = offset + _nbytes(shape, dtype)
+            if info.file_size != expected:
+                return ("corrupt: {} bytes, expected {}".format(
+                    info.file_size, expected), None, None)
+            return None, shape, dtype.str
+        size = os.path.getsize(path)
+        if size == 0:
+            return "corrupt: empty file", None, None
+        if ext == ".png":
+            with open(path, "rb") as f:
+                f.seek(max(size - len(PNG_END), 0))
+                if f.read() != PNG_END:
+                    return "corrupt: truncated png", None, None
+        return None, None, None
+    except (ValueError, OSError, IndexError, zipfile.BadZipFile, EOFError) as err:
+        return "corrupt: {}".format(err), None, None
+
+
+def _nbytes(shape, dtype):
+    if dtype.hasobject:
+        raise ValueError("object arrays are not supported")
+    return int(np.prod(shape, dtype="int64")) * dtype.itemsize
+
+
+def _check_chunk(paths):
+    """(path, problem, shape, dtype) of each path in a chunk"""
+    return [(path, ) + check_file(path) for path in paths]
+
+
+def _chunks(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def validate(directory, shape=None, dtype=None, n_threads=16,
+             chunk_size=1024, quarantine=None, follow_links=False):
+    """
+    Check every sample of a prepared dataset without loading array data.
+
+    Parameters:
+    -----------
+    directory : string or list of strings
+        dataset directory, as written by the create_directories methods,
+        or a list of sample paths. Paths in the list that do not exist are
+        reported as missing.
+    shape : tuple (default = None)
+        expected shape of every array. Defaults to the shape of the first
+        valid array.
+    dtype : numpy dtype (default = None)
+        expected dtype of every array. Defaults to the dtype of the first
+        valid array.
+    n_threads : Integer (default = 16)
+        number of files checked at once
+    chunk_size : Integer (default = 1024)
+        number of files checked per task
+    quarantine : string (default = None)
+        if given, move every corrupt or mis-shaped file to this directory,
+        keeping its path relative to `directory`
+    follow_links : Boolean (default = False)
+        follow symbolic links when listing directory
+
+    Returns:
+    --------
+    dictionary with
+        n_files : number of files checked
+        counts : {class: number of valid samples}, where the class is the
+            directory of the sample, relative to `directory`
+        shapes : {(shape, dtype): number of arrays}
+        corrupt : list of (path, reason)
+        missing : list of paths
+        misshaped : list of (path, shape, dtype)
+        quarantined : list of the new paths of quarantined files
+    """
+    if isinstance(directory, str):
+        root = directory
+        paths = preprocessing.iter_files(directory, follow_links)
+    else:
+        paths = list(directory)
+        root = os.path.commonpath([os.path.dirname(p) for p in paths]) if paths else ""
+    if dtype is not None:
+        dtype = np.dtype(dtype).str
+    report = {"n_files": 0, "counts": Counter(), "shapes": Counter(),
+              "corrupt": [], "missing": [], "misshaped": [], "quarantined": []}
+    expected = [None if shape is None else tuple(shape), dtype]
+    with ThreadPoolExecutor(n_threads) as executor:
+        pending = []
+        chunks = _chunks(paths, chunk_size)
+        # keep a bounded number of chunks in flight, so the file listing is
+        # never held in memory
+        for chunk in chunks:
+            pending.append(executor.submit(_check_chunk, chunk))
+            if len(pending) >= 2 * n_threads:
+                _collect(pending.pop(0).result(), root, expected, report)
+        for future in pending:
+            _collect(future.result(), root, expected, report)
+    report["counts"] = dict(report["counts"])
+    report["shapes"] = dict(report["shapes"])
+    if quarantine is not None:
+        bad = [p for p, _ in report["corrupt"]] + [p for p, _, _ in report["misshaped"]]
+        report["quarantined"] = _quarantine(bad, root, quarantine)
+    return report
+
+
+def _collect(results, root, expected, report):
+    """add the results of one chunk to the report"""
+    for path, problem, shape, dtype in results:
+        report["n_files"] += 1
+        if problem == "missing":
+            report["missing"].append(path)
+            continue
+        if problem is not None:
+            report["corrupt"].append((path, problem))
+            continue
+        if shape is not None:
+            report["shapes"][(shape, dtype)] += 1
+            if expected[0] is None:
+                expected[0] = shape
+            if expected[1] is None:
+                expected[1] = dtype
+            if shape != expected[0] or dtype != expected[1]:
+                report["misshaped"].append((path, shape, dtype))
+                continue
+        label = os.path.relpath(os.path.dirname(path), root) if root else ""
+        report["counts"][label] += 1
+
+
+def _quarantine(paths, root, quarantine):
+    """move paths under the quarantine directory, returns the new paths"""
+    moved = []
+    for path in paths:
+        rel = os.path.relpath(path, root) if root else os.path.basename(path)
+        if rel.startswith(os.pardir):
+            rel = os.path.basename(path)
+        new_path = os.path.join(quarantine, rel)
+        if not os.path.isdir(os.path.dirname(new_path)):
+            os.makedirs(os.path.dirname(new_path))
+        shutil.move(path, new_path)
+        moved.append(new_path)
+    return moved
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("directory", help="prepared dataset directory")
+    parser.add_argument("--shape", nargs="*", type=int, default=None,
+                        help="expected array shape")
+    parser.add_argument("--n-threads", type=int, default=16)
+    parser.add_argument("--quarantine", default=None,
+                        help="directory to move bad files to")
+    args = parser.parse_args()
+    report = validate(args.directory, shape=args.shape,
+                      n_threads=args.n_threads, quarantine=args.quarantine)
+    for label, count in sorted(report["counts"].items()):
+        print("{}: {}".format(label, count))
+    for path, reason in report["corrupt"]:
+        print("corrupt {} ({})".format(path, reason))
+    for path in report["missing"]:
+        print("missing {}".format(path))
+    for path, shape, dtype in report["misshaped"]:
+        print("misshaped {} {} {}".format(path, shape, dtype))
+    print("{} files, {} corrupt, {} missing, {} misshaped".format(
+        report["n_files"], len(report["corrupt"]), len(report["missing"]),
+        len(report["misshaped"])))
+    if report["corrupt"] or report["missing"] or report["misshaped"]:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -7,11 +7,14 @@ setup(name="nncell",
       author="Scott Warchal",
       license="MIT",
       packages=["nncell"],
+      python_requires=">=3.9",
       tests_require=["pytest"],
       dependency_links=["https://github.com/swarchal/parserix/tarball/master#egg=parserix-0.1"],
       install_requires=["pandas>=0.16",
                         "numpy>=1.0",
+                        "scipy",
                         "scikit-image>=0.12",
                         "parserix>=0.1",
                         "joblib>=0.10.0"],
+      extras_require={"parquet": ["pyarrow"]},
       zip_safe=False)
@@ -140,3 +140,143 @@ def test_chop_nuclei_multi_keeps_dims():
         assert img.ndim == 3
         assert img.shape == (300, 300, 3)
 
+
+
+def test_box_origins_matches_crop_to_box():
+    arr = np.arange(200 * 150).reshape([200, 150])
+    coords = np.array([[50, 50], [0, 0], [199, 149], [100, 3], [5, 140]])
+    for edge in ["keep", "remove"]:
+        origins, kept = chop.box_origins(coords, arr.shape, 20, edge)
+        boxes = chop.crop_boxes(arr, origins, 20)
+        expected = [chop.crop_to_box(x, y, arr, 20, edge) for x, y in coords]
+        expected = [box for box in expected if box is not None]
+        assert kept.sum() == len(boxes) == len(expected)
+        for box, expected_box in zip(boxes, expected):
+            assert (box == expected_box).all()
+
+
+def test_chop_nuclei_no_nuclei():
+    with pytest.raises(ValueError):
+        chop.chop_nuclei(np.zeros((200, 200)), size=20)
+
+
+def test_resize_crops_block_mean():
+    crops = np.arange(2 * 4 * 4 * 3).reshape([2, 4, 4, 3]).astype("float32")
+    out = chop.resize_crops(crops, 2)
+    assert out.shape == (2, 2, 2, 3)
+    assert out[0, 0, 0, 0] == crops[0, :2, :2, 0].mean()
+    assert out[1, 1, 0, 2] == crops[1, 2:, :2, 2].mean()
+
+
+def test_resize_crops_keeps_dtype_and_falls_back():
+    crops = np.full([3, 10, 10], 7, dtype="uint8")
+    # 10 -> 4 is not an integer factor
+    out = chop.resize_crops(crops, (4, 4))
+    assert out.dtype == np.uint8
+    assert out.shape == (3, 4, 4)
+    assert (out == 7).all()
+
+
+def test_dedupe_nuclei_keeps_largest():
+    blobs = np.array([[10, 10, 2.0],
+                      [11, 10, 4.0],   # duplicate of the first, larger
+                      [50, 50, 3.0],
+                      [52, 51, 1.0],   # duplicate of the third, smaller
+                      [90, 10, 1.0]])
+    out = chop.dedupe_nuclei(blobs, radius=5)
+    assert out.tolist() == [[11, 10, 4.0], [50, 50, 3.0], [90, 10, 1.0]]
+    # nothing within radius, nothing removed
+    assert len(chop.dedupe_nuclei(blobs, radius=0.5)) == len(blobs)
+
+
+def test_dedupe_nuclei_keeps_strongest():
+    img = np.zeros((100, 100))
+    img[10, 10] = 1.0
+    blobs = np.array([[10, 10, 2.0], [11, 10, 4.0]])
+    out = chop.dedupe_nuclei(blobs, radius=5, keep="strongest", img=img)
+    assert out.tolist() == [[10, 10, 2.0]]
+    with pytest.raises(ValueError):
+        chop.dedupe_nuclei(blobs, radius=5, keep="strongest")
+
+
+def test_dedupe_nuclei_keeps_strongest_unsigned():
+    img = np.zeros((100, 100), dtype="uint8")
+    img[10, 10] = 200
+    img[30, 30] = 50
+    blobs = np.array([[10, 10, 2.0], [11, 10, 4.0], [30, 30, 1.0]])
+    out = chop.dedupe_nuclei(blobs, radius=5, keep="strongest", img=img)
+    assert out.tolist() == [[10, 10, 2.0], [30, 30, 1.0]]
+
+
+def test_chop_nuclei_multiple_sizes():
+    # bright spots, one close to the edge
+    img = np.zeros((200, 200, 2))
+    yy, xx = np.mgrid[:200, :200]
+    for x, y in [(60, 60), (140, 100), (100, 15)]:
+        img[..., 0] += np.exp(-((xx - y) ** 2 + (yy - x) ** 2) / 50.0)
+    img[..., 1] = np.arange(200)[:, None]
+    single = chop.chop_nuclei(img, size=40, edge="remove")
+    crops = chop.chop_nuclei(img, size=[20, 40], edge="remove")
+    assert sorted(crops.keys()) == [20, 40]
+    assert crops[20].shape[1:] == (20, 20, 2)
+    assert crops[40].shape[1:] == (40, 40, 2)
+    # same nuclei, in the same order, at every size
+    assert len(crops[20]) == len(crops[40]) == len(single)
+    np.testing.assert_array_equal(crops[40], single)
+    np.testing.assert_array_equal(crops[20][:, 10, 10, 1],
+                                  crops[40][:, 20, 20, 1])
+    # the nucleus near the edge fits at 20 but not at 40
+    kept = chop.chop_nuclei(img, size=20, edge="remove")
+    assert len(kept) == len(crops[20]) + 1
+
+
+def test_iter_crops_chunks():
+    img = np.zeros((200, 200, 2))
+    yy, xx = np.mgrid[:200, :200]
+    for x, y in [(30, 30), (30, 170), (100, 100), (170, 30), (170, 170)]:
+        img[..., 0] += np.exp(-((xx - y) ** 2 + (yy - x) ** 2) / 50.0)
+    img[..., 1] = np.arange(200)[:, None]
+    crops = chop.chop_nuclei(img, size=[20, 40])
+    chunks = list(chop.iter_crops(img, size=[20, 40], chunk_size=2))
+    assert [len(chunk[20]) for chunk in chunks] == [2, 2, 1]
+    for size in [20, 40]:
+        np.testing.assert_array_equal(
+            np.concatenate([chunk[size] for chunk in chunks]), crops[size])
+    crops_20, blobs = chop.chop_nuclei(img, size=20, return_blobs=True)
+    np.testing.assert_array_equal(crops_20, crops[20])
+    assert blobs.shape == (5, 3)
+    assert (np.abs(blobs[:, :2] - [[30, 30], [30, 170], [100, 100],
+                                   [170, 30], [170, 170]]) <= 1).all()
+    single = list(chop.iter_crops(img, size=20))
+    assert len(single) == 1
+    np.testing.assert_array_equal(single[0], crops[20])
+    with pytest.raises(ValueError):
+        chop.iter_crops(np.zeros((200, 200)), size=20)
+
+
+def test_crop_quality():
+    rng = np.random.RandomState(0)
+    sharp = rng.randint(0, 200, (20, 20)).astype("uint8")
+    flat = np.full((20, 20), 100, dtype="uint8")
+    saturated = flat.copy()
+    saturated[:10] = 255
+    crops = np.stack([sharp, flat, saturated])[..., np.newaxis]
+    metrics = chop.crop_quality(crops)
+    assert metrics["focus"][0] > metrics["focus"][1] == 0
+    np.testing.assert_allclose(metrics["mean"], crops.reshape(3, -1).mean(axis=1))
+    np.testing.assert_allclose(metrics["saturated"], [0, 0, 0.5])
+
+
+def test_quality_filter_counts():
+    crops = np.zeros((4, 10, 10, 2), dtype="uint8")
+    crops[0, ..., 0] = 50
+    crops[1, ..., 0] = 255
+    crops[2, ..., 0] = 60
+    quality_filter = chop.QualityFilter(min_mean=10, max_saturated=0.1)
+    kept = quality_filter.filter(crops, label="a")
+    assert len(kept) == 2
+    assert (kept[:, 0, 0, 0] == [50, 60]).all()
+    quality_filter.filter(crops[:1], label="a")
+    quality_filter.filter(crops[3:], label="b")
+    assert quality_filter.kept == {"a": 3, "b": 0}
+    assert quality_filter.dropped == {"a": 2, "b": 1}
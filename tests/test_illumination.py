@@ -0,0 +1,182 @@
+"""
+tests for nncell.illumination
+"""
+import os
+import numpy as np
+import pytest
+from skimage import io
+from nncell import illumination
+from nncell import image_prep
+
+
+def make_plate(tmpdir, plate, gradient, n_fields=6, shape=(40, 60)):
+    """two-channel fields of a flat background under `gradient`"""
+    rng = np.random.RandomState(plate)
+    plate_dir = tmpdir.join("screen", "PLATE{}".format(plate), "date",
+                            str(1000 + plate)).ensure(dir=True)
+    fields = []
+    for site in range(1, n_fields + 1):
+        field = []
+        for channel in (1, 2):
+            img = rng.normal(10000 * channel, 100, shape) * gradient
+            path = str(plate_dir.join("screen_A01_s{}_w{}.tif".format(site, channel)))
+            io.imsave(path, img.astype("uint16"), check_contrast=False)
+            field.append(path)
+        fields.append(field)
+    return fields
+
+
+def test_flatfield_per_plate(tmpdir):
+    yy, xx = np.mgrid[:40, :60]
+    left = 0.5 + xx / 60.0
+    top = 0.5 + yy / 40.0
+    fields = make_plate(tmpdir, 1, left) + make_plate(tmpdir, 2, top)
+    cache = str(tmpdir.join("cache"))
+    for method in ["mean", "median"]:
+        correction = illumination.IlluminationCorrection(
+            cache, method=method, sigma=1, seed=0).fit(fields)
+        flat_1 = correction.flatfield("PLATE1_1001")
+        flat_2 = correction.flatfield_for(fields[-1])
+        assert flat_1.shape == (40, 60, 2)
+        np.testing.assert_allclose(flat_1.mean(axis=(0, 1)), 1, rtol=1e-3)
+        # the gradients are recovered, per plate
+        np.testing.assert_allclose(flat_1[..., 1], left / left.mean(), rtol=0.05)
+        np.testing.assert_allclose(flat_2[..., 0], top / top.mean(), rtol=0.05)
+    assert len(os.listdir(cache)) == 4
+
+
+def test_flatfield_cached_and_applied(tmpdir):
+    yy, xx = np.mgrid[:40, :60]
+    fields = make_plate(tmpdir, 1, 0.5 + xx / 60.0)
+    cache = str(tmpdir.join("cache"))
+    correction = illumination.IlluminationCorrection(cache, sigma=1).fit(fields)
+    path = os.path.join(cache, os.listdir(cache)[0])
+    np.save(path, np.ones((40, 60, 2), dtype="float32"))
+    # already cached, not recomputed
+    correction = illumination.IlluminationCorrection(cache, sigma=1).fit(fields)
+    assert (correction.flatfield("PLATE1_1001") == 1).all()
+    np.testing.assert_array_equal(correction.read_field(fields[0]),
+                                  image_prep.Prepper.convert_to_rgb(fields[0]))
+    prep = image_prep.ArrayPrep({"train": {"a": fields}}, illumination=correction)
+    np.testing.assert_array_equal(prep._read_field(fields[0]),
+                                  image_prep.Prepper.convert_to_rgb(fields[0]))
+    with pytest.raises(ValueError):
+        correction.flatfield("PLATE9_1009")
+
+
+def test_flatfield_cache_per_settings(tmpdir):
+    yy, xx = np.mgrid[:40, :60]
+    fields = make_plate(tmpdir, 1, 0.5 + xx / 60.0)
+    cache = str(tmpdir.join("cache"))
+    sharp = illumination.IlluminationCorrection(cache, sigma=1).fit(fields)
+    assert len(os.listdir(cache)) == 1
+    # new settings are fitted again, not read from the old file
+    smooth = illumination.IlluminationCorrection(cache, sigma=20).fit(fields)
+    assert len(os.listdir(cache)) == 2
+    assert not np.allclose(sharp.flatfield("PLATE1_1001"),
+                           smooth.flatfield("PLATE1_1001"))
+    illumination.IlluminationCorrection(cache, sigma=1, n_sample=1).fit(fields)
+    illumination.IlluminationCorrection(cache, sigma=1, seed=0).fit(fields)
+    assert len(os.listdir(cache)) == 4
+
+
+def test_fit_accepts_any_iterable(tmpdir):
+    yy, xx = np.mgrid[:40, :60]
+    fields = make_plate(tmpdir, 1, 0.5 + xx / 60.0)
+    expected = illumination.IlluminationCorrection(
+        str(tmpdir.join("list")), sigma=1).fit(fields).flatfield("PLATE1_1001")
+    for name, given in [("tuple", tuple(fields)),
+                        ("generator", (field for field in fields)),
+                        ("dict", {"a": fields})]:
+        correction = illumination.IlluminationCorrection(
+            str(tmpdir.join(name)), sigma=1).fit(given)
+        np.testing.assert_array_equal(correction.flatfield("PLATE1_1001"),
+                                      expected)
+
+
+def test_convert_to_rgb_flatfields(tmpdir):
+    yy, xx = np.mgrid[:40, :60]
+    gradient = 0.5 + xx / 60.0
+    fields = make_plate(tmpdir, 1, gradient)
+    flat = np.dstack([gradient / gradient.mean()] * 2).astype("float32")
+    corrected = image_prep.Prepper.convert_to_rgb(fields[0], flat)
+    raw = image_prep.Prepper.convert_to_rgb(fields[0])
+    assert corrected.dtype == np.uint8
+    # the left to right gradient is removed
+    assert raw[:, :5].mean() < 0.5 * raw[:, -5:].mean()
+    assert abs(corrected[:, :5].mean() - corrected[:, -5:].mean()) < 2
+
+
+def make_nuclei_field(tmpdir, shape=(120, 120)):
+    """three-channel 16-bit field of bright blobs, on plate 1"""
+    rng = np.random.RandomState(0)
+    plate_dir = tmpdir.join("screen", "PLATE1", "date", "1001").ensure(dir=True)
+    yy, xx = np.mgrid[:shape[0], :shape[1]]
+    img = rng.normal(1000, 50, shape)
+    for y, x in [(30, 30), (30, 90), (90, 30), (90, 90)]:
+        img += 30000 * np.exp(-((yy - y) ** 2 + (xx - x) ** 2) / 50.0)
+    field = []
+    for channel in (1, 2, 3):
+        path = str(plate_dir.join("screen_A01_s1_w{}.tif".format(channel)))
+        io.imsave(path, img.astype("uint16"), check_contrast=False)
+        field.append(path)
+    return field
+
+
+def test_convert_to_rgb_16_bit(tmpdir):
+    field = make_nuclei_field(tmpdir)
+    raw = np.dstack([io.imread(path) for path in field])
+    rgb = image_prep.Prepper.convert_to_rgb(field, bit_depth=16)
+    assert rgb.dtype == np.uint16
+    np.testing.assert_array_equal(rgb, raw)
+    with pytest.raises(ValueError):
+        image_prep.Prepper.convert_to_rgb(field, bit_depth=12)
+    # the crops keep every bit
+    out_dir = str(tmpdir.join("out"))
+    prep = image_prep.ArrayPrep({"train": {"a": [field, field]}}, bit_depth=16)
+    prep.create_directories_chop(out_dir, size=20)
+    crops = [np.load(os.path.join(root, f))
+             for root, _, files in os.walk(out_dir) for f in files]
+    assert len(crops) == 8
+    assert all(crop.dtype == np.uint16 for crop in crops)
+    assert max(crop.max() for crop in crops) > 30000
+
+
+def test_convert_to_rgb_16_bit_other_dtypes(tmpdir):
+    # every integer dtype is scaled to 16 bits by the same rule
+    field = []
+    for c, (dtype, value) in enumerate([("uint8", 255), ("int16", 16383),
+                                        ("int32", 2 ** 30)], 1):
+        path = str(tmpdir.join("field_w{}.tif".format(c)))
+        io.imsave(path, np.full((10, 10), value, dtype=dtype),
+                  check_contrast=False)
+        assert io.imread(path).dtype == dtype
+        field.append(path)
+    rgb = image_prep.Prepper.convert_to_rgb(field, bit_depth=16)
+    assert rgb.dtype == np.uint16
+    np.testing.assert_array_equal(rgb[0, 0], [65535, 32766, 32768])
+
+
+def test_percentile_rescale(tmpdir):
+    yy, xx = np.mgrid[:40, :60]
+    fields = make_plate(tmpdir, 1, 0.5 + xx / 60.0)
+    cache = str(tmpdir.join("cache"))
+    rescale = illumination.PercentileRescale(cache, low=1, high=99).fit(fields)
+    lut = rescale.lut("PLATE1_1001")
+    assert lut.shape == (2, 2 ** 16) and lut.dtype == np.uint8
+    assert len(os.listdir(cache)) == 1
+    rgb = rescale.read_field(fields[0])
+    assert rgb.dtype == np.uint8 and rgb.shape == (40, 60, 2)
+    for c in range(2):
+        values = np.concatenate([io.imread(f[c]).ravel() for f in fields])
+        low, high = np.percentile(values, [1, 99])
+        # the percentiles are stretched over the full 8-bit range
+        assert lut[c, int(low) - 1] == 0
+        assert lut[c, int(high) + 1] == 255
+        assert (np.diff(lut[c].astype(int)) >= 0).all()
+        assert rgb[..., c].min() == 0 and rgb[..., c].max() == 255
+    prep = image_prep.ArrayPrep({"train": {"a": fields}}, rescale=rescale)
+    np.testing.assert_array_equal(prep._read_field(fields[0]), rgb)
+    with pytest.raises(ValueError):
+        image_prep.ArrayPrep({"train": {"a": fields}}, bit_depth=16,
+                             rescale=rescale)
@@ -80,6 +80,50 @@ def test_ImageDict_train_test_split():
     assert n_train + n_test == n_images
 
 
+def test_ImageDict_train_test_split_grouped():
+    ImgDict = image_prep.ImageDict()
+    ImgDict.add_class("test", IMG_URLS)
+    ImgDict.group_image_channels()
+    ImgDict.train_test_split(test_size=0.25, group_by="well", seed=42)
+    out = ImgDict.make_dict()
+    def wells(fields):
+        return set(parse.img_well(parse.img_filename(f[0])) for f in fields)
+    train_wells = wells(out["train"]["test"])
+    test_wells = wells(out["test"]["test"])
+    # every site of a well is on the same side
+    assert not train_wells & test_wells
+    assert len(test_wells) == 15
+    # reproducible with the same seed, whatever the input order
+    ImgDict2 = image_prep.ImageDict()
+    ImgDict2.add_class("test", IMG_URLS[::-1])
+    ImgDict2.group_image_channels()
+    ImgDict2.train_test_split(test_size=0.25, group_by="well", seed=42)
+    assert wells(ImgDict2.make_dict()["test"]["test"]) == test_wells
+    with pytest.raises(ValueError):
+        ImgDict2.train_test_split(group_by="column")
+
+
+def test_split_indices():
+    labels = np.repeat(["a", "b"], [600, 400])
+    groups = np.arange(1000) // 10
+    train, test = image_prep.split_indices(labels, groups, 0.3, seed=0)
+    assert len(train) + len(test) == 1000
+    assert not set(groups[train]) & set(groups[test])
+    # stratified by class
+    assert (labels[test] == "a").sum() == 180
+    assert (labels[test] == "b").sum() == 120
+    # the seed sets the split
+    train2, test2 = image_prep.split_indices(labels, groups, 0.3, seed=0)
+    np.testing.assert_array_equal(test, test2)
+    _, test3 = image_prep.split_indices(labels, groups, 0.3, seed=1)
+    assert not np.array_equal(test, test3)
+    # without groups, items are split one by one
+    train, test = image_prep.split_indices(labels, None, 0.5, seed=0)
+    assert len(test) == 500
+    with pytest.raises(ValueError):
+        image_prep.split_indices(labels, groups[:10])
+
+
 def test_ImageDict_sort_channels():
     ImgDict = image_prep.ImageDict()
     # un-sorted channels
@@ -147,6 +191,20 @@ def test_ImagePrep_convert_to_rgb():
     assert isinstance(out, np.ndarray)
     assert out.ndim == 3
 
+def test_create_directories_chop_resize_to_multi_size(tmpdir):
+    # every size would be resized to the same resolution
+    fields = {"train": {"a": [REAL_IMG_PATHS]}}
+    with pytest.raises(ValueError):
+        image_prep.ArrayPrep(fields).create_directories_chop(
+            str(tmpdir), size=[32, 64], resize_to=32)
+    prep = image_prep.ImagePrep(fields)
+    with pytest.raises(ValueError):
+        prep.create_directories_chop(str(tmpdir), size=[32, 64], resize_to=32)
+    with pytest.raises(ValueError):
+        prep.create_directories_chop_par(str(tmpdir), n_jobs=1, size=[32, 64],
+                                         resize_to=32)
+    assert os.listdir(str(tmpdir)) == []
+
 # TODO sort testing with creating and tearing down directories with pytest
 # def test_ImagePrep_create_directories():
 #     assert 2 + 2 == 5
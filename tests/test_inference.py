@@ -0,0 +1,71 @@
+"""
+tests for nncell.inference
+"""
+import numpy as np
+import pandas as pd
+import pytest
+from nncell import chop
+from nncell import image_prep
+from nncell import inference
+from tests.test_preprocessing import make_field_dict, read_npy_field
+
+
+def make_metadata(n_fields):
+    """two wells on one plate, with two sites each"""
+    return pd.DataFrame({"plate_name": "plate",
+                         "plate_num": "1",
+                         "well": ["A01", "A01", "A02", "A02", "A02"][:n_fields],
+                         "site": ["1", "2", "1", "2", "3"][:n_fields]})
+
+
+def mean_intensity(batch):
+    return batch[..., 0].reshape(len(batch), -1).mean(axis=1)
+
+
+def test_predict_crops_batches_across_fields(tmpdir):
+    img_dict = make_field_dict(tmpdir)
+    fields, labels = image_prep.list_fields(img_dict)
+    assert labels == ["class_0"] * 2 + ["class_1"] * 3
+    sizes = []
+    def predict(batch):
+        sizes.append(len(batch))
+        return mean_intensity(batch)
+    predictions, field_index = inference.predict_crops(
+        fields, predict, batch_size=4, read_field=read_npy_field, size=16)
+    expected = [chop.chop_nuclei(read_npy_field(f), size=16) for f in fields]
+    n_crops = sum(len(e) for e in expected)
+    assert sizes == [4] * (n_crops // 4) + ([n_crops % 4] if n_crops % 4 else [])
+    np.testing.assert_allclose(predictions[:, 0],
+                               mean_intensity(np.concatenate(expected)))
+    assert field_index.tolist() == [i for i, e in enumerate(expected) for _ in e]
+
+
+def test_aggregate_segments():
+    metadata = make_metadata(5)
+    predictions = np.array([[1.0, 0.0], [3.0, 2.0], [0.0, 5.0], [2.0, 1.0]])
+    field_index = np.array([3, 0, 1, 3])
+    well = inference.aggregate(predictions, field_index, metadata, "well")
+    assert well.well.tolist() == ["A01", "A02"]
+    assert well.n_crops.tolist() == [2, 2]
+    np.testing.assert_allclose(well[["pred_0", "pred_1"]].values,
+                               [[1.5, 3.5], [1.5, 0.5]])
+    vote = inference.aggregate(predictions, field_index, metadata, "well", "vote")
+    np.testing.assert_allclose(vote[["pred_0", "pred_1"]].values, [[0.5, 0.5], [1, 0]])
+    top = inference.aggregate(predictions, field_index, metadata, "plate", "max")
+    np.testing.assert_allclose(top[["pred_0", "pred_1"]].values, [[3, 5]])
+    # fields without crops are left out
+    field = inference.aggregate(predictions, field_index, metadata, "field")
+    assert field.field.tolist() == [0, 1, 3]
+    with pytest.raises(ValueError):
+        inference.aggregate(predictions, field_index, metadata, "column")
+
+
+def test_run_inference(tmpdir):
+    img_dict = make_field_dict(tmpdir)
+    results = inference.run_inference(
+        img_dict, mean_intensity, batch_size=3, metadata=make_metadata(5),
+        read_field=read_npy_field, size=16)
+    assert sorted(results) == ["field", "plate", "site", "well"]
+    assert results["field"]["class"].tolist() == ["class_0"] * 2 + ["class_1"] * 3
+    assert results["plate"].n_crops.sum() == results["field"].n_crops.sum()
+    assert len(results["site"]) == 5
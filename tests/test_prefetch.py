@@ -0,0 +1,61 @@
+"""
+tests for nncell.prefetch
+"""
+import time
+import threading
+import numpy as np
+import pytest
+from nncell import prefetch
+
+
+class SlowReader(object):
+    """reads a field after a delay, recording the most reads in flight"""
+
+    def __init__(self, delay=0.01, nbytes=100):
+        self.delay = delay
+        self.nbytes = nbytes
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def __call__(self, field):
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        time.sleep(self.delay)
+        with self.lock:
+            self.in_flight -= 1
+        if field == "bad":
+            raise ValueError("unreadable field")
+        return np.full(self.nbytes, field, dtype="uint8")
+
+
+def test_prefetch_in_order_and_bounded():
+    fields = list(range(20))
+    for depth in [0, 1, 4]:
+        reader = SlowReader()
+        out = list(prefetch.FieldPrefetcher(reader, fields, depth=depth))
+        assert [int(arr[0]) for arr in out] == fields
+        assert reader.max_in_flight == max(depth, 1)
+    # the memory budget limits the fields read ahead, once their size is known
+    reader = SlowReader(nbytes=100)
+    out = list(prefetch.FieldPrefetcher(reader, fields, depth=8, max_bytes=250))
+    assert len(out) == 20
+    assert reader.max_in_flight <= 8
+    prefetcher = prefetch.FieldPrefetcher(reader, fields, depth=8, max_bytes=250)
+    prefetcher.field_bytes = 100
+    assert prefetcher._n_ahead() == 2
+    prefetcher.max_bytes = 10
+    assert prefetcher._n_ahead() == 1
+
+
+def test_prefetch_errors_raised_in_place():
+    reader = SlowReader(delay=0)
+    fields = [1, 2, "bad", 3]
+    prefetcher = iter(prefetch.FieldPrefetcher(reader, fields, depth=3))
+    assert int(next(prefetcher)[0]) == 1
+    assert int(next(prefetcher)[0]) == 2
+    with pytest.raises(ValueError):
+        next(prefetcher)
+    with pytest.raises(ValueError):
+        prefetch.FieldPrefetcher(reader, fields, depth=-1)
@@ -0,0 +1,344 @@
+"""
+tests for nncell.preprocessing and nncell.loader
+"""
+import os
+import numpy as np
+import pytest
+from nncell import preprocessing
+from nncell import loader
+from nncell import utils
+
+
+IMAGE_SHAPE = (8, 8, 3)
+
+
+def make_array_dir(base_dir, n_per_class=(5, 7), compress=None):
+    """directory of arrays, one sub-directory per class"""
+    for label, n in enumerate(n_per_class):
+        class_dir = os.path.join(str(base_dir), "class_{}".format(label))
+        os.makedirs(class_dir)
+        for i in range(n):
+            arr = np.full(IMAGE_SHAPE, label * 100 + i, dtype="float32")
+            utils.save_array(os.path.join(class_dir, "arr_{}".format(i)), arr,
+                             compress)
+    return str(base_dir)
+
+
+def make_iterator(directory, batch_size=4, **kwargs):
+    generator = preprocessing.ArrayDataGenerator()
+    return preprocessing.DirectoryIterator(directory, generator,
+                                           batch_size=batch_size,
+                                           image_shape=IMAGE_SHAPE, **kwargs)
+
+
+#####################################
+# DirectoryIterator tests
+#####################################
+
+def test_DirectoryIterator_batches(tmpdir):
+    directory = make_array_dir(tmpdir)
+    iterator = make_iterator(directory)
+    assert iterator.samples == 12
+    assert iterator.num_classes == 2
+    batch_x, batch_y = next(iterator)
+    assert batch_x.shape == (4, ) + IMAGE_SHAPE
+    assert batch_y.shape == (4, 2)
+    assert (batch_y.sum(axis=1) == 1).all()
+
+
+#####################################
+# SharedMemoryLoader tests
+#####################################
+
+def test_SharedMemoryLoader_matches_iterator(tmpdir):
+    directory = make_array_dir(tmpdir)
+    expected = make_iterator(directory)
+    with loader.SharedMemoryLoader(make_iterator(directory), n_workers=2) as shm:
+        # more batches than an epoch, to wrap around the ring and the epoch
+        for _ in range(8):
+            x_expected, y_expected = next(expected)
+            x, y = next(shm)
+            np.testing.assert_array_equal(x, x_expected)
+            np.testing.assert_array_equal(y, y_expected)
+
+
+def test_SharedMemoryLoader_worker_error(tmpdir):
+    directory = make_array_dir(tmpdir)
+    iterator = make_iterator(directory)
+    os.remove(os.path.join(directory, iterator.filenames[0]))
+    shm = loader.SharedMemoryLoader(iterator, n_workers=1)
+    with pytest.raises(RuntimeError):
+        next(shm)
+    # the loader shuts itself down after a worker failure
+    with pytest.raises(RuntimeError):
+        next(shm)
+
+
+def test_DirectoryIterator_class_modes(tmpdir):
+    directory = make_array_dir(tmpdir)
+    expected = make_iterator(directory).classes[:4].astype("float32")
+    for class_mode in ["sparse", "binary"]:
+        iterator = make_iterator(directory, class_mode=class_mode)
+        _, batch_y = next(iterator)
+        np.testing.assert_array_equal(batch_y, expected)
+    iterator = make_iterator(directory, class_mode=None)
+    batch_x = next(iterator)
+    assert batch_x.shape == (4, ) + IMAGE_SHAPE
+    with pytest.raises(ValueError):
+        make_iterator(directory, class_mode="foo")
+
+
+def test_DirectoryIterator_binary_needs_two_classes(tmpdir):
+    directory = make_array_dir(tmpdir, n_per_class=(3, 3, 3))
+    with pytest.raises(ValueError):
+        make_iterator(directory, class_mode="binary")
+    assert make_iterator(directory, class_mode="sparse").num_classes == 3
+
+
+def test_DirectoryIterator_standardizes_batches(tmpdir):
+    directory = make_array_dir(tmpdir)
+    raw_x, raw_y = next(make_iterator(directory))
+    generator = preprocessing.ArrayDataGenerator(rescale=0.5, mean=[10] * 3,
+                                                 std=[2] * 3)
+    iterator = preprocessing.DirectoryIterator(
+        directory, generator, batch_size=4, image_shape=IMAGE_SHAPE)
+    batch_x, batch_y = iterator.next()
+    np.testing.assert_allclose(batch_x, (raw_x - 10) / 2.0, rtol=1e-6)
+    np.testing.assert_array_equal(batch_y, raw_y)
+    # no generator, the samples are returned as stored
+    iterator = preprocessing.DirectoryIterator(
+        directory, None, batch_size=4, image_shape=IMAGE_SHAPE)
+    batch_x, _ = iterator.next()
+    np.testing.assert_array_equal(batch_x, raw_x)
+
+
+def test_DirectoryIterator_reuses_buffers(tmpdir):
+    # 10 samples in batches of 4, so the last batch of each epoch has 2
+    directory = make_array_dir(tmpdir, n_per_class=(4, 6))
+    expected = make_iterator(directory)
+    iterator = make_iterator(directory, n_buffers=2)
+    batches = []
+    for _ in range(6):
+        x_expected, y_expected = next(expected)
+        batch_x, batch_y = next(iterator)
+        np.testing.assert_array_equal(batch_x, x_expected)
+        np.testing.assert_array_equal(batch_y, y_expected)
+        batches.append(batch_x)
+    assert len(batches[2]) == 2
+    # two buffers in the ring, so every other batch shares memory
+    assert np.shares_memory(batches[0], batches[2])
+    assert not np.shares_memory(batches[0], batches[1])
+
+
+#####################################
+# ClassWeightedSampler tests
+#####################################
+
+def test_ClassWeightedSampler_balanced():
+    classes = np.repeat([0, 1, 2], [5000, 100, 10])
+    sampler = preprocessing.ClassWeightedSampler(classes, "balanced", seed=0)
+    index_array = sampler.sample()
+    assert len(index_array) == len(classes)
+    drawn = np.bincount(classes[index_array], minlength=3) / len(index_array)
+    np.testing.assert_allclose(drawn, [1 / 3.0] * 3, atol=0.03)
+    # every index drawn from the rare class is a real member of it
+    assert set(index_array[classes[index_array] == 2]) <= set(range(5100, 5110))
+
+
+def test_ClassWeightedSampler_user_weights():
+    classes = np.repeat([0, 1], [100, 100])
+    sampler = preprocessing.ClassWeightedSampler(classes, {1: 1.0},
+                                                 num_samples=50, seed=0)
+    index_array = sampler.sample()
+    assert len(index_array) == 50
+    assert (classes[index_array] == 1).all()
+    with pytest.raises(ValueError):
+        preprocessing.ClassWeightedSampler(classes, [1.0])
+
+
+def test_DirectoryIterator_class_weight(tmpdir):
+    directory = make_array_dir(tmpdir, n_per_class=(2, 30))
+    iterator = make_iterator(directory, batch_size=32, class_mode="sparse",
+                             class_weight="balanced", seed=0)
+    labels = np.concatenate([next(iterator)[1] for _ in range(10)])
+    assert 0.35 < labels.mean() < 0.65
+
+
+#####################################
+# SampleCache tests
+#####################################
+
+def test_SampleCache_evicts_least_recently_used():
+    cache = preprocessing.SampleCache(max_bytes=300)
+    for key in range(3):
+        cache.put(key, np.zeros(100, dtype="uint8"))
+    assert cache.get(0) is not None  # 0 is now most recently used
+    cache.put(3, np.zeros(100, dtype="uint8"))
+    assert cache.get(1) is None
+    assert cache.get(0) is not None
+    info = cache.info()
+    assert info["evictions"] == 1
+    assert info["current_bytes"] == 300
+    assert (info["hits"], info["misses"]) == (2, 1)
+
+
+def test_DirectoryIterator_cache(tmpdir):
+    directory = make_array_dir(tmpdir)
+    expected = make_iterator(directory)
+    iterator = make_iterator(directory, cache_bytes=10 ** 6)
+    # two epochs, the second served from the cache
+    for _ in range(6):
+        x_expected, _ = next(expected)
+        batch_x, _ = next(iterator)
+        np.testing.assert_array_equal(batch_x, x_expected)
+    info = iterator.cache_info()
+    assert info["misses"] == 12
+    assert info["hits"] == 12
+    assert make_iterator(directory).cache_info() is None
+
+
+def test_DirectoryIterator_compressed_threaded(tmpdir):
+    expected = make_iterator(make_array_dir(tmpdir.mkdir("npy")))
+    for compress in ["zlib", "lzma"]:
+        directory = make_array_dir(tmpdir.mkdir(compress), compress=compress)
+        iterator = make_iterator(directory, n_threads=4)
+        assert iterator.filenames[0].endswith(".npz")
+        for _ in range(3):
+            x_expected, y_expected = next(expected)
+            batch_x, batch_y = next(iterator)
+            np.testing.assert_array_equal(batch_x, x_expected)
+            np.testing.assert_array_equal(batch_y, y_expected)
+
+
+def test_DirectoryIterator_images(tmpdir):
+    from skimage import io
+    for label in range(2):
+        class_dir = tmpdir.mkdir("class_{}".format(label))
+        for i in range(3):
+            img = np.full((16, 16, 3), 10 * label + i, dtype="uint8")
+            io.imsave(str(class_dir.join("img_{}.png".format(i))), img,
+                      check_contrast=False)
+    iterator = make_iterator(str(tmpdir), batch_size=6, class_mode="sparse",
+                             n_threads=2, resize=True)
+    batch_x, batch_y = next(iterator)
+    assert batch_x.shape == (6, ) + IMAGE_SHAPE
+    np.testing.assert_allclose(batch_x[:, 0, 0, 0], [0, 1, 2, 10, 11, 12])
+    np.testing.assert_array_equal(batch_y, [0, 0, 0, 1, 1, 1])
+    # without resize the shapes must already match
+    with pytest.raises(ValueError):
+        next(make_iterator(str(tmpdir), batch_size=6))
+
+
+#####################################
+# FieldCropIterator tests
+#####################################
+
+def make_field(n_nuclei, seed, shape=(128, 128)):
+    """uint8 field of bright square nuclei on a dark background"""
+    rng = np.random.RandomState(seed)
+    field = np.zeros(shape + (2, ), dtype="uint8")
+    for x, y in rng.randint(10, shape[0] - 10, size=(n_nuclei, 2)):
+        field[x - 3: x + 3, y - 3: y + 3, 0] = 200
+        field[x - 3: x + 3, y - 3: y + 3, 1] = 100
+    return field
+
+
+def make_field_dict(tmpdir, n_fields=(2, 3)):
+    """{class: [[path], ...]} of .npy fields, read with np.load"""
+    img_dict = dict()
+    for label, n in enumerate(n_fields):
+        fields = []
+        for i in range(n):
+            path = str(tmpdir.join("field_{}_{}.npy".format(label, i)))
+            np.save(path, make_field(5, seed=10 * label + i))
+            fields.append([path])
+        img_dict["class_{}".format(label)] = fields
+    return img_dict
+
+
+def read_npy_field(field):
+    return np.load(field[0])
+
+
+def test_FieldCropIterator_matches_chop_nuclei(tmpdir):
+    from nncell import chop
+    img_dict = make_field_dict(tmpdir)
+    generator = preprocessing.ArrayDataGenerator()
+    iterator = preprocessing.FieldCropIterator(
+        img_dict, generator, batch_size=1000, size=16,
+        read_field=read_npy_field, class_mode="sparse")
+    batch_x, batch_y = next(iterator)
+    expected = [chop.chop_nuclei(read_npy_field(f), size=16)
+                for name in sorted(img_dict) for f in img_dict[name]]
+    np.testing.assert_array_equal(batch_x, np.concatenate(expected))
+    n_class_0 = sum(len(e) for e in expected[:2])
+    assert (batch_y[:n_class_0] == 0).all() and (batch_y[n_class_0:] == 1).all()
+    assert iterator.image_shape == (16, 16, 2)
+
+
+def test_FieldCropIterator_shuffle_groups_fields(tmpdir):
+    img_dict = make_field_dict(tmpdir)
+    generator = preprocessing.ArrayDataGenerator()
+    kwargs = dict(batch_size=8, size=16, read_field=read_npy_field)
+    plain = preprocessing.FieldCropIterator(img_dict, generator, **kwargs)
+    shuffled = preprocessing.FieldCropIterator(
+        img_dict, generator, shuffle=True, seed=0, cache_bytes=10 ** 6,
+        memmap_dir=str(tmpdir.join("memmap")), **kwargs)
+    index_array = shuffled._epoch_index_array(shuffled.n)
+    assert sorted(index_array) == list(range(shuffled.n))
+    # crops of each field are contiguous
+    fields = shuffled.field_index[index_array]
+    assert (np.diff(fields) != 0).sum() == len(shuffled.fields) - 1
+    # batches hold the same crops as the unshuffled iterator
+    batch_x, _ = next(shuffled)
+    plain_x = np.concatenate([next(plain)[0] for _ in range(4)])
+    for crop in batch_x:
+        assert (plain_x == crop).all(axis=(1, 2, 3)).any()
+
+
+#####################################
+# rank / world_size sharding tests
+#####################################
+
+def test_DirectoryIterator_shards(tmpdir):
+    # 12 samples split between 5 simulated ranks
+    directory = make_array_dir(tmpdir)
+    for drop_last, per_rank in [(False, 3), (True, 2)]:
+        ranks = [make_iterator(directory, batch_size=10, shuffle=True, seed=1,
+                               rank=rank, world_size=5, drop_last=drop_last)
+                 for rank in range(5)]
+        epochs = []
+        for _ in range(2):
+            # a batch is larger than a shard, so one batch per rank per epoch
+            shards = [next(iterator.index_generator)[0] for iterator in ranks]
+            assert [len(shard) for shard in shards] == [per_rank] * 5
+            epoch = np.concatenate(shards)
+            if drop_last:
+                assert len(set(epoch)) == 10
+            else:
+                assert set(epoch) == set(range(12))
+            epochs.append(epoch)
+        assert not np.array_equal(epochs[0], epochs[1])
+    batch_x, _ = next(make_iterator(directory, batch_size=10, rank=4,
+                                    world_size=5))
+    assert len(batch_x) == 3
+    with pytest.raises(ValueError):
+        make_iterator(directory, shuffle=True, world_size=2)
+    with pytest.raises(ValueError):
+        make_iterator(directory, rank=2, world_size=2)
+
+
+def test_DirectoryIterator_batch_resize(tmpdir):
+    from nncell import chop
+    rng = np.random.RandomState(0)
+    arrays = rng.randint(0, 256, size=(6, 16, 16, 3)).astype("uint8")
+    class_dir = tmpdir.mkdir("class_0")
+    for i, arr in enumerate(arrays):
+        np.save(str(class_dir.join("arr_{}.npy".format(i))), arr)
+    generator = preprocessing.ArrayDataGenerator()
+    iterator = generator.flow_from_directory(str(tmpdir), batch_size=6,
+                                             image_shape=IMAGE_SHAPE,
+                                             resize=True)
+    batch_x, _ = next(iterator)
+    np.testing.assert_allclose(batch_x, chop.resize_crops(
+        arrays.astype("float32"), 8), rtol=1e-6)
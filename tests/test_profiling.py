@@ -0,0 +1,71 @@
+"""
+tests for nncell.profiling
+"""
+import os
+import time
+import multiprocessing
+import numpy as np
+import pytest
+from nncell import profiling
+
+
+@profiling.profiled("outer")
+def outer(n):
+    inner(n)
+    return sum(range(n))
+
+
+@profiling.profiled("inner")
+def inner(n):
+    return np.ones(n).sum()
+
+
+@pytest.fixture
+def out_dir(tmpdir):
+    profiling.enable(str(tmpdir))
+    yield str(tmpdir)
+    profiling.disable()
+
+
+def test_disabled_does_nothing(tmpdir):
+    assert not profiling.is_enabled()
+    assert outer(10) == 45
+    with profiling.stage("block"):
+        pass
+    assert os.listdir(str(tmpdir)) == []
+
+
+def test_stages_are_merged_across_processes(out_dir):
+    assert os.environ[profiling.ENV_VAR] == out_dir
+    outer(1000)
+    outer(1000)
+    with profiling.stage("block"):
+        inner(10 ** 6)
+    pool = multiprocessing.Pool(2)
+    try:
+        pool.map(outer, [10] * 4)
+    finally:
+        pool.close()
+        pool.join()
+    report = profiling.merge_report()
+    assert report["outer"]["calls"] == 6
+    assert report["inner"]["calls"] == 7
+    assert report["block"]["calls"] == 1
+    assert report["outer"]["processes"] >= 2
+    # the million floats allocated by inner show up in the nested stages
+    assert report["inner"]["peak_bytes"] >= 8 * 10 ** 6
+    assert report["block"]["peak_bytes"] >= 8 * 10 ** 6
+    # nested time is counted towards the inner stage only
+    functions = [f[2] for f in report["outer"]["stats"].stats]
+    assert "outer" in functions
+    assert "inner" not in functions
+    assert os.path.isfile(os.path.join(out_dir, "report.txt"))
+
+
+def test_nested_time_is_not_counted_twice(out_dir):
+    with profiling.stage("block"):
+        with profiling.stage("sleep"):
+            time.sleep(0.2)
+    report = profiling.merge_report()
+    assert report["sleep"]["seconds"] >= 0.2
+    assert report["block"]["seconds"] < 0.1
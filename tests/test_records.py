@@ -0,0 +1,77 @@
+"""
+tests for nncell.records
+"""
+import numpy as np
+import pytest
+from nncell import chop
+from nncell import records
+from nncell import image_prep
+from tests.test_preprocessing import make_field_dict, read_npy_field
+
+
+def write_records(directory, n=50, shard_bytes=2 ** 30):
+    rng = np.random.RandomState(0)
+    arrays = [rng.randint(0, 255, (8, 8, 2)).astype("uint8") for _ in range(n)]
+    with records.RecordWriter(directory, shard_bytes=shard_bytes) as writer:
+        for i, arr in enumerate(arrays):
+            writer.write(arr, "class_{}".format(i % 3), {"id": i})
+    return arrays, writer
+
+
+def test_records_round_trip(tmpdir):
+    arrays, writer = write_records(str(tmpdir), shard_bytes=2000)
+    assert len(writer.paths) > 1
+    reader = records.RecordReader(str(tmpdir))
+    assert len(reader) == 50
+    out = list(reader)
+    assert [meta["id"] for _, _, meta in out] == list(range(50))
+    assert [label for _, label, _ in out] == ["class_{}".format(i % 3) for i in range(50)]
+    for arr, (read, _, _) in zip(arrays, out):
+        np.testing.assert_array_equal(arr, read)
+    # random access through the index
+    shard = writer.paths[1]
+    offset, _ = records.load_index(shard)[2]
+    arr, label, meta = records.read_record(shard, offset)
+    np.testing.assert_array_equal(arr, arrays[meta["id"]])
+
+
+def test_records_shuffle_buffer(tmpdir):
+    write_records(str(tmpdir))
+    reader = records.RecordReader(str(tmpdir), shuffle_buffer=10, seed=1)
+    ids = [meta["id"] for _, _, meta in reader]
+    assert sorted(ids) == list(range(50))
+    assert ids != list(range(50))
+    # a record can't be yielded before the buffer has read past it
+    assert all(ids[k] <= k + 10 for k in range(50))
+    batches = list(reader.batches(16, class_names=["class_0", "class_1", "class_2"]))
+    assert [len(b[0]) for b in batches] == [16, 16, 16, 2]
+    assert batches[0][0].shape == (16, 8, 8, 2)
+    assert set(np.concatenate([b[1] for b in batches])) == {0, 1, 2}
+
+
+def test_records_corrupt(tmpdir):
+    _, writer = write_records(str(tmpdir), n=3)
+    with open(writer.paths[0], "r+b") as f:
+        f.seek(-5, 2)
+        f.write(b"xxxxx")
+    with pytest.raises(ValueError):
+        list(records.RecordReader(str(tmpdir)))
+
+
+def test_export_records(tmpdir):
+    img_dict = {"train": make_field_dict(tmpdir.mkdir("fields"), n_fields=(3, 3))}
+    prep = image_prep.ArrayPrep(img_dict)
+    prep.convert_to_rgb = read_npy_field
+    shards = prep.export_records(str(tmpdir.join("out")), size=16, seed=0)
+    assert len(shards["train"]) == 1
+    out = list(records.RecordReader(shards["train"]))
+    expected = {(label, i + 1): len(chop.chop_nuclei(read_npy_field(f), size=16))
+                for label, fields in img_dict["train"].items()
+                for i, f in enumerate(fields)}
+    assert len(out) == sum(expected.values())
+    assert out[0][0].shape == (16, 16, 2)
+    # fields are written in a random order across classes
+    field_order = [(label, meta["field"]) for _, label, meta in out
+                   if meta["nucleus"] == 1]
+    assert sorted(field_order) == sorted(expected)
+    assert field_order != sorted(field_order)
@@ -0,0 +1,110 @@
+"""
+tests for nncell.scheduler
+"""
+import numpy as np
+import pandas as pd
+import pytest
+from skimage import io
+from nncell import chop
+from nncell import image_prep
+from nncell import scheduler
+from tests.test_illumination import make_nuclei_field
+
+
+def make_metadata(n_plates=3, n_wells=4, n_sites=2):
+    """task metadata in a shuffled order"""
+    rows = [("plate_{}".format(p), str(p), "A{:02d}".format(w), str(s))
+            for p in range(n_plates)
+            for w in range(1, n_wells + 1)
+            for s in range(1, n_sites + 1)]
+    df = pd.DataFrame(rows, columns=["plate_name", "plate_num", "well", "site"])
+    return df.sample(frac=1, random_state=0).reset_index(drop=True)
+
+
+def test_plan_chunks_plate_local_and_ordered():
+    metadata = make_metadata()
+    chunks = scheduler.plan_chunks(metadata, n_workers=2)
+    # every task exactly once
+    flat = np.concatenate(chunks)
+    assert sorted(flat.tolist()) == list(range(len(metadata)))
+    # no chunk spans plates, and tasks come in plate, well, site order
+    for chunk in chunks:
+        assert metadata.plate_name.values[chunk].tolist().count(
+            metadata.plate_name.values[chunk[0]]) == len(chunk)
+    ordered = metadata.iloc[flat]
+    keys = list(zip(ordered.plate_name, ordered.well, ordered.site))
+    assert keys == sorted(keys)
+    # chunks shrink towards the end of the schedule
+    sizes = [len(chunk) for chunk in chunks]
+    assert sizes[0] == 6
+    assert sizes[-1] == 1
+
+
+def test_plan_chunks_one_worker_is_one_chunk_per_plate():
+    metadata = make_metadata()
+    chunks = scheduler.plan_chunks(metadata, n_workers=1, min_chunk=8)
+    assert [len(chunk) for chunk in chunks] == [8, 8, 8]
+    with pytest.raises(ValueError):
+        scheduler.plan_chunks(metadata, n_workers=0)
+
+
+def test_load_report():
+    report = scheduler.load_report([(1, 4, 2.0), (2, 2, 1.0), (1, 1, 1.0)])
+    assert report["workers"][1] == {"chunks": 2, "tasks": 5, "seconds": 3.0}
+    assert report["workers"][2]["tasks"] == 2
+    assert report["imbalance"] == pytest.approx(1.5)
+
+
+def test_memory_budget():
+    shape = (512, 512, 3)
+    fixed = scheduler.estimate_task_bytes(shape, 64, 0)
+    per_nucleus = chop.crop_bytes(64, 3)
+    assert per_nucleus == 64 * 64 * 3
+    assert scheduler.estimate_task_bytes(shape, 64, 10) == fixed + 10 * per_nucleus
+    # detection dominates, and grows with the field
+    assert fixed > chop.detection_bytes(shape) > 512 * 512 * 8 * 10
+    assert scheduler.estimate_task_bytes((1024, 1024, 3), 64, 0) == 4 * fixed
+    assert scheduler.nuclei_per_chunk(fixed + 25 * per_nucleus, shape, 64) == 25
+    assert scheduler.nuclei_per_chunk(fixed, shape, 64) == 1
+    task = fixed + 100 * per_nucleus
+    assert scheduler.workers_for_budget(3.5 * task, task, n_jobs=8) == 3
+    assert scheduler.workers_for_budget(100 * task, task, n_jobs=8) == 8
+    with pytest.raises(ValueError):
+        scheduler.workers_for_budget(task / 2, task)
+
+
+def test_crop_chunks_within_budget():
+    img = np.zeros((200, 200, 3), dtype="uint8")
+    yy, xx = np.mgrid[:200, :200]
+    for x in range(20, 200, 40):
+        for y in [50, 150]:
+            img[..., 0] += (200 * np.exp(-((xx - y) ** 2 + (yy - x) ** 2) / 50.0)).astype("uint8")
+    whole = image_prep._crop_chunks(img, size=20)
+    assert len(whole) == 1 and len(whole[0][0][None]) == 10
+    fixed = scheduler.estimate_task_bytes(img.shape, 20, 0)
+    budget = fixed + 4 * chop.crop_bytes(20, 3)
+    chunks = list(image_prep._crop_chunks(img, budget, size=20))
+    assert [len(crops[None]) for crops, _ in chunks] == [4, 4, 2]
+    np.testing.assert_array_equal(
+        np.concatenate([crops[None] for crops, _ in chunks]), whole[0][0][None])
+    np.testing.assert_array_equal(
+        np.concatenate([blobs for _, blobs in chunks]), whole[0][1])
+
+
+def test_workers_for_budget_samples_fields(tmpdir):
+    field = make_nuclei_field(tmpdir)
+    blank = []
+    for c in (1, 2, 3):
+        path = str(tmpdir.join("blank_w{}.tif".format(c)))
+        io.imsave(path, np.full((120, 120), 1000, dtype="uint16"),
+                  check_contrast=False)
+        blank.append(path)
+    # the first field has no nuclei, the estimate comes from the sample
+    prep = image_prep.ImagePrep({"train": {"a": [blank, blank, field]}})
+    task = scheduler.estimate_task_bytes((120, 120, 3), 20, 4)
+    empty = scheduler.estimate_task_bytes((120, 120, 3), 20, 0)
+    budget = 2 * task - 1
+    assert budget // empty == 2
+    assert prep._workers_for_budget(budget, 8, 20) == 1
+    # and uses the chop arguments, no nuclei pass this threshold
+    assert prep._workers_for_budget(budget, 8, 20, threshold=10) == 2
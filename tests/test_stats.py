@@ -0,0 +1,76 @@
+"""
+tests for nncell.stats
+"""
+import numpy as np
+import pytest
+from nncell import stats
+from nncell import preprocessing
+
+
+def make_dataset(tmpdir, n_files=20):
+    """class directories of random uint8 crops, returns all the data too"""
+    rng = np.random.RandomState(0)
+    arrays = []
+    for i in range(n_files):
+        class_dir = tmpdir.join("class_{}".format(i % 2))
+        class_dir.ensure(dir=True)
+        # a different distribution per channel
+        arr = np.dstack([rng.randint(0, 50, (10, 10)),
+                         rng.randint(100, 256, (10, 10)),
+                         rng.randint(0, 256, (10, 10))]).astype("uint8")
+        np.save(str(class_dir.join("arr_{}.npy".format(i))), arr)
+        arrays.append(arr)
+    return str(tmpdir), np.stack(arrays).reshape(-1, 3)
+
+
+def test_channel_stats_matches_numpy(tmpdir):
+    directory, values = make_dataset(tmpdir)
+    for n_jobs, chunk_size in [(1, 3), (2, 4)]:
+        out = stats.channel_stats(directory, n_jobs=n_jobs, chunk_size=chunk_size)
+        assert out.count == len(values)
+        np.testing.assert_allclose(out.mean, values.mean(axis=0))
+        np.testing.assert_allclose(out.std, values.std(axis=0))
+        np.testing.assert_array_equal(out.min, values.min(axis=0))
+        np.testing.assert_array_equal(out.max, values.max(axis=0))
+        np.testing.assert_array_equal(
+            out.percentiles([0, 50, 100]),
+            np.percentile(values, [0, 50, 100], axis=0, method="inverted_cdf"))
+
+
+def test_ChannelStats_save_load(tmpdir):
+    directory, _ = make_dataset(tmpdir)
+    out = stats.channel_stats(directory)
+    path = str(tmpdir.join("stats.npz"))
+    out.save(path)
+    loaded = stats.ChannelStats.load(path)
+    np.testing.assert_array_equal(loaded.mean, out.mean)
+    np.testing.assert_array_equal(loaded.std, out.std)
+    np.testing.assert_array_equal(loaded.percentiles([5]), out.percentiles([5]))
+
+
+def test_channel_stats_float_needs_range(tmpdir):
+    path = str(tmpdir.join("arr.npy"))
+    np.save(path, np.zeros((4, 4, 2), dtype="float32"))
+    with pytest.raises(ValueError):
+        stats.channel_stats([path])
+    out = stats.channel_stats([path], value_range=(0, 1))
+    assert out.n_channels == 2
+
+
+def test_ArrayDataGenerator_normalises_in_place(tmpdir):
+    directory, values = make_dataset(tmpdir)
+    out = stats.channel_stats(directory)
+    generator = preprocessing.ArrayDataGenerator(mean=out.mean, std=out.std)
+    iterator = preprocessing.DirectoryIterator(directory, generator,
+                                               batch_size=20,
+                                               image_shape=(10, 10, 3),
+                                               n_buffers=1)
+    batch_x, _ = next(iterator)
+    assert np.shares_memory(batch_x, iterator._buffers[0][0])
+    flat = batch_x.reshape(-1, 3)
+    np.testing.assert_allclose(flat.mean(axis=0), 0, atol=1e-4)
+    np.testing.assert_allclose(flat.std(axis=0), 1, atol=1e-4)
+    # rescale on its own
+    generator = preprocessing.ArrayDataGenerator(rescale=1 / 255.0)
+    x = np.full((2, 2), 255, dtype="float32")
+    np.testing.assert_allclose(generator.standardize(x), 1)
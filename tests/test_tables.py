@@ -0,0 +1,93 @@
+"""
+tests for nncell.tables
+"""
+import os
+import numpy as np
+import pytest
+from nncell import image_prep
+from nncell import tables
+from tests.test_illumination import make_nuclei_field
+
+
+def add_field(writer, i, n):
+    field = {column: "{}_{}".format(column, i) for column in tables.FIELD_COLUMNS}
+    nuclei = np.arange(1, n + 1)
+    blobs = np.column_stack([nuclei, nuclei * 2, np.full(n, 3.0)])
+    writer.add(field, nuclei, ["img_{}_{}".format(i, j) for j in nuclei], blobs)
+
+
+def test_writer_parts_and_merge(tmpdir):
+    directory = str(tmpdir.join("table"))
+    # two writers, as two workers would
+    with tables.NucleusTableWriter(directory, rows_per_part=10, fmt="npz") as writer:
+        for i in range(5):
+            add_field(writer, i, 4)
+    assert len(writer.paths) == 2 and writer.n_rows == 20
+    with tables.NucleusTableWriter(directory, rows_per_part=10, fmt="npz") as other:
+        add_field(other, 10, 3)
+    assert len(tables.list_parts(directory)) == 3
+    path = tables.merge_parts(directory)
+    assert path == os.path.join(directory, "nuclei.npz")
+    assert tables.list_parts(directory) == []
+    df = tables.read_table(path)
+    assert list(df.columns) == tables.COLUMNS
+    assert len(df) == 23
+    # strings of different widths in different parts
+    assert set(df["img_url"]) == set("img_url_{}".format(i) for i in [0, 1, 2, 3, 4, 10])
+    assert (df["y"] == 2 * df["x"]).all()
+    assert df["nucleus"].dtype == np.int64
+    with pytest.raises(ValueError):
+        tables.NucleusTableWriter(directory, fmt="csv")
+
+
+def test_writer_parquet(tmpdir):
+    pytest.importorskip("pyarrow")
+    directory = str(tmpdir.join("table"))
+    with tables.NucleusTableWriter(directory, rows_per_part=5, fmt="parquet") as writer:
+        for i in range(3):
+            add_field(writer, i, 4)
+    df = tables.read_table(tables.merge_parts(directory))
+    assert len(df) == 12
+
+
+def test_create_directories_nucleus_table(tmpdir):
+    field = make_nuclei_field(tmpdir)
+    out_dir = str(tmpdir.join("out"))
+    table_dir = str(tmpdir.join("table"))
+    prep = image_prep.ArrayPrep({"train": {"a": [field, field]},
+                                 "test": {"a": [field]}})
+    prep.create_directories_chop(out_dir, size=20, nucleus_table=table_dir)
+    assert tables.list_parts(table_dir) == []
+    df = tables.read_table(os.path.join(
+        table_dir, "nuclei.{}".format(tables.default_format())))
+    assert len(df) == 12
+    assert (df["plate_name"] == "PLATE1").all() and (df["well"] == "A01").all()
+    assert sorted(df["group"].unique()) == ["test", "train"]
+    # rows name the crops that were written
+    for group, label, crop in zip(df["group"], df["class"], df["crop"]):
+        arr = np.load(os.path.join(out_dir, group, label, crop + ".npy"))
+        assert arr.shape == (20, 20, 3)
+    # nuclei are centred on their crops
+    centres = {(int(x), int(y)) for x, y in zip(df["x"], df["y"])}
+    assert centres == {(30, 30), (30, 90), (90, 30), (90, 90)}
+
+
+@pytest.mark.parametrize("schedule", [None, "plate"])
+def test_create_directories_chop_par_nucleus_table(tmpdir, schedule):
+    field = make_nuclei_field(tmpdir)
+    out_dir = str(tmpdir.join("out"))
+    table_dir = str(tmpdir.join("table"))
+    # a class with no fields, e.g. an empty test split
+    prep = image_prep.ImagePrep({"train": {"a": [field, field, field]},
+                                 "test": {"a": []}})
+    prep.create_directories_chop_par(out_dir, n_jobs=2, size=20,
+                                     schedule=schedule,
+                                     nucleus_table=table_dir)
+    assert tables.list_parts(table_dir) == []
+    df = tables.read_table(os.path.join(
+        table_dir, "nuclei.{}".format(tables.default_format())))
+    assert len(df) == 12
+    assert (df["group"] == "train").all()
+    written = {os.path.splitext(f)[0]
+               for f in os.listdir(os.path.join(out_dir, "train", "a"))}
+    assert set(df["crop"]) == written
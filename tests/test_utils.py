@@ -0,0 +1,36 @@
+"""
+tests for nncell.utils
+"""
+import os
+import numpy as np
+import pytest
+from nncell import utils
+
+
+def test_save_array_uncompressed(tmpdir):
+    arr = np.arange(100, dtype="uint8").reshape(10, 10)
+    path = utils.save_array(os.path.join(str(tmpdir), "arr"), arr)
+    assert path.endswith(".npy")
+    np.testing.assert_array_equal(utils.load_array(path), arr)
+
+
+def test_save_array_compressed(tmpdir):
+    # mostly background, like a nucleus crop
+    arr = np.zeros((100, 100, 3), dtype="uint8")
+    arr[40:60, 40:60] = 200
+    for compress in [True, "zlib", "lzma"]:
+        path = utils.save_array(os.path.join(str(tmpdir), "arr"), arr, compress)
+        assert path.endswith(".npz")
+        assert os.path.getsize(path) < arr.nbytes / 4
+        np.testing.assert_array_equal(utils.load_array(path), arr)
+    with pytest.raises(ValueError):
+        utils.save_array(os.path.join(str(tmpdir), "arr"), arr, "bz2")
+
+
+def test_softmax_batched_and_stable():
+    logits = np.array([[1.0, 2.0, 3.0], [1000.0, 1000.0, 0.0]])
+    probs = utils.softmax(logits)
+    np.testing.assert_allclose(probs.sum(axis=1), 1)
+    np.testing.assert_allclose(probs[1], [0.5, 0.5, 0])
+    np.testing.assert_allclose(probs[0], utils.softmax(logits[0]))
+    np.testing.assert_allclose(utils.softmax(logits.T, axis=0), probs.T)
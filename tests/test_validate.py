@@ -0,0 +1,71 @@
+"""
+tests for nncell.validate
+"""
+import os
+import numpy as np
+from skimage import io
+from nncell import utils
+from nncell import validate
+
+
+def make_dataset(tmpdir):
+    """a dataset with one of each kind of problem"""
+    rng = np.random.RandomState(0)
+    for label in ["a", "b"]:
+        tmpdir.join(label).ensure(dir=True)
+        for i in range(3):
+            arr = rng.randint(0, 255, (8, 8, 3)).astype("uint8")
+            utils.save_array(str(tmpdir.join(label, "img_{}".format(i))), arr)
+    arr = rng.randint(0, 255, (8, 8, 3)).astype("uint8")
+    utils.save_array(str(tmpdir.join("a", "zipped")), arr, compress=True)
+    # truncated .npy, as left by a killed worker
+    path = str(tmpdir.join("b", "img_0.npy"))
+    with open(path, "rb") as f:
+        data = f.read()
+    with open(path, "wb") as f:
+        f.write(data[:-10])
+    # truncated .npz
+    path = utils.save_array(str(tmpdir.join("b", "zipped")), arr, compress=True)
+    with open(path, "rb") as f:
+        data = f.read()
+    with open(path, "wb") as f:
+        f.write(data[:len(data) // 2])
+    # wrong shape
+    utils.save_array(str(tmpdir.join("a", "small")), arr[:4])
+    # dangling link
+    os.symlink(str(tmpdir.join("gone.npy")), str(tmpdir.join("a", "link.npy")))
+    # images, one truncated
+    io.imsave(str(tmpdir.join("b", "good.png")), arr)
+    io.imsave(str(tmpdir.join("b", "cut.png")), arr)
+    with open(str(tmpdir.join("b", "cut.png")), "r+b") as f:
+        f.truncate(40)
+
+
+def test_validate_finds_problems(tmpdir):
+    make_dataset(tmpdir)
+    report = validate.validate(str(tmpdir), n_threads=2, chunk_size=2)
+    assert report["n_files"] == 12
+    assert report["counts"] == {"a": 4, "b": 3}
+    corrupt = sorted(os.path.basename(p) for p, _ in report["corrupt"])
+    assert corrupt == ["cut.png", "img_0.npy", "zipped.npz"]
+    assert [os.path.basename(p) for p in report["missing"]] == ["link.npy"]
+    assert [(os.path.basename(p), s) for p, s, _ in report["misshaped"]] == [
+        ("small.npy", (4, 8, 3))]
+    assert report["shapes"] == {((8, 8, 3), "|u1"): 6, ((4, 8, 3), "|u1"): 1}
+    # an expected shape that nothing matches
+    report = validate.validate(str(tmpdir), shape=(4, 8, 3))
+    assert len(report["misshaped"]) == 6
+
+
+def test_validate_quarantine(tmpdir):
+    data_dir = tmpdir.join("data")
+    make_dataset(data_dir)
+    quarantine = str(tmpdir.join("quarantine"))
+    report = validate.validate(str(data_dir), quarantine=quarantine)
+    assert len(report["quarantined"]) == 4
+    assert os.path.isfile(os.path.join(quarantine, "b", "img_0.npy"))
+    assert not data_dir.join("a", "small.npy").exists()
+    # only the dangling link is left
+    report = validate.validate(str(data_dir))
+    assert not report["corrupt"] and not report["misshaped"]
+    assert len(report["missing"]) == 1